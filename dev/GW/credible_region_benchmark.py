@@ -0,0 +1,97 @@
+"""
+Benchmark the credible region engine against the old in-place sorting get_a
+
+Run from the repo root:
+PYTHONPATH=. python dev/GW/credible_region_benchmark.py
+"""
+
+import timeit
+import numpy as np
+import astropy.units as u
+import astropy_healpix as ah
+from astropy.table import Table
+
+from utils.credible_region import CredibleRegions
+
+
+def get_a_sort(skymap, probarea):
+    """
+    The original get_a, sorting the table in place on every call
+    """
+    skymap.sort("PROBDENSITY", reverse=True)
+    level, ipix = ah.uniq_to_level_ipix(skymap["UNIQ"])
+    pixel_area = ah.nside_to_pixel_area(ah.level_to_nside(level))
+    prob = pixel_area * skymap["PROBDENSITY"]
+    cumprob = np.cumsum(prob)
+    i = cumprob.searchsorted(probarea)
+    area = (pixel_area[:i].sum()).to_value(u.deg**2)
+    return area
+
+
+def simulate_multiorder_skymap(
+    base_level=6, max_level=11, n_refine=2000, sigma_deg=5, seed=0, center=None
+):
+    """
+    A gaussian blob on a multiorder grid, refining the most probable pixels like bayestar.
+    The blob is at center (ra, dec in deg), or somewhere random if that is None.
+    The defaults give ~ 50000 rows, similar in size to O4 multiorder skymaps
+    """
+    rng = np.random.default_rng(seed)
+    if center is None:
+        ra0, dec0 = rng.uniform(0, 360), rng.uniform(-60, 60)
+    else:
+        ra0, dec0 = center
+    levels = np.full(12 * 4**base_level, base_level)
+    ipix = np.arange(12 * 4**base_level)
+    for level in range(base_level, max_level):
+        nside = ah.level_to_nside(level)
+        ra, dec = ah.healpix_to_lonlat(ipix, nside, order="nested")
+        dist = np.hypot(
+            (ra.to_value(u.deg) - ra0) * np.cos(dec.to_value(u.rad)),
+            dec.to_value(u.deg) - dec0,
+        )
+        on_level = levels == level
+        refine = on_level & (dist < np.sort(dist[on_level])[n_refine // 4])
+        children = (4 * ipix[refine])[:, None] + np.arange(4)
+        ipix = np.concatenate([ipix[~refine], children.ravel()])
+        levels = np.concatenate([levels[~refine], np.full(children.size, level + 1)])
+    uniq = ah.level_ipix_to_uniq(levels, ipix)
+    ra, dec = ah.healpix_to_lonlat(ipix, ah.level_to_nside(levels), order="nested")
+    dist = np.hypot(
+        (ra.to_value(u.deg) - ra0) * np.cos(dec.to_value(u.rad)),
+        dec.to_value(u.deg) - dec0,
+    )
+    probdensity = np.exp(-0.5 * (dist / sigma_deg) ** 2)
+    pixel_area = ah.nside_to_pixel_area(ah.level_to_nside(levels)).to_value(u.sr)
+    probdensity /= np.sum(probdensity * pixel_area)
+    return Table({"UNIQ": uniq, "PROBDENSITY": probdensity / u.sr})
+
+
+def run_benchmark(levels=(0.5, 0.9, 0.95), number=20):
+    for n_refine in [500, 2000, 8000]:
+        skymap = simulate_multiorder_skymap(n_refine=n_refine)
+        old_areas = [get_a_sort(skymap.copy(), level) for level in levels]
+        new_areas = CredibleRegions(skymap).get_areas(levels)
+        assert np.allclose(old_areas, new_areas), (old_areas, new_areas)
+
+        time_old = (
+            timeit.timeit(
+                lambda: [get_a_sort(skymap, level) for level in levels], number=number
+            )
+            / number
+        )
+        time_new = (
+            timeit.timeit(
+                lambda: CredibleRegions(skymap).get_areas(levels), number=number
+            )
+            / number
+        )
+        print(
+            f"{len(skymap)} pixels, levels {list(levels)}: "
+            f"get_a {1e3 * time_old:.1f} ms, CredibleRegions {1e3 * time_new:.1f} ms "
+            f"({time_old / time_new:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,544 @@
+"""
+Replay LVC alerts through the trigger pipeline against stand-in services, and report how
+long each stage takes from the Kafka message to sending the trigger
+
+Fritz, GraceDB, Kowalski, the ZTF queue and email are replaced by local stand-ins with
+configurable response latency, and everything else (parsing, the skymap statistics, the
+plan estimate, the trigger ledger) is the real code. The pipeline runs on an event loop
+with a virtual clock that follows real time while anything is running and skips ahead
+when everything is waiting, so the 10-30 s sleeps and polling waits cost nothing but are
+still counted in the latencies.
+
+Run with synthetic alerts or a directory of recorded VOEvent xml files:
+python dev/GW/trigger_replay.py --events 20
+python dev/GW/trigger_replay.py --voevents path/to/voevents --latency fritz=2
+"""
+
+import os
+import sys
+import time
+import heapq
+import argparse
+import asyncio
+import tempfile
+import selectors
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from astropy.time import Time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+
+import trigger_utils.trigger_pipeline as trigger_pipeline
+import trigger_utils.trigger_utils as trigger_utils
+from trigger_utils.chirp_mass import ChirpMassDistribution
+from trigger_utils.plan_estimator import get_night_window, get_sidereal_time
+from utils.tracing import get_tracer
+from credible_region_benchmark import simulate_multiorder_skymap
+
+# seconds each stand-in service takes to respond
+LATENCY = {
+    "skymap": 1.0,  # GraceDB skymap download
+    "mchirp": 0.5,  # GraceDB chirp mass file
+    "fritz": 0.5,  # each Fritz API call
+    "kowalski": 2.0,  # ZTF queue and ZTF_ops queries
+    "email": 0.0,  # only queued in the notification outbox
+}
+
+# seconds before a stand-in service has what we ask for, so we poll until then
+READY_AFTER = {
+    "mchirp": 60,  # chirp mass file uploaded to GraceDB after the alert
+    "fritz_event": 45,  # Fritz ingests the GCN
+    "plan": 90,  # Fritz generates the observation plan
+}
+
+# the alert being replayed, for attributing stand-in calls - to_thread copies it into workers
+current_alert = contextvars.ContextVar("current_alert", default=None)
+
+
+class VirtualClock:
+    """
+    Seconds that advance with real time, and jump forward whenever the event loop and
+    every worker thread are waiting on the clock
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.last_real = time.perf_counter()
+        self.condition = threading.Condition()
+        self.active = 0  # executor jobs in flight
+        self.sleepers = []  # heap of wake times of worker threads in sleep()
+        self.loop = None
+
+    def sync(self):
+        real = time.perf_counter()
+        self.now += real - self.last_real
+        self.last_real = real
+        self.wake_sleepers()
+
+    def time(self):
+        with self.condition:
+            self.sync()
+            return self.now
+
+    def wake_sleepers(self):
+        woken = False
+        while self.sleepers and self.sleepers[0] <= self.now:
+            heapq.heappop(self.sleepers)
+            woken = True
+        if woken:
+            self.condition.notify_all()
+
+    def busy(self):
+        """
+        Whether a worker thread is doing real work rather than sleeping on the clock
+        """
+        return self.active > len(self.sleepers)
+
+    def advance(self, timeout):
+        """
+        Skip to the next timer, timeout seconds away (None for no timer), or the next sleeper
+        """
+        target = np.inf if timeout is None else self.now + timeout
+        if self.sleepers:
+            target = min(target, self.sleepers[0])
+        if np.isfinite(target):
+            self.now = max(self.now, target)
+            self.wake_sleepers()
+
+    def sleep(self, seconds):
+        """
+        time.sleep for worker threads, in virtual time
+        """
+        with self.condition:
+            self.sync()
+            wake = self.now + seconds
+            heapq.heappush(self.sleepers, wake)
+            # the event loop may be waiting on real I/O for this thread - let it skip ahead
+            self.loop.call_soon_threadsafe(lambda: None)
+            while self.now < wake:
+                self.condition.wait(0.05)
+                self.sync()
+
+
+class VirtualSelector:
+    """
+    Selector that skips ahead on the clock instead of blocking when nothing is running
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.selector = selectors.DefaultSelector()
+
+    def __getattr__(self, name):
+        return getattr(self.selector, name)
+
+    def select(self, timeout=None):
+        events = self.selector.select(0)
+        if events or timeout == 0:
+            return events
+        with self.clock.condition:
+            self.clock.sync()
+            if not self.clock.busy() and (timeout is not None or self.clock.sleepers):
+                self.clock.advance(timeout)
+                return []
+        # a worker thread is running, wait for it in real time
+        return self.selector.select(0.05)
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock):
+        super().__init__(VirtualSelector(clock))
+        self.clock = clock
+        clock.loop = self
+
+    def time(self):
+        return self.clock.time()
+
+    def run_in_executor(self, executor, func, *args):
+        with self.clock.condition:
+            self.clock.active += 1
+        future = super().run_in_executor(executor, func, *args)
+        future.add_done_callback(self.job_done)
+        return future
+
+    def job_done(self, future):
+        with self.clock.condition:
+            self.clock.active -= 1
+
+
+class ReplayLogger:
+    """
+    Stands in for the slack logger, keeping messages with the virtual time
+    """
+
+    def __init__(self, clock, verbose=False):
+        self.clock = clock
+        self.verbose = verbose
+        self.messages = []
+
+    def log(self, message, slack=True):
+        self.messages.append((self.clock.time(), str(message)))
+        if self.verbose:
+            print(f"{self.clock.time():9.1f} s  {message}")
+
+
+class StandInServices:
+    """
+    Local versions of everything the trigger pipeline calls over the network. Each call
+    sleeps for the service latency on the virtual clock and is recorded against the alert
+    being processed.
+    """
+
+    def __init__(self, clock, latency=None, ready_after=None, seed=0):
+        self.clock = clock
+        self.latency = {**LATENCY, **(latency or {})}
+        self.ready_after = {**READY_AFTER, **(ready_after or {})}
+        self.rng = np.random.default_rng(seed)
+        self.first_seen = {}
+        self.skymaps = {}
+        # ra (deg) on the meridian at Palomar in the middle of the night
+        self.meridian = None
+        self.lock = threading.Lock()
+
+    def call(self, stage, service):
+        start = self.clock.time()
+        if self.latency[service]:
+            self.clock.sleep(self.latency[service])
+        alert = current_alert.get()
+        if alert is not None:
+            alert["calls"].append((stage, start, self.clock.time()))
+
+    def ready(self, key, what):
+        """
+        Whether what has become available, counting from the first time key was asked for
+        """
+        now = self.clock.time()
+        with self.lock:
+            first = self.first_seen.setdefault(key, now)
+        return now - first >= self.ready_after[what]
+
+    def get_table(self, url):
+        """
+        Skymaps are downloaded once per url, like the skymap cache
+        """
+        with self.lock:
+            cached = url in self.skymaps
+        if not cached:
+            self.call("skymap download", "skymap")
+        with self.lock:
+            if url not in self.skymaps:
+                seed = int(self.rng.integers(1 << 31))
+                # up for a few hours of the night the plan estimate looks at
+                center = (
+                    (self.meridian + self.rng.uniform(-30, 30)) % 360,
+                    self.rng.uniform(0, 60),
+                )
+                skymap = simulate_multiorder_skymap(
+                    n_refine=500, sigma_deg=3, seed=seed, center=center
+                )
+                skymap.meta["DISTMEAN"] = self.rng.uniform(500, 3000)
+                self.skymaps[url] = skymap
+            return self.skymaps[url]
+
+    def query_chirp_mass(self, superevent_id, path_data):
+        self.call("chirp mass", "mchirp")
+        if not self.ready(("mchirp", superevent_id), "mchirp"):
+            return None
+        return ChirpMassDistribution([22, 30, 44, 60], [0.1, 0.7, 0.2])
+
+    def query_fritz_gcn_events(self, dateobs, skymap_name, token, mode):
+        self.call("fritz event", "fritz")
+        if not self.ready(("event", dateobs), "fritz_event"):
+            return None
+        return abs(hash(dateobs)) % 100000, abs(hash((dateobs, skymap_name))) % 100000
+
+    def submit_plan(self, token, allocation, superevent_id, *args):
+        self.call("plan request", "fritz")
+        return f"{superevent_id}_BBHBot_replay"
+
+    def get_plan_stats(self, gcnevent_id, queuename, token, mode):
+        self.call("plan stats", "fritz")
+        if not self.ready(("plan", queuename), "plan"):
+            return None
+        start = Time(self.clock.time() / 86400 + Time.now().jd, format="jd").isot
+        return [False, 2400, 0.8, start, abs(hash(queuename)) % 100000]
+
+    def query_kowalski_ztf_queue(self, keywords, token, allocation):
+        self.call("ztf queue check", "kowalski")
+        return False
+
+    def trigger_ztf(self, plan_request_id, token, mode):
+        self.call("trigger ztf", "fritz")
+
+    def delete_trigger_ztf(self, plan_request_id, token, mode):
+        self.call("delete trigger", "fritz")
+
+    def send_trigger_email(self, credentials, message, dateobs, path_data="data"):
+        self.call("email", "email")
+
+    def skymap_coverage(self):
+        services = self
+
+        class Coverage(trigger_utils.SkymapCoverage):
+            def __init__(self, *args, **kwargs):
+                pass
+
+            def get_coverage_fractions(self):
+                services.call("skymap coverage", "kowalski")
+                return {"g": 0.1, "r": 0.1, "both": 0.1, "any": 0.2}
+
+        return Coverage
+
+    def install(self, path_data):
+        """
+        Point the trigger pipeline at the stand-ins
+        """
+        start, end = get_night_window(path_data)
+        self.meridian = float(get_sidereal_time((start + end) / 2))
+        for name in [
+            "query_chirp_mass",
+            "query_fritz_gcn_events",
+            "submit_plan",
+            "get_plan_stats",
+            "query_kowalski_ztf_queue",
+            "trigger_ztf",
+            "delete_trigger_ztf",
+            "send_trigger_email",
+        ]:
+            setattr(trigger_pipeline, name, getattr(self, name))
+        trigger_pipeline.SkymapCoverage = self.skymap_coverage()
+        trigger_pipeline.get_skymap_cache = lambda path_data: self
+        trigger_utils.get_skymap_cache = lambda path_data: self
+
+
+def synthetic_voevent(superevent_id, alert_type, isotime, version, rng):
+    """
+    A minimal LVC notice with the parameters the pipeline reads, mostly passing the cuts
+    """
+    bbh = rng.choice([0.95, 0.2], p=[0.8, 0.2])
+    far = rng.choice([1e-10, 1e-6], p=[0.9, 0.1])
+    return f"""<?xml version="1.0" ?>
+<voe:VOEvent xmlns:voe="http://www.ivoa.net/xml/VOEvent/v2.0" ivorn="ivo://gwnet/LVC#{superevent_id}-{version}-{alert_type}" role="observation" version="2.0">
+<Who><Date>{isotime}</Date></Who>
+<What>
+<Param name="Packet_Type" value="151"/><Param name="internal" value="0"/><Param name="Pkt_Ser_Num" value="{version}"/>
+<Param name="GraceID" value="{superevent_id}"/><Param name="AlertType" value="{alert_type}"/><Param name="HardwareInj" value="0"/>
+<Param name="OpenAlert" value="1"/><Param name="EventPage" value="https://gracedb.ligo.org/superevents/{superevent_id}/view/"/>
+<Param name="Instruments" value="H1,L1"/><Param name="FAR" value="{far}"/><Param name="Group" value="CBC"/>
+<Param name="Pipeline" value="gstlal"/><Param name="Search" value="AllSky"/><Param name="Significant" value="1"/>
+<Group name="GW_SKYMAP" type="GW_SKYMAP"><Param name="skymap_fits" value="https://gracedb.ligo.org/api/superevents/{superevent_id}/files/bayestar.multiorder.fits,{version}"/></Group>
+<Group name="Classification" type="Classification"><Param name="BNS" value="0"/><Param name="NSBH" value="0"/>
+<Param name="BBH" value="{bbh}"/><Param name="Terrestrial" value="{1 - bbh:.2f}"/></Group>
+</What>
+<WhereWhen><ObsDataLocation><ObservationLocation><AstroCoords><Time><TimeInstant><ISOTime>{isotime}</ISOTime></TimeInstant></Time></AstroCoords></ObservationLocation></ObsDataLocation></WhereWhen>
+</voe:VOEvent>"""
+
+
+def synthetic_alerts(num_events, spacing=600, seed=0):
+    """
+    (arrival time in s, VOEvent) for num_events superevents, each with two preliminary
+    notices seconds apart and an initial notice ~10 minutes later
+    """
+    rng = np.random.default_rng(seed)
+    alerts = []
+    for i in range(num_events):
+        superevent_id = f"S{i:06d}replay"
+        arrival = i * spacing + rng.uniform(0, spacing / 2)
+        isotime = Time.now().isot
+        schedule = [("Preliminary", 0), ("Preliminary", 15), ("Initial", 600)]
+        for version, (alert_type, delay) in enumerate(schedule, start=1):
+            voevent = synthetic_voevent(
+                superevent_id, alert_type, isotime, version, rng
+            )
+            alerts.append((arrival + delay, voevent))
+    return sorted(alerts, key=lambda x: x[0])
+
+
+def recorded_alerts(directory, spacing=60):
+    """
+    (arrival time in s, VOEvent) for each xml file in directory, in name order
+    """
+    names = sorted(x for x in os.listdir(directory) if x.endswith(".xml"))
+    alerts = []
+    for i, name in enumerate(names):
+        with open(os.path.join(directory, name), "rb") as f:
+            alerts.append((i * spacing, f.read()))
+    return alerts
+
+
+async def replay(pipeline, alerts, clock):
+    """
+    Feed alerts to the pipeline at their arrival times, and return a record for each
+    """
+    records = []
+    tasks = []
+
+    async def arrive(arrival, voevent):
+        await asyncio.sleep(max(0, arrival - clock.time()))
+        header = trigger_utils.parse_alert_header(voevent)
+        record = {
+            "superevent_id": header[0] if header else None,
+            "arrival": clock.time(),
+            "calls": [],
+            "done": None,
+        }
+        records.append(record)
+        current_alert.set(record)
+        start = time.perf_counter()
+        task = pipeline.submit(voevent)
+        record["parse"] = time.perf_counter() - start
+        if task is None:
+            record["done"] = record["arrival"]
+            return
+        tasks.append(task)
+        await asyncio.wait([task])
+        record["done"] = clock.time()
+        record["cancelled"] = task.cancelled()
+
+    start = clock.time()
+    await asyncio.gather(*(arrive(start + a, v) for a, v in alerts))
+    # triggers still being committed after their alert
+    await asyncio.gather(*pipeline.commits.values(), return_exceptions=True)
+    return records
+
+
+def percentiles(values):
+    if not values:
+        return "-"
+    p50, p95 = np.percentile(values, [50, 95])
+    return f"{p50:8.1f} {p95:8.1f} {max(values):8.1f}"
+
+
+def report(records):
+    """
+    Per stage: time spent waiting on the service, and time from the alert arriving to the
+    end of the stage. End to end: alert arriving to the trigger being sent, and to the
+    alert being done with.
+    """
+    skipped = [r for r in records if "cancelled" not in r]
+    superseded = [r for r in records if r.get("cancelled")]
+    stages = []
+    for record in records:
+        for stage, _, _ in record["calls"]:
+            if stage not in stages:
+                stages.append(stage)
+
+    print(
+        f"{len(records)} alerts: {len(skipped)} skipped from the header or unparseable, "
+        f"{len(superseded)} superseded by a newer alert"
+    )
+    print(
+        f"{'stage':<18} {'alerts':>6} {'calls':>6}   "
+        f"{'waiting on service (s) p50/p95/max':>34}   {'since arrival (s) p50/p95/max':>29}"
+    )
+    for stage in stages:
+        waiting, reached, calls = [], [], 0
+        for record in records:
+            stage_calls = [c for c in record["calls"] if c[0] == stage]
+            if not stage_calls:
+                continue
+            calls += len(stage_calls)
+            waiting.append(sum(end - start for _, start, end in stage_calls))
+            reached.append(stage_calls[-1][2] - record["arrival"])
+        print(
+            f"{stage:<18} {len(waiting):>6} {calls:>6}   {percentiles(waiting):>34}   {percentiles(reached):>29}"
+        )
+
+    parse = [1e3 * r["parse"] for r in records if "parse" in r]
+    triggered = [
+        c[2] - r["arrival"]
+        for r in records
+        for c in r["calls"]
+        if c[0] == "trigger ztf"
+    ]
+    done = [r["done"] - r["arrival"] for r in records if r["done"] is not None]
+    print()
+    print(f"{'end to end':<26} {'p50':>8} {'p95':>8} {'max':>8}")
+    print(f"{'header and parse (ms)':<26} {percentiles(parse)}")
+    print(f"{'arrival to trigger (s)':<26} {percentiles(triggered)}")
+    print(f"{'arrival to done (s)':<26} {percentiles(done)}")
+    print(f"{len(triggered)} triggers sent")
+
+
+def parse_latency(values):
+    latency = {}
+    for value in values or []:
+        name, seconds = value.split("=")
+        latency[name] = float(seconds)
+    return latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--events", type=int, default=10, help="synthetic superevents")
+    parser.add_argument("--voevents", help="directory of recorded VOEvent xml files")
+    parser.add_argument("--spacing", type=float, default=600, help="s between events")
+    parser.add_argument(
+        "--latency",
+        nargs="*",
+        help=f"service=seconds, services {list(LATENCY)}",
+    )
+    parser.add_argument(
+        "--ready-after",
+        nargs="*",
+        help=f"what=seconds, for {list(READY_AFTER)}",
+    )
+    parser.add_argument("--path-data", help="data directory, default a new temp dir")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-prewarm",
+        action="store_true",
+        help="don't start lookups on Preliminary alerts ahead of later alerts",
+    )
+    parser.add_argument("--verbose", action="store_true", help="print the pipeline log")
+    args = parser.parse_args()
+
+    path_data = args.path_data or tempfile.mkdtemp(prefix="trigger_replay_")
+    clock = VirtualClock()
+    loop = VirtualClockLoop(clock)
+    # worker threads sleep through service latencies, so have enough that none wait for a thread
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=64))
+    asyncio.set_event_loop(loop)
+
+    services = StandInServices(
+        clock,
+        latency=parse_latency(args.latency),
+        ready_after=parse_latency(args.ready_after),
+        seed=args.seed,
+    )
+    services.install(path_data)
+    # keep replay spans out of the live trace file
+    get_tracer().configure(path=f"{path_data}/trace.jsonl", process="replay")
+    logger = ReplayLogger(clock, verbose=args.verbose)
+    credentials = {"kowalski_username": None, "kowalski_password": None}
+    pipeline = trigger_pipeline.TriggerPipeline(
+        credentials,
+        None,
+        None,
+        "",
+        path_data,
+        False,
+        logger,
+        prewarm=not args.no_prewarm,
+    )
+
+    if args.voevents:
+        alerts = recorded_alerts(args.voevents, args.spacing)
+    else:
+        alerts = synthetic_alerts(args.events, args.spacing, args.seed)
+
+    start = time.perf_counter()
+    records = loop.run_until_complete(replay(pipeline, alerts, clock))
+    real = time.perf_counter() - start
+    print(
+        f"replayed {clock.time() / 3600:.2f} h of alerts in {real:.1f} s, data in {path_data}"
+    )
+    report(records)
+    print(f"stage timings (real, not virtual, seconds) in {path_data}/trace.jsonl")
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Local stand-ins for the SMTP server and Slack webhook that the notification outbox
+delivers to, for trying out the outbox without sending real email or Slack messages
+
+The SMTP stand-in speaks just enough SMTP for smtplib (EHLO, AUTH PLAIN, MAIL, RCPT,
+DATA, NOOP, RSET, QUIT), and the Slack stand-in answers webhook POSTs. Both record what
+they receive, can be made slow, and can fail the first few requests so the outbox retries.
+
+Run from the repo root to queue some notifications and watch them get delivered:
+PYTHONPATH=. python dev/outbox_standin.py --emails 5 --slack 20 --slack-failures 3
+"""
+
+import time
+import json
+import argparse
+import tempfile
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.outbox import Outbox
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply("220 localhost stand-in SMTP")
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                self.reply("250-localhost")
+                self.reply("250 AUTH PLAIN")
+            elif verb == "HELO":
+                self.reply("250 localhost")
+            elif verb == "AUTH":
+                self.reply("235 Authentication successful")
+            elif verb == "MAIL":
+                sender, recipients = command[10:].strip("<>"), []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command[8:].strip("<>"))
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line in (b".\r\n", b".\n"):
+                        break
+                    data.append(line.decode())
+                time.sleep(server.latency)
+                with server.lock:
+                    fail = server.failures > 0
+                    if fail:
+                        server.failures -= 1
+                    else:
+                        server.messages.append((sender, recipients, "".join(data)))
+                self.reply("451 Try again later" if fail else "250 OK queued")
+            elif verb in ("NOOP", "RSET"):
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class StandInSMTP(socketserver.ThreadingTCPServer):
+    """
+    SMTP server on localhost that records each message instead of sending it
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0.0, failures=0):
+        super().__init__(("127.0.0.1", port), SMTPHandler)
+        self.latency = latency
+        self.failures = failures
+        self.connections = 0
+        self.messages = []
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class SlackHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(server.latency)
+        with server.lock:
+            fail = server.failures > 0
+            if fail:
+                server.failures -= 1
+            else:
+                server.messages.append(payload["text"])
+        self.send_response(503 if fail else 200)
+        self.end_headers()
+        self.wfile.write(b"unavailable" if fail else b"ok")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInSlack(ThreadingHTTPServer):
+    """
+    Slack incoming webhook on localhost that records each message
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, failures=0):
+        super().__init__(("127.0.0.1", port), SlackHandler)
+        self.latency = latency
+        self.failures = failures
+        self.messages = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/webhook"
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--emails", type=int, default=5)
+    parser.add_argument("--slack", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.5, help="s per request")
+    parser.add_argument("--email-failures", type=int, default=1)
+    parser.add_argument("--slack-failures", type=int, default=2)
+    args = parser.parse_args()
+
+    smtp = serve(StandInSMTP(latency=args.latency, failures=args.email_failures))
+    slack = serve(StandInSlack(latency=args.latency, failures=args.slack_failures))
+    outbox = Outbox(
+        tempfile.mkdtemp(prefix="outbox_"),
+        smtp_host="127.0.0.1",
+        smtp_port=smtp.port,
+        starttls=False,
+        initial_delay=0.5,
+    )
+
+    start = time.perf_counter()
+    for i in range(args.emails):
+        outbox.email(
+            "bbhbot@example.com",
+            "password",
+            ["a@example.com", "b@example.com", "c@example.com"],
+            f"ZTF Triggered for S{i:06d}",
+            "<html><body><p>stand-in</p></body></html>",
+        )
+    for i in range(args.slack):
+        outbox.slack(slack.url, f"stand-in message {i}")
+    queued = time.perf_counter() - start
+    print(
+        f"queued {args.emails} emails and {args.slack} slack messages in {1000 * queued:.1f} ms"
+    )
+
+    while set(outbox.counts()) & {"pending", "sending"}:
+        time.sleep(0.05)
+    delivered = time.perf_counter() - start
+    print(f"delivered in {delivered:.1f} s: {outbox.counts()}")
+    print(
+        f"smtp: {len(smtp.messages)} messages over {smtp.connections} connections, "
+        f"{sum(len(r) for _, r, _ in smtp.messages)} recipients"
+    )
+    print(f"slack: {len(slack.messages)} messages")
+    outbox.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,7 @@ from flares_utils.flares_utils import (
     RollingWindowHeuristic,
 )
 from utils.log import Logger
+from utils.http_client import get_http_client
 from utils.parser import followup_parser_args
 
 
@@ -160,6 +161,7 @@ trigger_status = Fritz(
     fritz_token,
     kowalski_username,
     kowalski_password,
+    path_data=path_data,
 ).get_trigger_status()
 
 # save the new events to dictionary
@@ -337,3 +339,5 @@ for id in check_for_flares:
         k_mad=3,
         testing=testing,
     ).get_flares(github_token=github_token)
+
+get_http_client().log_summary(logger)
@@ -2,15 +2,10 @@ import pandas as pd
 from pandas import json_normalize
 import numpy as np
 import matplotlib.pyplot as plt
-from astropy.table import Table
-import astropy.cosmology as cos
-from astropy.cosmology import Planck15 as cosmo
 import astropy_healpix as ah
 import astropy.units as u
 from astropy.time import Time
 from datetime import datetime, timedelta
-import requests
-from io import BytesIO
 import xmltodict
 import pickle
 import gzip
@@ -26,11 +21,14 @@ from matplotlib import rcParams
 
 from trigger_utils.trigger_utils import (
     query_mchirp_gracedb,
-    m_total_mlp,
-    get_a,
+    get_mass_estimator,
     SkymapCoverage,
 )
 from utils.log import Logger, PublishToGithub
+from utils.skymap_cache import get_skymap_cache
+from utils.credible_region import CredibleRegions
+from utils.cosmology import z_at_luminosity_distance
+from utils.http_client import get_http_client
 
 # set up logger (this one wont send to slack)
 logger = Logger(filename="new_events_utils")
@@ -102,7 +100,7 @@ class GetSuperevents:
         ]
         urls = [i + j for i, j in zip(superevent_files, file)]
         urls_save = [x for x in urls if "none" not in x]
-        response = [requests.get(url).text for url in urls_save]
+        response = [get_http_client().get(url).text for url in urls_save]
         return response
 
     def get_params(self, response):
@@ -198,9 +196,10 @@ class GetSuperevents:
             logger.log(logmessage, slack=False)
 
     def proc_skymap(self, skymap_url):
-        skymap_response = requests.get(skymap_url)
-        skymap_bytes = skymap_response.content
-        skymap = Table.read(BytesIO(skymap_bytes))
+        cache = get_skymap_cache(self.path_data)
+        content_hash = cache.fetch(skymap_url)
+        skymap = cache.read_table(content_hash)
+        skymap_bytes = cache.read_bytes(content_hash)
         skymap_str = base64.b64encode(skymap_bytes).decode("utf-8")
         return skymap, skymap_str
 
@@ -213,21 +212,11 @@ class GetSuperevents:
             dateobs = Time(t0, precision=0)
             dateobs = Time(dateobs.iso).datetime
             dateobs_str = dateobs.strftime("%Y-%m-%dT%H:%M:%S")
-            a90 = get_a(skymap, 0.9)
-            a50 = get_a(skymap, 0.5)
-            if distmean - 3 * diststd > 0:
-                zmin = cos.z_at_value(
-                    cosmo.luminosity_distance,
-                    (distmean - 3 * diststd) * u.Mpc,
-                    method="bounded",
-                ).value
-            else:
-                zmin = 0
-            zmax = cos.z_at_value(
-                cosmo.luminosity_distance,
-                (distmean + 3 * diststd) * u.Mpc,
-                method="bounded",
-            ).value
+            a90, a50 = CredibleRegions(skymap).get_areas([0.9, 0.5])
+            zmin, zmax = z_at_luminosity_distance(
+                [max(distmean - 3 * diststd, 0), distmean + 3 * diststd],
+                self.path_data,
+            )
             return (
                 distmean,
                 diststd,
@@ -282,9 +271,7 @@ class GetSuperevents:
         # mass
         dist = [x[0] for x in skymap_data]
         far = [x[9] for x in params]
-        mass = [
-            m_total_mlp(self.path_data, d, f, dl_bns=168.0) for d, f in zip(dist, far)
-        ]
+        mass = list(get_mass_estimator(self.path_data).predict(dist, far))
         try:
             chirpmass = [query_mchirp_gracedb(str(x[0]), self.path_data) for x in params]
         except:
@@ -307,6 +294,7 @@ class Fritz:
         fritz_token,
         kowalsi_username,
         kowalski_password,
+        path_data="data",
     ):
         self.eventid = eventid
         self.dateid = dateid
@@ -317,11 +305,12 @@ class Fritz:
         self.fritz_token = fritz_token
         self.kowalski_username = kowalsi_username
         self.kowalski_password = kowalski_password
+        self.path_data = path_data
 
     def query_fritz_observation_plans(self, allocation, token):
         headers = {"Authorization": f"token {token}"}
         endpoint = f"https://fritz.science/api/allocation/observation_plans/{allocation}?numPerPage=1000"
-        response = requests.request("GET", endpoint, headers=headers)
+        response = get_http_client().request("GET", endpoint, headers=headers)
         if response.status_code == 200:
             json_string = response.content.decode("utf-8")
             json_data = json.loads(json_string)
@@ -429,21 +418,6 @@ class Fritz:
         total_time = stats[0]["statistics"]["total_time"]
         probability = stats[0]["statistics"]["probability"]
         start = stats[0]["statistics"]["start_observation"]
-        # check serendiptious coverage case
-        skymap_name = selected_plan["localization"]["localization_name"]
-        frac_observed = SkymapCoverage(
-            localdateobs=dateid,
-            localname=skymap_name,
-            localprob=0.9,
-            fritz_token=self.fritz_token,
-            fritz_mode="",  # TODO: add testing fritz api mode?
-            kowalski_username=self.kowalski_username,
-            kowalski_password=self.kowalski_password,
-        ).get_coverage_fraction()
-        if frac_observed > 0.9 * probability:
-            serendipitious_observation = True
-        else:
-            serendipitious_observation = False
         # independently get the intended trigger status
         if (
             far < 10
@@ -474,6 +448,22 @@ class Fritz:
             trigger_status == "not triggered"
             and intended_trigger_status == "triggered"
         ):
+            # check serendiptious coverage case - the exposures are cached by night, so
+            # measuring the coverage again is cheap and reports what we actually observed
+            skymap_name = selected_plan["localization"]["localization_name"]
+            # same test as the trigger and cadence
+            frac_observed = SkymapCoverage(
+                localdateobs=dateid,
+                localname=skymap_name,
+                localprob=0.9,
+                fritz_token=self.fritz_token,
+                fritz_mode="",  # TODO: add testing fritz api mode?
+                kowalski_username=self.kowalski_username,
+                kowalski_password=self.kowalski_password,
+                superevent_id=eventid,
+                path_data=self.path_data,
+            ).get_coverage_fraction()
+            serendipitious_observation = frac_observed > 0.9 * probability
             if serendipitious_observation:
                 logmessage = (
                     f"Correct no trigger: serendipitous coverage for {eventid}"
@@ -854,8 +844,10 @@ class KowalskiCrossmatch:
         """
         order coords based on skymap probability, so when we submit to ZFPS we submit highest prob first
         """
-        # test this
-        skymap = Table.read(BytesIO(base64.b64decode(skymapstring)))
+        # the same content as parsed in GetSuperevents.proc_skymap, so this is a cache hit
+        skymap = get_skymap_cache(self.path_data).table_from_bytes(
+            base64.b64decode(skymapstring)
+        )
         max_level = 29  # arbitrarily high resolution
         max_nside = ah.level_to_nside(max_level)
         level, ipix = ah.uniq_to_level_ipix(skymap["UNIQ"])
@@ -1417,7 +1409,7 @@ class PlotSkymap:
             ]
 
             url = event_files[key[0]]
-            skymap = read_sky_map(url)[0]
+            skymap = read_sky_map(get_skymap_cache(self.path_data).get_path(url))[0]
             return skymap
 
     def plot(
@@ -4,7 +4,6 @@ import json
 import pandas as pd
 from datetime import datetime
 from astropy.time import Time
-import requests
 import os
 import re
 from io import StringIO
@@ -14,6 +13,7 @@ import matplotlib.pyplot as plt
 import math
 
 from utils.log import Logger
+from utils.http_client import get_http_client
 
 # set up logger (this one wont send to slack)
 logger = Logger(filename="cadence_utils")
@@ -492,7 +492,7 @@ class GetPhotometry:
         }
         # fixed IP address/URL where requests are submitted:
         url = "https://ztfweb.ipac.caltech.edu/cgi-bin/batchfp.py/submit"
-        r = requests.post(
+        r = get_http_client().post(
             url, auth=(self.auth_username, self.auth_password), data=payload
         )
         if r.status_code == 200:
@@ -613,7 +613,7 @@ class SavePhotometry:
         }
         # fixed IP address/URL where requests are submitted:
         url = "https://ztfweb.ipac.caltech.edu/cgi-bin/getBatchForcedPhotometryRequests.cgi"
-        r = requests.get(
+        r = get_http_client().get(
             url, auth=(self.auth_username, self.auth_password), params=settings
         )
         if r.status_code == 200:
@@ -651,7 +651,7 @@ class SavePhotometry:
         }
         # load the full table of returned zfps:
         url = "https://ztfweb.ipac.caltech.edu/cgi-bin/getBatchForcedPhotometryRequests.cgi"
-        r = requests.get(
+        r = get_http_client().get(
             url, auth=(self.auth_username, self.auth_password), params=settings
         )
         if r.status_code != 200:
@@ -760,7 +760,7 @@ class SavePhotometry:
         }
         # fixed IP address/URL where requests are submitted:
         url = "https://ztfweb.ipac.caltech.edu/cgi-bin/getBatchForcedPhotometryRequests.cgi"
-        r = requests.get(
+        r = get_http_client().get(
             url, auth=(self.auth_username, self.auth_password), params=settings
         )
         if r.status_code == 200:
@@ -784,7 +784,7 @@ class SavePhotometry:
         """
         load lightcurves from url
         """
-        data = requests.get(
+        data = get_http_client().get(
             url,
             auth=(self.auth_username, self.auth_password),
             data={"email": self.email, "userpass": self.userpass},
@@ -1000,7 +1000,7 @@ class PhotometryLog:
         }
         # load the full table of returned zfps:
         url = "https://ztfweb.ipac.caltech.edu/cgi-bin/getBatchForcedPhotometryRequests.cgi"
-        r = requests.get(
+        r = get_http_client().get(
             url, auth=(self.auth_username, self.auth_password), params=settings
         )
         if r.status_code == 200:
@@ -1,31 +1,12 @@
+import asyncio
 from gcn_kafka import Consumer
 import yaml
-import time
 import random
-from astropy.time import Time, TimeDelta
-from ligo.gracedb.exceptions import HTTPError
 
-from trigger_utils.trigger_utils import (
-    parse_gcn_dict,
-    get_params,
-    check_triggered_csv,
-    SkymapCoverage,
-    query_fritz_gcn_events,
-    query_kowalski_ztf_queue,
-    query_mchirp_gracedb,
-    m_total_mlp,
-    generate_cadence_dates,
-    submit_plan,
-    update_trigger_log,
-    delete_trigger_ztf,
-    get_plan_stats,
-    check_before_sunset,
-    trigger_ztf,
-    add_triggercsv,
-    send_trigger_email,
-    MyException,
-)
+from trigger_utils.trigger_pipeline import TriggerPipeline
 from utils.log import Logger
+from utils.tracing import get_tracer
+from utils.http_client import get_http_client
 
 # settings for the trigger bot
 from utils.parser import trigger_parser_args
@@ -33,12 +14,11 @@ from utils.parser import trigger_parser_args
 args = trigger_parser_args()
 testing = args.testing
 path_data = args.path_data
+get_tracer().configure(enabled=not args.no_trace, process="trigger")
 
 # tokens passwords etc.
 with open("config/Credentials.yaml", "r") as file:
     credentials = yaml.safe_load(file)
-kowalskiusername = credentials["kowalski_username"]
-kowalskipassword = credentials["kowalski_password"]
 
 # set up logging that writes messages locally, sends to slack, and sends emails
 if testing:
@@ -96,279 +76,43 @@ logger.log(f"subscribed to Kafka consumer with groupid {configid} and topics {to
 # heartbeat_thread.daemon = True
 # heartbeat_thread.start()
 
-while True:
-    try:
-        for message in consumer.consume(timeout=1.0):
-            if message.value() is None:
-                logmessage = "No message received"
-                logger.log(logmessage, slack=False)
-                continue
-            try:
-                value = message.value()
-                parsed = parse_gcn_dict(value)
-                params = get_params(parsed)
-                dateobs = params[0]
-                mjd = params[1]
-                superevent_id = params[2]
-                significant = params[3]
-                alert_type = params[4]
-                group = params[5]
-                prob_bbh = params[6]
-                prob_ter = params[7]
-                far = params[8]
-                distmean = params[9]
-                a90 = params[10]
-                skymap_name = params[11]
-
-                # open triggered_events.csv and check for superevent_id
-                triggered, trigger_plan_id = check_triggered_csv(
-                    superevent_id, path_data
-                )
-
-                if (
-                    superevent_id[0] != "S"
-                    or alert_type == "RETRACTION"
-                    or significant != "1"
-                    or group != "CBC"
-                    or prob_bbh < 0.5
-                    or prob_ter > 0.4
-                    or distmean == "error"
-                    or far < 10
-                    or a90 > 1000
-                    or (alert_type == "Preliminary" and skymap_name[-1] == 0)
-                ):
-                    if triggered:
-                        # try to remove trigger from ZTF queue
-                        update_trigger_log(
-                            superevent_id, "valid", False, path_data=path_data
-                        )
-                        delete_trigger_ztf(trigger_plan_id, fritz_token, mode)
-                        logger.log(f"attempting to remove trigger for {superevent_id}")
-                    logmessage = f"{superevent_id} did not pass initial criteria"
-                    logger.log(logmessage)
-                    raise MyException(logmessage)
-
-                logger.log(f"Processing {superevent_id} from {alert_type} alert")
-
-                end_time = time.time() + 600
-                mchirp = None
-                while mchirp is None and time.time() < end_time:
-                    try:
-                        # grab the left bin edge for the most probable mchirp bin
-                        mchirp = query_mchirp_gracedb(
-                            superevent_id, path_data=path_data
-                        )
-                        # trigger on most probable bins >= 22
-                        if mchirp and mchirp < 22:
-                            if triggered:
-                                update_trigger_log(
-                                    superevent_id, "valid", False, path_data=path_data
-                                )
-                                delete_trigger_ztf(trigger_plan_id, fritz_token, mode)
-                                logger.log(
-                                    f"attempting to remove trigger for {superevent_id}"
-                                )
-                            logmessage = f"{superevent_id} did not pass mass criteria"
-                            logger.log(logmessage)
-                            raise MyException(logmessage)
-
-                    except HTTPError:
-                        logmessage = f"GraceDB HTTPError for {superevent_id}, retrying in 60 seconds"
-                        logger.log(logmessage)
-
-                    time.sleep(60)
-                if mchirp is None:
-                    # revert to the mass prediction
-                    logmessage = f"Could not find a chirp mass file on GraceDB for {superevent_id}"
-                    logger.log(logmessage)
-                    mass = m_total_mlp(path_data, distmean, far, dl_bns=168.0)
-                    if mass < 60:
-                        if triggered:
-                            update_trigger_log(
-                                superevent_id, "valid", False, path_data=path_data
-                            )
-                            delete_trigger_ztf(trigger_plan_id, fritz_token, mode)
-                            logger.log(
-                                f"attempting to remove trigger for {superevent_id}"
-                            )
-                    logmessage = (
-                        f"{superevent_id} with mass={mass} did not pass mass criteria"
-                    )
-                    logger.log(logmessage)
-                    raise MyException(logmessage)
-
-                logger.log(f"{superevent_id} passed mass criteria")
-                # find gcn event on fritz
-                if not testing:
-                    time.sleep(30)
-                    end_time = time.time() + 300
-                else:
-                    end_time = time.time() + 1
-                gcnevent_id = None
-                while gcnevent_id is None and time.time() < end_time:
-                    gcnevent_id, localization_id = query_fritz_gcn_events(
-                        dateobs, skymap_name, fritz_token, mode
-                    )
-                    time.sleep(30)
-                if gcnevent_id is None:
-                    logmessage = (
-                        f"Could not find a GCN event on Fritz for {superevent_id}"
-                    )
-                    logger.log(logmessage)
-                    raise MyException(logmessage)
-
-                # submit plan request to Fritz
-                logger.log(f"Submitting plan request for {superevent_id}")
-                queuename = submit_plan(
-                    fritz_token,
-                    allocation,
-                    superevent_id,
-                    gcnevent_id,
-                    localization_id,
-                    mode,
-                )
-
-                # retrieve observation plan for event from Fritz
-                time.sleep(15)
-                end_time = time.time() + 300
-                fritz_event_status = None
-                while fritz_event_status is None and time.time() < end_time:
-                    fritz_event_status = get_plan_stats(
-                        gcnevent_id, queuename, fritz_token, mode
-                    )
-                    time.sleep(30)
-                if fritz_event_status is None:
-                    logmessage = f"Could not find an observing plan for {superevent_id}"
-                    logger.log(logmessage)
-                    raise MyException(logmessage)
-
-                # API call to Kowalski - check for event keywords in ZTF observing queue
-                if not testing:
-                    keyword_list = [dateobs, superevent_id, gcnevent_id]
-                    kowalski_event_status = query_kowalski_ztf_queue(
-                        keyword_list, fritz_token, allocation
-                    )
-                    logger.log(
-                        f"checked ZTF observing queue for key words related to {superevent_id}"
-                    )
-                else:
-                    kowalski_event_status = False
-
-                # have we triggered on the event
-                if fritz_event_status[0] or kowalski_event_status:
-                    previous_trigger = True
-                else:
-                    previous_trigger = False
-
-                # if another group has triggered on the event, we will not trigger
-                if previous_trigger and not triggered:
-                    logmessage = f"Previous trigger for {superevent_id}"
-                    logger.log(logmessage)
-                    raise MyException(logmessage)
-
-                # do the plan stats pass our criteria
-                total_time = fritz_event_status[1]
-                probability = fritz_event_status[2]
-                start_observation = fritz_event_status[3]
-                observation_plan_request_id = fritz_event_status[4]
-
-                if total_time > 5400 or probability < 0.5:
-                    if triggered:
-                        update_trigger_log(
-                            superevent_id, "valid", False, path_data=path_data
-                        )
-                        delete_trigger_ztf(trigger_plan_id, fritz_token, mode)
-                        logger.log(f"attempting to remove trigger for {superevent_id}")
-                    logmessage = f"Followup plan for {superevent_id} with {total_time} seconds and {probability} probability does not meet criteria"
-                    logger.log(logmessage)
-                    raise MyException(logmessage)
-                # don't trigger on events older than 1 day
-                if TimeDelta(Time.now().mjd - mjd, format="jd").value > 1:
-                    logmessage = f"{superevent_id} is more than 1 day old"
-                    logger.log(logmessage)
-                    raise MyException(logmessage)
-
-                # if we have triggered on earlier GCN, can we update trigger with more recent inference
-                if triggered:
-                    if not check_before_sunset():
-                        logmessage = (
-                            f"Too late to update submitted trigger for {superevent_id}"
-                        )
-                        logger.log(logmessage)
-                        raise MyException(logmessage)
-                    else:
-                        # remove current submitted plan so we can submit new one
-                        # TODO: verify that trigger is successfully removed, else raise exception
-                        delete_trigger_ztf(trigger_plan_id, fritz_token, mode)
-                        logmessage = f"Removing previous trigger for {superevent_id} so we can resubmit updated plan"
-                        logger.log(logmessage)
-
-                # check if ZTF survey naturally covered the skymap previous ~3 nights
-                # TODO: require g and r separately
-                frac_observed = SkymapCoverage(
-                    dateobs,
-                    skymap_name,
-                    localprob=0.9,
-                    fritz_token=fritz_token,
-                    fritz_mode=mode,
-                    kowalski_username=kowalskiusername,
-                    kowalski_password=kowalskipassword,
-                ).get_coverage_fraction()
-                if (
-                    frac_observed >= 0.9 * probability
-                ):  # TODO: what percentage do we want here? Either way, make sure it is documented
-                    serendipitious_observation = (
-                        observation_plan_request_id,
-                        start_observation,
-                    )
-                    email_message = f"{superevent_id} is good. Serendipitious coverage {round(frac_observed * 100)} % of {superevent_id} - not triggering"
-                    logger.log(email_message)
-
-                else:
-                    if testing:
-                        logmessage = f"Plan for {superevent_id} is good - but dont trigger in testing mode"
-                        logger.log(logmessage)
-                    else:
-                        # send plan to ZTF queue
-                        time.sleep(30)
-                        trigger_ztf(observation_plan_request_id, fritz_token, mode)
-                        logger.log(f"Triggered ZTF for {superevent_id} at {Time.now()}")
-                    email_message = f"ZTF Triggered for {superevent_id}"
-                    serendipitious_observation = None
-
-                # write to triggered_events.csv
-                trigger_cadence = generate_cadence_dates(dateobs)
-                gcn_type = (alert_type, skymap_name)
-                queued_plan = (observation_plan_request_id, start_observation)
-                valid = True
-                if serendipitious_observation:
-                    queued_plan = None
-                add_triggercsv(
-                    superevent_id,
-                    dateobs,
-                    gcn_type,
-                    gcnevent_id,
-                    localization_id,
-                    trigger_cadence,
-                    queued_plan,
-                    serendipitious_observation,
-                    valid,
-                    path_data,
-                )
-                send_trigger_email(credentials, email_message, dateobs)
-
-                logger.log("post-trigger sleep")
-                time.sleep(
-                    120
-                )  # after triggering pause to avoid double triggers on quickly updated gcn
+pipeline = TriggerPipeline(
+    credentials,
+    fritz_token,
+    allocation,
+    mode,
+    path_data,
+    testing,
+    logger,
+)
 
-            except MyException as e:
-                logger.log(e, slack=False)
-                continue
 
-            finally:
+async def consume():
+    """
+    Hand each Kafka message to the pipeline without waiting for it to finish.
+    Messages are committed in the order they were received, once they and every
+    earlier message have been processed.
+    """
+    in_flight = []
+    while True:
+        try:
+            messages = await asyncio.to_thread(consumer.consume, timeout=1.0)
+            for message in messages:
+                if message.value() is None:
+                    logmessage = "No message received"
+                    logger.log(logmessage, slack=False)
+                    continue
+                task = pipeline.submit(message.value())
+                in_flight.append((task, message))
+            while in_flight and (in_flight[0][0] is None or in_flight[0][0].done()):
+                task, message = in_flight.pop(0)
                 consumer.commit(message)
+        except Exception as e:
+            logger.log(e, slack=False)
+            continue
+
 
-    except Exception as e:
-        logger.log(e, slack=False)
-        continue
+try:
+    asyncio.run(consume())
+finally:
+    get_http_client().log_summary(logger)
@@ -1,9 +1,18 @@
-import pandas as pd
 from astropy.time import Time, TimeDelta
-import requests
-import json
-from .trigger_utils import update_trigger_log, SkymapCoverage
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .trigger_utils import (
+    SkymapCoverage,
+    get_coverage_verifier,
+    submit_plan,
+    get_plan_stats,
+    trigger_ztf,
+    send_trigger_email,
+)
+from .trigger_ledger import get_trigger_ledger
+from .plan_requests import get_plan_requests, MyException as PlanRequestsException
 from utils.log import Logger
+from utils.tracing import get_tracer
 
 # set up logger (this one wont send to slack)
 logger = Logger(filename="cadence_utils")
@@ -13,60 +22,50 @@ class MyException(Exception):
     pass
 
 
-def check_pending_observations(df):
+def check_pending_observations(path_data):
     """
-    Check if we have pending observations
+    Check the pending observations of valid triggers whose start time has passed
     """
     check_pending = []
-
-    for row in df.itertuples(index=False):
-        if row.valid != "True":
-            continue
-        pending = row.pending_observation
-        if pd.isna(pending):
-            continue
-        supereventid = row.superevent_id
-        items = pending.split("),(")
-        items_list = [
-            (int(item.split(",")[0].strip("()")), item.split(",")[1].strip("()"))
-            for item in items
-        ]
-        logmessage = f"Found {len(items_list)} pending observation for {supereventid}"
-        logger.log(logmessage, slack=False)
-        current_date = Time.now()
-        for item in items_list:
-            observation_plan_id, start_observation = item[0], item[1]
-            # if it is before the time for observation, don't do anything yet
-            if current_date < Time(start_observation):
-                logmessage = f"Observation of {supereventid} scheduled for {start_observation} - will check tomorrow"
-                logger.log(logmessage, slack=False)
-                continue
-            # if the current date is within 2 days after start_observation, check if we observed
-            time_difference = abs((current_date - Time(start_observation)).jd)
-            if time_difference <= 2:
-                gcnid = row.gcn_id
-                localizationid = row.localization_id
-                dateobs = row.dateobs
-                logmessage = f"will check status of pending observation for {supereventid} on {start_observation}"
-                logger.log(logmessage, slack=False)
-                format_item = f"({item[0]},{item[1]})"
-                check_pending.append(
-                    [
-                        True,
-                        supereventid,
-                        format_item,
-                        gcnid,
-                        localizationid,
-                        observation_plan_id,
-                        dateobs,
-                        start_observation,
-                    ]
-                )
-            else:
-                # this will make event be moved to unsuccessful observation
-                check_pending.append(
-                    [False, supereventid, pending, None, None, None, None, None]
-                )
+    current_date = Time.now()
+    pending = get_trigger_ledger(path_data).observations(
+        status="pending", started_before=current_date, valid=True
+    )
+    logmessage = f"Found {len(pending)} pending observations that have started"
+    logger.log(logmessage, slack=False)
+    for observation in pending:
+        supereventid = observation["superevent_id"]
+        observation_plan_id = observation["plan_request_id"]
+        start_observation = observation["start_time"]
+        # if the current date is within 2 days after start_observation, check if we observed
+        time_difference = (current_date - Time(start_observation)).jd
+        if time_difference <= 2:
+            logmessage = f"will check status of pending observation for {supereventid} on {start_observation}"
+            logger.log(logmessage, slack=False)
+            check_pending.append(
+                [
+                    True,
+                    supereventid,
+                    observation["gcn_id"],
+                    observation["localization_id"],
+                    observation_plan_id,
+                    observation["dateobs"],
+                    start_observation,
+                ]
+            )
+        else:
+            # this will make the observation be moved to unsuccessful observation
+            check_pending.append(
+                [
+                    False,
+                    supereventid,
+                    None,
+                    None,
+                    observation_plan_id,
+                    None,
+                    start_observation,
+                ]
+            )
     return check_pending
 
 
@@ -76,24 +75,14 @@ def get_plan_prob(gcnevent_id, observation_plan_id, token, mode):
     given the gcn event id and specific plan id, get the probability covered by the plan
     """
     try:
-        headers = {"Authorization": f"token {token}"}
-        endpoint = f"https://{mode}fritz.science/api/gcn_event/{gcnevent_id}/observation_plan_requests"
-        response = requests.request("GET", endpoint, headers=headers)
-        if response.status_code == 200:
-            json_string = response.content.decode("utf-8")
-            json_data = json.loads(json_string)
-
-        if len(json_data["data"]) == 0:
+        listing = get_plan_requests(token, mode).get(gcnevent_id)
+
+        if len(listing) == 0:
             raise MyException(f"No requests found for {gcnevent_id}")
-        generated_plan = [
-            x
-            for x in json_data["data"]
-            if x["observation_plans"][0]["observation_plan_request_id"]
-            == observation_plan_id
-        ]
-        if len(generated_plan) == 0:
+        generated_plan = listing.by_id.get(int(observation_plan_id))
+        if generated_plan is None:
             raise MyException(f"No generated plan for {gcnevent_id}")
-        observation_plans = generated_plan[0]["observation_plans"]
+        observation_plans = generated_plan["observation_plans"]
         if len(observation_plans) == 0:
             raise MyException(f"No observation plans for {gcnevent_id}")
         elif len(observation_plans) > 1:
@@ -110,7 +99,7 @@ def get_plan_prob(gcnevent_id, observation_plan_id, token, mode):
         probability = stats["statistics"]["probability"]
         return probability
 
-    except MyException as e:
+    except (MyException, PlanRequestsException) as e:
         logmessage = f"error: {e}"
         logger.log(logmessage, slack=False)
         return None
@@ -119,96 +108,93 @@ def get_plan_prob(gcnevent_id, observation_plan_id, token, mode):
 def parse_pending_observation(
     path_data, fritz_token, kowalski_username, kowalski_password, mode
 ):
-    # open log of triggers
-    trigger_log = pd.read_csv(
-        f"{path_data}/trigger_data/triggered_events.csv",
-        dtype={"gcn_id": "Int64", "localization_id": "Int64"},
-    )
+    ledger = get_trigger_ledger(path_data)
+    tracer = get_tracer()
     retry = []
-    pending = check_pending_observations(trigger_log)
-    if pending:
-        for x in pending:
-            try:
-                within_time = x[0]
-                superevent_id = x[1]
-                observation_info = x[2]
-                gcnid = x[3]
-                localizationid = x[4]
-                observation_plan_id = x[5]
-                dateobs = x[6]
-                startdate = x[7]
-
-                if not within_time:
-                    # ~2 days post trigger and still unsuccessful - handle manually
-                    update_trigger_log(
-                        superevent_id,
-                        "unsuccessful_observation",
-                        observation_info,
-                        path_data=path_data,
-                        append_string=True,
-                    )
-                    update_trigger_log(
-                        superevent_id,
-                        "pending_observation",
-                        observation_info,
-                        path_data=path_data,
-                        remove_string=True,
-                    )
-                    logmessage = f"We did not sucessfully observe the queued plans for {superevent_id}"
-                    logger.log(logmessage, slack=False)
-                    continue
+    checks = []
+    pending = check_pending_observations(path_data)
+    for x in pending:
+        try:
+            within_time = x[0]
+            superevent_id = x[1]
+            gcnid = x[2]
+            observation_plan_id = x[4]
+            startdate = x[6]
+
+            if not within_time:
+                # ~2 days post trigger and still unsuccessful - handle manually
+                ledger.set_observation(
+                    superevent_id, observation_plan_id, startdate, "unsuccessful"
+                )
+                logmessage = f"We did not sucessfully observe the queued plans for {superevent_id}"
+                logger.log(logmessage, slack=False)
+                continue
 
-                # check if executed observation was successful
+            # check if executed observation was successful
+            with tracer.span("plan probability", superevent_id=superevent_id):
                 fraction_covered_in_plan = get_plan_prob(
-                    localizationid, observation_plan_id, fritz_token, mode
+                    gcnid, observation_plan_id, fritz_token, mode
                 )
-                skymap_name = "bayestar.multiorder.fits,2"  # TODO : find the most recent skymap, make sure this exists?
-                enddate = (Time(startdate) + TimeDelta(3, format="jd")).iso
-                observations = SkymapCoverage(
-                    startdate,
-                    enddate,
-                    dateobs,
+            if fraction_covered_in_plan is None:
+                continue
+            checks.append((x, fraction_covered_in_plan))
+
+        except MyException as e:
+            logmessage = f"error: {e}"
+            logger.log(logmessage, slack=False)
+            continue
+    if not checks:
+        return retry
+
+    # one pass over the exposures for all the pending observations
+    skymap_name = "bayestar.multiorder.fits,2"  # TODO : find the most recent skymap, make sure this exists?
+    verifier = get_coverage_verifier(
+        fritz_token, mode, kowalski_username, kowalski_password, path_data
+    )
+    with tracer.span("coverage check", observations=len(checks)):
+        coverage = verifier.verify(
+            [
+                (
+                    x[1],
+                    x[5],
                     skymap_name,
-                    localprob=0.9,
-                    fritz_token=fritz_token,
-                    kowalski_username=kowalski_username,
-                    kowalski_password=kowalski_password,
+                    x[6],
+                    (Time(x[6]) + TimeDelta(3, format="jd")).iso,
                 )
-                frac_observed = observations.get_coverage_fraction()
-                if (
-                    frac_observed >= 0.8 * fraction_covered_in_plan
-                ):  # TODO: fix coverage function and remove 0.8*
-                    logmessage = f"Observation of {superevent_id} successful"
-                    logger.log(logmessage, slack=False)
-                    update_trigger_log(
-                        superevent_id,
-                        "successful_observation",
-                        observation_info,
-                        path_data=path_data,
-                        append_string=True,
-                    )
-                    update_trigger_log(
-                        superevent_id,
-                        "pending_observation",
-                        observation_info,
-                        path_data=path_data,
-                        remove_string=True,
-                    )
-                elif frac_observed > 0:
-                    logmessage = "Observation partially successful - visually inspect"
-                    logger.log(logmessage, slack=False)
-                    # TODO: build out this case handling
-                else:
-                    retry.append(
-                        ["retry", superevent_id, gcnid, localizationid, dateobs]
-                    )
-                    logmessage = f"Trigger not successful for {superevent_id} - retrying for tonight"
-                    logger.log(logmessage, slack=False)
-
-            except MyException as e:
-                logmessage = f"error: {e}"
-                logger.log(logmessage, slack=False)
-                continue
+                for x, _ in checks
+            ]
+        )
+
+    for (x, fraction_covered_in_plan), fractions in zip(checks, coverage):
+        superevent_id = x[1]
+        gcnid = x[2]
+        localizationid = x[3]
+        observation_plan_id = x[4]
+        dateobs = x[5]
+        startdate = x[6]
+        if fractions is None:
+            continue
+        frac_observed = SkymapCoverage.covered_fraction(fractions)
+        if (
+            frac_observed >= 0.8 * fraction_covered_in_plan
+        ):  # TODO: fix coverage function and remove 0.8*
+            logmessage = f"Observation of {superevent_id} successful"
+            logger.log(logmessage, slack=False)
+            ledger.set_observation(
+                superevent_id, observation_plan_id, startdate, "successful"
+            )
+        elif frac_observed > 0:
+            logmessage = "Observation partially successful - visually inspect"
+            logger.log(logmessage, slack=False)
+            ledger.mark_checked(superevent_id, observation_plan_id)
+            # TODO: build out this case handling
+        else:
+            ledger.mark_checked(superevent_id, observation_plan_id)
+            retry.append(["retry", superevent_id, gcnid, localizationid, dateobs])
+            logmessage = (
+                f"Trigger not successful for {superevent_id} - retrying for tonight"
+            )
+            logger.log(logmessage, slack=False)
     return retry
 
 
@@ -217,31 +203,247 @@ def trigger_on_cadence(path_data):
     Follow-up triggers based on trigger_cadence
     times in UTC time
     """
-
-    df = pd.read_csv(
-        f"{path_data}/trigger_data/triggered_events.csv",
-        dtype={"gcn_id": "Int64", "localization_id": "Int64"},
-    )
-    df["gcn_id"] = df["gcn_id"].astype("int", errors="ignore")
-    df["localization_id"] = df["localization_id"].astype("int", errors="ignore")
     trigger = []
-    for row in df.itertuples(index=False):
-        if row.valid != True:
-            continue
-        cadence_str = row.trigger_cadence
-        cadence = cadence_str.strip("[]").replace("'", "").split(", ")
-        current_date = Time.now().strftime("%Y-%m-%d")
-        for cadence_date in cadence:
-            if Time(current_date) == Time(cadence_date):
-                supereventid = row.superevent_id
-                gcnid = row.gcn_id
-                localizationid = row.localization_id
-                dateobs = row.dateobs
-                trigger.append(
-                    ["followup", supereventid, gcnid, localizationid, dateobs]
+    current_date = Time.now().strftime("%Y-%m-%d")
+    for followup in get_trigger_ledger(path_data).due(current_date):
+        supereventid = followup["superevent_id"]
+        trigger.append(
+            [
+                "followup",
+                supereventid,
+                followup["gcn_id"],
+                followup["localization_id"],
+                followup["dateobs"],
+            ]
+        )
+        logmessage = f"Found follow-up trigger: {supereventid} on {followup['date']}"
+        logger.log(logmessage, slack=False)
+    return trigger
+
+
+def upcoming_followups(path_data, days=7):
+    """
+    Superevents with a follow-up trigger on each date of the next days days, from the
+    cadence calendar - e.g. to plan the use of our ZTF allocation
+    """
+    start = Time.now()
+    end = start + TimeDelta(days, format="jd")
+    calendar = {}
+    for followup in get_trigger_ledger(path_data).due(
+        start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+    ):
+        calendar.setdefault(followup["date"], []).append(followup["superevent_id"])
+    return calendar
+
+
+class CadenceTriggers:
+    """
+    Send tonight's follow-up and retry triggers concurrently.
+
+    Plan requests for every event are submitted up front from a bounded pool of worker
+    threads. One poller then checks all the pending requests every poll_interval s, and
+    each plan that meets the criteria is triggered as soon as it is ready, rather than
+    after every event before it in the list has been handled.
+    """
+
+    def __init__(
+        self,
+        credentials,
+        fritz_token,
+        allocation,
+        mode,
+        path_data,
+        testing,
+        logger,
+        max_workers=4,
+        poll_interval=30,
+        timeout=300,
+        trigger_delay=30,
+    ):
+        self.credentials = credentials
+        self.fritz_token = fritz_token
+        self.allocation = allocation
+        self.mode = mode
+        self.path_data = path_data
+        self.testing = testing
+        self.logger = logger
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.trigger_delay = trigger_delay
+        self.tracer = get_tracer()
+
+    def run(self, new_triggers):
+        """
+        Handle each [retrigger_type, superevent_id, gcnevent_id, localization_id, dateobs]
+        """
+        with (
+            ThreadPoolExecutor(self.max_workers, thread_name_prefix="fritz") as fritz,
+            ThreadPoolExecutor(self.max_workers, thread_name_prefix="ztf") as ztf,
+        ):
+            requests = [r for r in fritz.map(self.submit, new_triggers) if r]
+            triggers = self.poll(requests, fritz, ztf)
+            for trigger in triggers:
+                trigger.result()
+
+    def submit(self, x):
+        """
+        Request a plan from Fritz, returning what we need to follow it up (None on failure)
+        """
+        retrigger_type, superevent_id, gcnevent_id, localization_id, dateobs = x[:5]
+        with self.tracer.span(
+            "plan generation",
+            superevent_id=superevent_id,
+            retrigger_type=retrigger_type,
+        ) as span:
+            try:
+                gcnevent_id, localization_id = int(gcnevent_id), int(localization_id)
+                self.logger.log(f"Submitting plan request for {superevent_id}")
+                queuename = submit_plan(
+                    self.fritz_token,
+                    self.allocation,
+                    superevent_id,
+                    gcnevent_id,
+                    localization_id,
+                    self.mode,
+                    self.path_data,
                 )
-                logmessage = (
-                    f"Found follow-up trigger: {supereventid} on {cadence_date}"
+            except Exception as e:
+                span.set(outcome=f"error: {e}")
+                self.logger.log(
+                    f"Could not submit a plan request for {superevent_id}: {e}"
                 )
-                logger.log(logmessage, slack=False)
-    return trigger
+                return None
+        submitted = time.time()
+        return {
+            "retrigger_type": retrigger_type,
+            "superevent_id": superevent_id,
+            "gcnevent_id": gcnevent_id,
+            "dateobs": dateobs,
+            "queuename": queuename,
+            "submitted": submitted,
+            "deadline": submitted + self.timeout,
+        }
+
+    def get_stats(self, request):
+        """
+        One poll of Fritz for the plan, None if it isn't ready (or the poll failed). The
+        span records whether the plan was found, is still awaited or timed out, and how
+        long since the plan was requested.
+        """
+        superevent_id = request["superevent_id"]
+        with self.tracer.span("plan stats", superevent_id=superevent_id) as span:
+            try:
+                stats = get_plan_stats(
+                    request["gcnevent_id"],
+                    request["queuename"],
+                    self.fritz_token,
+                    self.mode,
+                )
+            except Exception as e:
+                logmessage = f"Error getting plan stats for {superevent_id}: {e}"
+                self.logger.log(logmessage, slack=False)
+                stats = None
+            now = time.time()
+            request["timed_out"] = stats is None and now >= request["deadline"]
+            if stats is not None:
+                outcome = "found"
+            elif request["timed_out"]:
+                outcome = "timed out"
+            else:
+                outcome = "waiting"
+            span.set(outcome=outcome, waited=round(now - request["submitted"], 1))
+        return stats
+
+    def poll(self, requests, fritz, ztf):
+        """
+        Poll Fritz for every pending plan request together, starting the trigger of each
+        plan that passes as soon as it is found. Returns the trigger futures.
+        """
+        triggers = []
+        pending = list(requests)
+        if pending:
+            time.sleep(15)
+        while pending:
+            waiting = []
+            for request, stats in zip(pending, fritz.map(self.get_stats, pending)):
+                superevent_id = request["superevent_id"]
+                if stats is None:
+                    if not request["timed_out"]:
+                        waiting.append(request)
+                    else:
+                        logmessage = (
+                            f"Could not find an observing plan for {superevent_id}"
+                        )
+                        self.logger.log(logmessage)
+                    continue
+                try:
+                    if self.passes(request, stats):
+                        triggers.append(ztf.submit(self.trigger, request, stats))
+                except Exception as e:
+                    self.logger.log(f"Error checking the plan for {superevent_id}: {e}")
+            pending = waiting
+            if pending:
+                time.sleep(self.poll_interval)
+        return triggers
+
+    def passes(self, request, stats):
+        """
+        Whether the plan meets the criteria, recording it as unsuccessful if it doesn't
+        """
+        superevent_id = request["superevent_id"]
+        total_time, probability, start_observation, observation_plan_request_id = stats[
+            1:5
+        ]
+        if total_time > 5400 or probability < 0.5:
+            get_trigger_ledger(self.path_data).set_observation(
+                superevent_id,
+                observation_plan_request_id,
+                start_observation,
+                "unsuccessful",
+            )
+            message = f"Followup plan for {superevent_id} with {total_time} seconds and {probability} probability does not meet criteria"
+            self.logger.log(message)
+            return False
+        self.logger.log(
+            f"Plan for {superevent_id} has {total_time} seconds and {probability} probability - should trigger ZTF"
+        )
+        if self.testing:
+            message = f"Testing mode, not actually triggering ZTF for {superevent_id}"
+            self.logger.log(message)
+            return False
+        return True
+
+    def trigger(self, request, stats):
+        """
+        Send the plan to the ZTF queue, record it as pending, and email
+        """
+        superevent_id = request["superevent_id"]
+        start_observation, observation_plan_request_id = stats[3], stats[4]
+        try:
+            self.logger.log(
+                f"Triggering ZTF for {superevent_id} in {self.trigger_delay} seconds"
+            )
+            time.sleep(self.trigger_delay)
+            with self.tracer.span("trigger submission", superevent_id=superevent_id):
+                trigger_ztf(observation_plan_request_id, self.fritz_token, self.mode)
+            get_trigger_ledger(self.path_data).set_observation(
+                superevent_id,
+                observation_plan_request_id,
+                start_observation,
+                "pending",
+            )
+            if request["retrigger_type"] == "followup":
+                message = f"ZTF Triggered for a scheduled follow-up observation of {superevent_id}"
+            else:
+                message = f"Sending another trigger for tonight after unsuccessful observation of {superevent_id}"
+            with self.tracer.span("email", superevent_id=superevent_id):
+                send_trigger_email(
+                    self.credentials,
+                    message,
+                    request["dateobs"],
+                    path_data=self.path_data,
+                )
+            self.logger.log(f"sent email: {message}")
+        except Exception as e:
+            self.logger.log(f"Error triggering ZTF for {superevent_id}: {e}")
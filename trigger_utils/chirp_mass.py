@@ -0,0 +1,151 @@
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ligo.gracedb.rest import GraceDb
+
+from utils.log import Logger
+
+# set up logger (this one wont send to slack)
+logger = Logger(filename="chirp_mass")
+
+
+class ChirpMassDistribution:
+    """
+    Source frame chirp mass bins and their probabilities, from a GraceDB mchirp_source file
+    """
+
+    def __init__(self, bin_edges, probabilities, filename=None):
+        self.bin_edges = bin_edges
+        self.probabilities = probabilities
+        self.filename = filename
+
+    @classmethod
+    def from_json(cls, payload, filename=None):
+        data = json.loads(payload)
+        return cls(data["bin_edges"], data["probabilities"], filename)
+
+    @property
+    def bins(self):
+        """
+        (left, right) edges of each bin
+        """
+        return list(zip(self.bin_edges[:-1], self.bin_edges[1:]))
+
+    def most_probable_bin(self):
+        """
+        Left edge of the most probable bin, which is what we cut on
+        """
+        max_index = self.probabilities.index(max(self.probabilities))
+        return self.bin_edges[max_index]
+
+    def slack_bins(self, min_probability=0.01):
+        """
+        Bins and probabilities worth reporting, leaving out unlikely bins
+        """
+        keep = [
+            (b, p)
+            for b, p in zip(self.bins, self.probabilities)
+            if p >= min_probability
+        ]
+        return [b for b, _ in keep], [p for _, p in keep]
+
+
+class ChirpMassPoller:
+    """
+    Poll GraceDB superevents for their chirp mass file.
+
+    One GraceDb client is reused for every poll. We keep the file list last seen for each
+    superevent and only download when a new mchirp_source file shows up, otherwise the
+    distribution we already have (or None) is returned. The file is parsed in memory and
+    written to {path_data}/mchirp in the background for the record. Polls run in worker
+    threads (the trigger's prewarm and alert lookups can overlap), so the seen files and
+    distributions are only touched under the lock.
+    """
+
+    def __init__(self, path_data="data", service_url="https://gracedb.ligo.org/api/"):
+        self.output_dir = os.path.join(path_data, "mchirp")
+        self.service_url = service_url
+        self.client = None
+        self.lock = threading.Lock()
+        self.seen_files = {}
+        self.distributions = {}
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mchirp")
+
+    def get_client(self):
+        with self.lock:
+            if self.client is None:
+                self.client = GraceDb(service_url=self.service_url)
+            return self.client
+
+    def poll(self, event):
+        """
+        Chirp mass distribution for the superevent, or None if GraceDB doesn't have one yet
+        """
+        client = self.get_client()
+        files = set(client.files(event).json())
+        with self.lock:
+            seen_files = self.seen_files.get(event, set())
+            distribution = self.distributions.get(event)
+        # versions are listed as mchirp_source.json,N alongside mchirp_source.json for the latest
+        new_files = [f for f in files - seen_files if "mchirp_source" in f]
+        if not new_files:
+            with self.lock:
+                self.seen_files[event] = files
+            if distribution is None:
+                logmessage = (
+                    f"Did not find chirp mass file on Gracedb event page for {event}"
+                )
+                logger.log(logmessage, slack=False)
+            return distribution
+
+        latest = [f for f in files if "mchirp_source" in f and f.endswith(".json")]
+        if not latest:
+            with self.lock:
+                self.seen_files[event] = files
+            return distribution
+        fname = sorted(latest)[0]
+        logmessage = f"Found: {fname}"
+        logger.log(logmessage, slack=False)
+        content = client.files(event, fname).read()
+        distribution = ChirpMassDistribution.from_json(content, fname)
+        # only mark the files seen once we have them, so a failed download is retried
+        with self.lock:
+            self.seen_files[event] = files
+            self.distributions[event] = distribution
+        self.writer.submit(self.write, event, content)
+        return distribution
+
+    def write(self, event, content):
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            output_path = os.path.join(self.output_dir, f"mchirp_source_{event}.json")
+            with open(output_path, "wb") as f:
+                f.write(content)
+        except OSError as e:
+            logmessage = f"Could not save chirp mass file for {event}: {e}"
+            logger.log(logmessage, slack=False)
+
+    def forget(self, event):
+        with self.lock:
+            self.seen_files.pop(event, None)
+            self.distributions.pop(event, None)
+
+
+chirp_mass_pollers = {}
+
+
+def get_chirp_mass_poller(path_data="data"):
+    """
+    One poller per data directory per process
+    """
+    if path_data not in chirp_mass_pollers:
+        chirp_mass_pollers[path_data] = ChirpMassPoller(path_data)
+    return chirp_mass_pollers[path_data]
+
+
+def query_chirp_mass(event, path_data="data"):
+    """
+    Chirp mass distribution for a superevent from GraceDB, or None if there isn't one yet
+    """
+    return get_chirp_mass_poller(path_data).poll(event)
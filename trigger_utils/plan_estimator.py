@@ -0,0 +1,118 @@
+import numpy as np
+
+from utils.log import Logger
+from utils.ephemeris import get_night_ephemeris, PALOMAR
+from trigger_utils.ztf_coverage import get_ztf_field_grid
+
+# set up logger (this one wont send to slack)
+logger = Logger(filename="plan_estimator")
+
+# seconds of readout and slew added to each exposure when filling the night
+OVERHEAD = 15
+
+# minutes between the times we check which fields are up
+TIME_STEP = 10
+
+
+def get_sidereal_time(jd):
+    """
+    Local mean sidereal time (deg) at Palomar at each UTC julian date
+    """
+    # good to well under a minute, which is plenty for an airmass cut
+    lst = 280.46061837 + 360.98564736629 * (np.asarray(jd) - 2451545.0)
+    return (lst + PALOMAR["lon"]) % 360
+
+
+def get_altitudes(ra, dec, jd):
+    """
+    Altitude (deg) at Palomar of each (ra, dec) in deg at each UTC julian date, shape (fields, times)
+    """
+    lst = get_sidereal_time(jd)
+    hour_angle = np.radians(lst[None, :] - np.asarray(ra)[:, None])
+    lat = np.radians(PALOMAR["lat"])
+    dec = np.radians(np.asarray(dec))[:, None]
+    sin_alt = np.sin(lat) * np.sin(dec) + np.cos(lat) * np.cos(dec) * np.cos(hour_angle)
+    return np.degrees(np.arcsin(sin_alt))
+
+
+def get_night_window(path_data="data", jd=None):
+    """
+    Start and end (UTC julian dates) of the dark time we can observe in - the rest of
+    tonight if it is already dark, else the coming night
+    """
+    ephemeris = get_night_ephemeris(path_data)
+    now = ephemeris.to_jd() if jd is None else jd
+    evening = ephemeris.next_event_jd("evening_twilight", now)
+    morning = ephemeris.next_event_jd("morning_twilight", now)
+    if morning < evening:
+        return now, morning
+    return evening, ephemeris.next_event_jd("morning_twilight", evening)
+
+
+def estimate_plan(
+    skymap,
+    path_data="data",
+    jd=None,
+    exposure_time=30,
+    num_filters=2,
+    maximum_airmass=2,
+    integrated_probability=0.9,
+):
+    """
+    Rough version of the Fritz greedy tiling plan for a multiorder skymap: primary grid
+    fields in the integrated_probability credible region that are above maximum_airmass
+    at some point tonight, taken most probable first while the night has time for them.
+    Returns a dict with the total_time (s) and probability of the plan, like the Fritz
+    plan statistics, and the planned field ids.
+    """
+    grid = get_ztf_field_grid(path_data)
+    coverage = grid.get_field_coverage(skymap, integrated_probability)
+    field_ids = np.array(list(coverage.field_prob))
+    field_prob = np.array(list(coverage.field_prob.values()))
+    rows = np.searchsorted(grid.field_id, field_ids)
+
+    start, end = get_night_window(path_data, jd)
+    times = np.arange(start, end, TIME_STEP / 1440)
+    # airmass ~ 1 / sin(altitude)
+    min_altitude = np.degrees(np.arcsin(1 / maximum_airmass))
+    altitudes = get_altitudes(grid.ra[rows], grid.dec[rows], times)
+    time_up = (altitudes > min_altitude).sum(axis=1) * TIME_STEP * 60
+
+    time_per_field = num_filters * (exposure_time + OVERHEAD)
+    available = (end - start) * 86400
+    planned = []
+    probability = 0.0
+    for i in np.argsort(field_prob)[::-1]:
+        if time_up[i] < time_per_field or available < time_per_field:
+            continue
+        planned.append(int(field_ids[i]))
+        probability += field_prob[i]
+        available -= time_per_field
+    total_time = len(planned) * num_filters * exposure_time
+    logmessage = f"estimated plan of {len(planned)} fields, {total_time} s and {probability:.2f} probability"
+    logger.log(logmessage, slack=False)
+    return {
+        "total_time": total_time,
+        "probability": float(probability),
+        "fields": planned,
+        "start": start,
+        "end": end,
+    }
+
+
+def screen_plan(estimate, max_time=5400, min_probability=0.5, margin=0.2):
+    """
+    "fail" if the estimate is clearly outside the plan criteria, "pass" if clearly inside,
+    and "unsure" if within margin of a cut and we need the real plan from Fritz to decide
+    """
+    total_time = estimate["total_time"]
+    probability = estimate["probability"]
+    if total_time > max_time * (1 + margin) or probability < min_probability * (
+        1 - margin
+    ):
+        return "fail"
+    if total_time < max_time * (1 - margin) and probability > min_probability * (
+        1 + margin
+    ):
+        return "pass"
+    return "unsure"
@@ -0,0 +1,128 @@
+import json
+import time
+import threading
+from concurrent.futures import Future
+
+from utils.log import Logger
+from utils.http_client import get_http_client
+
+# set up logger (this one wont send to slack)
+logger = Logger(filename="plan_requests")
+
+
+class MyException(Exception):
+    pass
+
+
+class PlanRequestListing:
+    """
+    The observation plan requests of one gcn event, indexed by queue name and by id
+    """
+
+    def __init__(self, gcnevent_id, requests, fetched):
+        self.gcnevent_id = gcnevent_id
+        self.requests = requests
+        self.fetched = fetched
+        self.by_queue_name = {}
+        self.by_id = {}
+        for request in requests:
+            # keep the first request with a queue name, as the list scans did
+            self.by_queue_name.setdefault(request["payload"]["queue_name"], request)
+            self.by_id[int(request["id"])] = request
+        self.submitted = any(
+            request["status"] == "submitted to telescope queue" for request in requests
+        )
+
+    def __len__(self):
+        return len(self.requests)
+
+
+class PlanRequests:
+    """
+    Fritz observation plan requests of each gcn event, cached for ttl seconds.
+
+    Every plan being polled for an event (the alerts of a superevent in the trigger, or the
+    retrigger and cadence plans in cadence) reads the same listing, so each event costs
+    one request per ttl however many plans are waiting on it. A caller that finds the
+    listing being fetched waits for that request instead of sending its own.
+    """
+
+    def __init__(self, token, mode, ttl=10):
+        self.token = token
+        self.mode = mode
+        self.ttl = ttl
+        self.listings = {}  # gcnevent_id -> PlanRequestListing
+        self.fetching = {}  # gcnevent_id -> Future of the request in flight
+        self.lock = threading.Lock()
+
+    def fetch(self, gcnevent_id):
+        headers = {"Authorization": f"token {self.token}"}
+        endpoint = f"https://{self.mode}fritz.science/api/gcn_event/{gcnevent_id}/observation_plan_requests"
+        fetched = time.monotonic()
+        response = get_http_client().request("GET", endpoint, headers=headers)
+        if response.status_code != 200:
+            raise MyException(
+                f"Could not get plan requests for {gcnevent_id} - {response.status_code} - {response.text}"
+            )
+        json_data = json.loads(response.content.decode("utf-8"))
+        return PlanRequestListing(gcnevent_id, json_data["data"], fetched)
+
+    def get(self, gcnevent_id):
+        """
+        Listing of the plan requests for gcnevent_id, fetched if the cached one is older than ttl
+        """
+        with self.lock:
+            listing = self.listings.get(gcnevent_id)
+            if listing is not None and time.monotonic() - listing.fetched < self.ttl:
+                return listing
+            future = self.fetching.get(gcnevent_id)
+            if future is None:
+                future = Future()
+                self.fetching[gcnevent_id] = future
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return future.result()
+        try:
+            listing = self.fetch(gcnevent_id)
+        except BaseException as e:
+            with self.lock:
+                del self.fetching[gcnevent_id]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.fetching[gcnevent_id]
+            # listings past their ttl would be fetched again anyway, so drop them
+            now = time.monotonic()
+            for key in [
+                key for key, x in self.listings.items() if now - x.fetched >= self.ttl
+            ]:
+                del self.listings[key]
+            self.listings[gcnevent_id] = listing
+        future.set_result(listing)
+        return listing
+
+    def invalidate(self, gcnevent_id=None):
+        """
+        Fetch the listing again on the next get, e.g. after submitting a plan. Without
+        gcnevent_id every listing is dropped, e.g. after a plan's status changes.
+        """
+        with self.lock:
+            if gcnevent_id is None:
+                self.listings.clear()
+            else:
+                self.listings.pop(gcnevent_id, None)
+
+
+plan_requests = {}
+
+
+def get_plan_requests(token, mode):
+    """
+    One plan request cache per Fritz instance and token per process
+    """
+    key = (mode, token)
+    if key not in plan_requests:
+        plan_requests[key] = PlanRequests(token, mode)
+    return plan_requests[key]
@@ -0,0 +1,399 @@
+import os
+import re
+import json
+import sqlite3
+import threading
+import pandas as pd
+from astropy.time import Time
+
+from utils.log import Logger
+
+# set up logger (this one wont send to slack)
+logger = Logger(filename="trigger_ledger")
+
+
+class MyException(Exception):
+    pass
+
+
+# column name -> sqlite type, for the columns of triggered_events.csv kept with the event
+COLUMNS = {
+    "superevent_id": "TEXT PRIMARY KEY",
+    "dateobs": "TEXT",
+    "gcn_type": "TEXT",
+    "gcn_id": "INTEGER",
+    "localization_id": "INTEGER",
+    "trigger_cadence": "TEXT",
+    "valid": "INTEGER",
+}
+
+# the observation columns of triggered_events.csv, and the status each one holds
+OBSERVATION_COLUMNS = {
+    "pending_observation": "pending",
+    "unsuccessful_observation": "unsuccessful",
+    "successful_observation": "successful",
+    "serendipitous_observation": "serendipitous",
+}
+
+# removed: the plan was taken out of the ZTF queue to make way for a newer trigger
+STATUSES = list(OBSERVATION_COLUMNS.values()) + ["removed"]
+
+CSV_COLUMNS = list(COLUMNS)[:-1] + list(OBSERVATION_COLUMNS) + ["valid"]
+
+
+def parse_observations(value):
+    """
+    List of (observation_plan_request_id, start_observation) from an observation string
+    like "(123,2025-01-01T03:00:00),(456, '2025-01-02T03:00:00')" or a single tuple
+    """
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return []
+    if isinstance(value, tuple):
+        return [(int(value[0]), str(value[1]))]
+    return [
+        (int(plan_id), start.strip())
+        for plan_id, start in re.findall(r"\(\s*(\d+)\s*,\s*'?([^)']*)'?\s*\)", value)
+    ]
+
+
+def format_observations(observations):
+    """
+    Inverse of parse_observations, or None if there are no observations
+    """
+    if not observations:
+        return None
+    return ",".join(f"({plan_id},{start})" for plan_id, start in observations)
+
+
+class TriggerLedger:
+    """
+    Record of every event we triggered on, one row per superevent, kept in SQLite.
+
+    Each plan sent to ZTF for an event is a row of the observations table holding its
+    plan request id, start time, status and when the status was last checked, so moving
+    an observation from pending to successful is a single update and the observations
+    due to be checked come from one indexed query. The csv is still written by export_csv
+    for people to read, and is imported the first time the ledger is opened.
+
+    The follow-up dates of each event's trigger_cadence are also kept in a calendar table
+    keyed by date, so the follow-ups due on a day, or over the coming week, are one query.
+    """
+
+    def __init__(self, path_data="data"):
+        self.path = f"{path_data}/trigger_data/triggered_events.db"
+        self.csv_path = f"{path_data}/trigger_data/triggered_events.csv"
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        new = not os.path.exists(self.path)
+        # the trigger and cadence containers can write at the same time - sqlite locks for us
+        self.connection = sqlite3.connect(
+            self.path, timeout=30, check_same_thread=False
+        )
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            columns = ", ".join(f"{name} {kind}" for name, kind in COLUMNS.items())
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS triggered_events ({columns})"
+            )
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS observations (
+                    superevent_id TEXT NOT NULL REFERENCES triggered_events(superevent_id),
+                    plan_request_id INTEGER NOT NULL,
+                    start_time TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    checked_at TEXT,
+                    UNIQUE (superevent_id, plan_request_id)
+                )
+                """
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS observations_status_start ON observations (status, start_time)"
+            )
+            new_calendar = not self.connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'cadence_calendar'"
+            ).fetchone()
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cadence_calendar (
+                    date TEXT NOT NULL,
+                    superevent_id TEXT NOT NULL REFERENCES triggered_events(superevent_id),
+                    PRIMARY KEY (date, superevent_id)
+                ) WITHOUT ROWID
+                """
+            )
+            if new_calendar:
+                # ledgers made before the calendar existed
+                for record in self.connection.execute(
+                    "SELECT superevent_id, trigger_cadence FROM triggered_events"
+                ).fetchall():
+                    self.set_cadence(
+                        record["superevent_id"],
+                        json.loads(record["trigger_cadence"] or "[]"),
+                    )
+        if new and os.path.exists(self.csv_path):
+            self.import_csv(self.csv_path)
+
+    def import_csv(self, csv_path):
+        """
+        Load rows from a triggered_events.csv. A superevent appearing twice keeps its last row.
+        """
+        df = pd.read_csv(
+            csv_path, dtype={"gcn_id": "Int64", "localization_id": "Int64"}
+        )
+        for row in df.to_dict("records"):
+            row = {k: (None if pd.isna(v) else v) for k, v in row.items()}
+            cadence = row["trigger_cadence"] or ""
+            row["trigger_cadence"] = [
+                x for x in cadence.strip("[]").replace("'", "").split(", ") if x
+            ]
+            row["valid"] = str(row["valid"]) == "True"
+            self.add(**row)
+        logmessage = f"imported {len(df)} rows from {csv_path} into {self.path}"
+        logger.log(logmessage, slack=False)
+
+    @staticmethod
+    def to_row(record):
+        row = dict(record)
+        row["trigger_cadence"] = json.loads(row["trigger_cadence"] or "[]")
+        row["valid"] = bool(row["valid"])
+        return row
+
+    def get(self, superevent_id):
+        """
+        The row for superevent_id as a dict, or None if we haven't triggered on it
+        """
+        with self.lock:
+            record = self.connection.execute(
+                "SELECT * FROM triggered_events WHERE superevent_id = ?",
+                (superevent_id,),
+            ).fetchone()
+        return self.to_row(record) if record else None
+
+    def rows(self, valid=None):
+        """
+        All rows, or only those with valid == valid
+        """
+        query = "SELECT * FROM triggered_events"
+        args = ()
+        if valid is not None:
+            query += " WHERE valid = ?"
+            args = (int(valid),)
+        with self.lock:
+            records = self.connection.execute(query, args).fetchall()
+        return [self.to_row(record) for record in records]
+
+    def add(
+        self,
+        superevent_id,
+        dateobs,
+        gcn_type,
+        gcn_id,
+        localization_id,
+        trigger_cadence,
+        pending_observation,
+        unsuccessful_observation=None,
+        successful_observation=None,
+        serendipitous_observation=None,
+        valid=True,
+    ):
+        """
+        Add a trigger, replacing any earlier trigger for the same superevent. Plans of the
+        earlier trigger still pending are marked removed, the rest of its history is kept.
+        """
+        row = (
+            superevent_id,
+            dateobs,
+            str(gcn_type),
+            None if gcn_id is None else int(gcn_id),
+            None if localization_id is None else int(localization_id),
+            json.dumps(list(trigger_cadence or [])),
+            int(bool(valid)),
+        )
+        observations = {
+            "pending": pending_observation,
+            "unsuccessful": unsuccessful_observation,
+            "successful": successful_observation,
+            "serendipitous": serendipitous_observation,
+        }
+        with self.lock, self.connection:
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO triggered_events VALUES ({', '.join('?' * len(COLUMNS))})",
+                row,
+            )
+            self.connection.execute(
+                "UPDATE observations SET status = 'removed', checked_at = ? WHERE superevent_id = ? AND status = 'pending'",
+                (Time.now().isot, superevent_id),
+            )
+            for status, value in observations.items():
+                for plan_request_id, start_time in parse_observations(value):
+                    self.upsert_observation(
+                        superevent_id, plan_request_id, start_time, status
+                    )
+            self.set_cadence(superevent_id, trigger_cadence or [])
+
+    def update(self, superevent_id, column, value):
+        """
+        Set one column for superevent_id - does nothing if the superevent isn't in the ledger
+        """
+        if column not in COLUMNS or column == "superevent_id":
+            raise MyException(f"Can't update column {column} of the trigger ledger")
+        if column == "valid":
+            value = int(bool(value))
+        elif column == "trigger_cadence":
+            value = json.dumps(list(value))
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                f"UPDATE triggered_events SET {column} = ? WHERE superevent_id = ?",
+                (value, superevent_id),
+            )
+            if column == "trigger_cadence" and cursor.rowcount:
+                self.set_cadence(superevent_id, json.loads(value))
+
+    def set_cadence(self, superevent_id, trigger_cadence):
+        # replace the calendar entries of superevent_id with its trigger_cadence dates
+        self.connection.execute(
+            "DELETE FROM cadence_calendar WHERE superevent_id = ?", (superevent_id,)
+        )
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO cadence_calendar VALUES (?, ?)",
+            [(str(date)[:10], superevent_id) for date in trigger_cadence],
+        )
+
+    def due(self, start, end=None, valid=True):
+        """
+        Follow-ups in the cadence calendar from start to end (inclusive, "YYYY-MM-DD"), or
+        only on start if end is None, date order, with the gcn_id, localization_id and
+        dateobs of their event. By default only events whose trigger is still valid.
+        """
+        query = """
+            SELECT c.date, c.superevent_id, t.gcn_id, t.localization_id, t.dateobs
+            FROM cadence_calendar c JOIN triggered_events t USING (superevent_id)
+            WHERE c.date BETWEEN ? AND ?
+        """
+        args = [str(start)[:10], str(end or start)[:10]]
+        if valid is not None:
+            query += " AND t.valid = ?"
+            args.append(int(valid))
+        query += " ORDER BY c.date, c.superevent_id"
+        with self.lock:
+            records = self.connection.execute(query, args).fetchall()
+        return [dict(record) for record in records]
+
+    def upsert_observation(
+        self, superevent_id, plan_request_id, start_time, status, checked_at=None
+    ):
+        # start times are stored as isot so they sort and compare as strings
+        self.connection.execute(
+            """
+            INSERT INTO observations VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (superevent_id, plan_request_id)
+            DO UPDATE SET status = excluded.status, checked_at = excluded.checked_at
+            """,
+            (
+                superevent_id,
+                int(plan_request_id),
+                Time(start_time).isot,
+                status,
+                checked_at,
+            ),
+        )
+
+    def set_observation(self, superevent_id, plan_request_id, start_time, status):
+        """
+        Record a plan for superevent_id with the given status, or move an existing one to that status
+        """
+        if status not in STATUSES:
+            raise MyException(f"Unknown observation status {status}")
+        with self.lock, self.connection:
+            if not self.connection.execute(
+                "SELECT 1 FROM triggered_events WHERE superevent_id = ?",
+                (superevent_id,),
+            ).fetchone():
+                raise MyException(f"{superevent_id} is not in the trigger ledger")
+            self.upsert_observation(
+                superevent_id, plan_request_id, start_time, status, Time.now().isot
+            )
+
+    def mark_checked(self, superevent_id, plan_request_id):
+        """
+        Note that we checked an observation without changing its status
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE observations SET checked_at = ? WHERE superevent_id = ? AND plan_request_id = ?",
+                (Time.now().isot, superevent_id, int(plan_request_id)),
+            )
+
+    def observations(
+        self, superevent_id=None, status=None, started_before=None, valid=None
+    ):
+        """
+        Observations, oldest start time first, with the gcn_id, localization_id and dateobs
+        of their event. Filter by superevent, status, start time before a time, and whether
+        the event is valid.
+        """
+        conditions = []
+        args = []
+        if superevent_id is not None:
+            conditions.append("o.superevent_id = ?")
+            args.append(superevent_id)
+        if status is not None:
+            conditions.append("o.status = ?")
+            args.append(status)
+        if started_before is not None:
+            conditions.append("o.start_time <= ?")
+            args.append(Time(started_before).isot)
+        if valid is not None:
+            conditions.append("t.valid = ?")
+            args.append(int(valid))
+        query = """
+            SELECT o.*, t.gcn_id, t.localization_id, t.dateobs
+            FROM observations o JOIN triggered_events t USING (superevent_id)
+        """
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY o.start_time, o.rowid"
+        with self.lock:
+            records = self.connection.execute(query, args).fetchall()
+        return [dict(record) for record in records]
+
+    def export_csv(self, csv_path=None):
+        """
+        Write the ledger out as triggered_events.csv, in the same format as before
+        """
+        csv_path = csv_path or self.csv_path
+        rows = {row["superevent_id"]: row for row in self.rows()}
+        for row in rows.values():
+            row["trigger_cadence"] = str(row["trigger_cadence"])
+            for column in OBSERVATION_COLUMNS:
+                row[column] = []
+        statuses = {status: column for column, status in OBSERVATION_COLUMNS.items()}
+        for observation in self.observations():
+            column = statuses.get(observation["status"])
+            if column:
+                rows[observation["superevent_id"]][column].append(
+                    (observation["plan_request_id"], observation["start_time"])
+                )
+        for row in rows.values():
+            for column in OBSERVATION_COLUMNS:
+                row[column] = format_observations(row[column])
+        df = pd.DataFrame(list(rows.values()), columns=CSV_COLUMNS)
+        df["gcn_id"] = df["gcn_id"].astype("Int64")
+        df["localization_id"] = df["localization_id"].astype("Int64")
+        tmp_path = f"{csv_path}.{os.getpid()}.tmp"
+        df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, csv_path)
+
+
+trigger_ledgers = {}
+
+
+def get_trigger_ledger(path_data="data"):
+    """
+    One ledger connection per data directory per process
+    """
+    if path_data not in trigger_ledgers:
+        trigger_ledgers[path_data] = TriggerLedger(path_data)
+    return trigger_ledgers[path_data]
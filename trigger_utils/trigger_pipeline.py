@@ -0,0 +1,746 @@
+import asyncio
+import datetime
+from astropy.time import Time, TimeDelta
+from ligo.gracedb.exceptions import HTTPError
+
+from trigger_utils.trigger_utils import (
+    parse_gcn_dict,
+    parse_alert_header,
+    ProcessedAlerts,
+    get_xml_params,
+    passes_xml_criteria,
+    plausible_bbh,
+    get_skymap_params,
+    check_triggered_csv,
+    SkymapCoverage,
+    query_fritz_gcn_events,
+    query_kowalski_ztf_queue,
+    get_mass_estimator,
+    generate_cadence_dates,
+    submit_plan,
+    update_trigger_log,
+    delete_trigger_ztf,
+    get_plan_stats,
+    check_before_sunset,
+    trigger_ztf,
+    add_triggercsv,
+    send_trigger_email,
+    MyException,
+)
+from trigger_utils.trigger_ledger import get_trigger_ledger
+from trigger_utils.chirp_mass import query_chirp_mass, get_chirp_mass_poller
+from trigger_utils.ztf_coverage import get_ztf_field_grid
+from trigger_utils.plan_estimator import estimate_plan, screen_plan
+from utils.ephemeris import get_night_ephemeris
+from utils.http_client import get_http_client
+from utils.skymap_cache import get_skymap_cache
+from utils.tracing import get_tracer
+
+
+async def poll_with_backoff(func, *args, timeout, initial_delay, max_delay, factor=2):
+    """
+    Call func in a worker thread until it returns something other than None or we time out.
+    The wait between calls grows by factor up to max_delay.
+    """
+    loop = asyncio.get_running_loop()
+    end_time = loop.time() + timeout
+    delay = initial_delay
+    while True:
+        result = await asyncio.to_thread(func, *args)
+        if result is not None:
+            return result
+        remaining = end_time - loop.time()
+        if remaining <= 0:
+            return None
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * factor, max_delay)
+
+
+class TriggerPipeline:
+    """
+    Decide whether to trigger ZTF on each LVC alert.
+
+    Every alert runs as its own asyncio task. Alerts for different superevents progress
+    concurrently. For a single superevent only the newest alert matters: it cancels any
+    older alert still in flight, then waits out a debounce window in case an even newer
+    one arrives. Results that don't depend on the skymap version (the chirp mass and the
+    Fritz gcnevent_id) and plan requests for an unchanged localization are reused from
+    the superseded alert. Blocking network calls run in worker threads; bookkeeping in
+    the trigger ledger stays on the event loop so only one alert updates it at a time.
+
+    With prewarm, a plausible BBH Preliminary alert also starts the skymap, chirp mass,
+    Fritz event and coverage lookups in the background, whether or not the alert itself
+    passes, so a later alert for the superevent finds them done or underway.
+    """
+
+    def __init__(
+        self,
+        credentials,
+        fritz_token,
+        allocation,
+        mode,
+        path_data,
+        testing,
+        logger,
+        debounce=10,
+        prewarm=True,
+    ):
+        self.credentials = credentials
+        self.fritz_token = fritz_token
+        self.allocation = allocation
+        self.mode = mode
+        self.path_data = path_data
+        self.testing = testing
+        self.logger = logger
+        self.kowalski_username = credentials["kowalski_username"]
+        self.kowalski_password = credentials["kowalski_password"]
+        # tasks still running or waiting for each superevent, oldest first
+        self.tasks = {}
+        # trigger submissions, which are not cancelled with their alert
+        self.commits = {}
+        # seconds to wait for a newer alert before processing one
+        self.debounce = 0 if testing else debounce
+        # results reusable by later alerts for each superevent
+        self.results = {}
+        # start the lookups for a later alert when a plausible BBH Preliminary arrives
+        self.prewarm = prewarm
+        self.prewarms = set()
+        # alerts already processed (on disk) or being processed, to drop repeats
+        self.processed = ProcessedAlerts(path_data)
+        self.in_flight = set()
+        # alerts older than this can't be triggered on, so skip them unparsed
+        self.horizon = datetime.timedelta(days=1)
+        # build or load the Palomar sunset/sunrise table now rather than on the first alert
+        try:
+            get_night_ephemeris(path_data)
+        except Exception as e:
+            logmessage = f"Could not load the night ephemeris, will try again on the first alert: {e}"
+            self.logger.log(logmessage, slack=False)
+        # likewise the ZTF field index used for coverage checks, which takes a few seconds to build
+        try:
+            get_ztf_field_grid(path_data)
+        except Exception as e:
+            logmessage = f"No local ZTF field grid, coverage checks will ask Fritz: {e}"
+            self.logger.log(logmessage, slack=False)
+
+    def skip_alert(self, value):
+        """
+        Check the VOEvent header for alerts we can drop without parsing the whole message:
+        repeats of alerts we have seen, and (apart from retractions) alerts too old to trigger on.
+        This lets a restarted consumer fast-forward through the backlog on the topics.
+        Returns the (superevent_id, ivorn) key of the alert, () if the header can't be read
+        (so the full parse decides), or None if it should be skipped.
+        """
+        header = parse_alert_header(value)
+        if header is None:
+            return ()
+        superevent_id, dateobs, alert_type, ivorn = header
+        key = (superevent_id, ivorn)
+        if key in self.processed or key in self.in_flight:
+            self.logger.log(f"Skipping repeat of {ivorn}", slack=False)
+            return None
+        age = datetime.datetime.now(datetime.timezone.utc) - dateobs
+        if alert_type.upper() != "RETRACTION" and age > self.horizon:
+            self.logger.log(f"Skipping {ivorn}: more than 1 day old", slack=False)
+            return None
+        return key
+
+    def submit(self, value):
+        """
+        Parse an alert and schedule it, returning the task (or None if the alert is skipped or can't be parsed)
+        """
+        key = self.skip_alert(value)
+        if key is None:
+            return None
+        try:
+            with get_tracer().span("xml parse") as span:
+                params = get_xml_params(parse_gcn_dict(value))
+                span.set(superevent_id=params[2], alert_type=params[4])
+        except Exception as e:
+            self.logger.log(e, slack=False)
+            return None
+        superevent_id = params[2]
+        alert_type = params[4]
+        queued = self.tasks.setdefault(superevent_id, [])
+        if queued:
+            for previous in queued:
+                previous.cancel()
+            logmessage = (
+                f"{alert_type} alert supersedes in-flight processing of {superevent_id}"
+            )
+            self.logger.log(logmessage, slack=False)
+        previous = queued[-1] if queued else None
+        if alert_type.upper() == "RETRACTION" and superevent_id in self.results:
+            for lookup in self.results[superevent_id]["lookups"].values():
+                lookup.cancel()
+        self.forget_old_results(params[1])
+        if self.prewarm and alert_type == "Preliminary" and plausible_bbh(*params[2:9]):
+            prewarm = asyncio.create_task(self.prewarm_alert(params))
+            self.prewarms.add(prewarm)
+            prewarm.add_done_callback(self.prewarms.discard)
+        task = asyncio.create_task(self.run_alert(params, previous))
+        queued.append(task)
+        if key:
+            self.in_flight.add(key)
+        task.add_done_callback(lambda t: self.forget(superevent_id, t, key))
+        return task
+
+    def forget(self, superevent_id, task, key=()):
+        if key:
+            self.in_flight.discard(key)
+            # a cancelled alert was superseded or interrupted, so it may still need processing on a restart
+            if not task.cancelled():
+                self.processed.add(*key)
+        queued = self.tasks.get(superevent_id, [])
+        if task in queued:
+            queued.remove(task)
+        if not queued:
+            self.tasks.pop(superevent_id, None)
+
+    def get_results(self, superevent_id, mjd):
+        """
+        Results saved by earlier alerts for this superevent
+        """
+        return self.results.setdefault(
+            superevent_id,
+            {"mjd": mjd, "localizations": {}, "plans": {}, "lookups": {}},
+        )
+
+    def start_lookup(self, results, key, lookup_function):
+        """
+        Start a lookup shared by all alerts for the superevent, unless one is underway or has
+        already succeeded. Await it through asyncio.shield so a cancelled alert leaves it running.
+        """
+        lookup = results["lookups"].get(key)
+        if (
+            lookup is None
+            or lookup.cancelled()
+            or (lookup.done() and (lookup.exception() or lookup.result() is None))
+        ):
+            lookup = asyncio.ensure_future(lookup_function())
+            results["lookups"][key] = lookup
+        return lookup
+
+    def forget_old_results(self, mjd):
+        """
+        Drop saved results for superevents too old to trigger on
+        """
+        for superevent_id in list(self.results):
+            if mjd - self.results[superevent_id]["mjd"] > 2:
+                del self.results[superevent_id]
+                get_chirp_mass_poller(self.path_data).forget(superevent_id)
+
+    async def run_alert(self, params, previous=None):
+        superevent_id = params[2]
+        alert_type = params[4]
+        tracer = get_tracer()
+        # every span from here on, including in worker threads, is tagged with the alert
+        with tracer.context(superevent_id=superevent_id, alert_type=alert_type):
+            with tracer.span("alert") as span:
+                try:
+                    # let a superseded alert finish cancelling, and any trigger it started finish
+                    if previous:
+                        await asyncio.wait([previous])
+                    commit = self.commits.pop(superevent_id, None)
+                    if commit:
+                        await asyncio.wait([commit])
+                    # a newer alert arriving during the debounce window cancels this one
+                    if alert_type.upper() != "RETRACTION":
+                        await asyncio.sleep(self.debounce)
+                    await self.process_alert(params)
+                except MyException as e:
+                    self.logger.log(e, slack=False)
+                    span.set(outcome=str(e))
+                except asyncio.CancelledError:
+                    self.logger.log(
+                        f"processing of {superevent_id} cancelled", slack=False
+                    )
+                    raise
+                except Exception as e:
+                    self.logger.log(e, slack=False)
+                    span.set(outcome=f"error: {e}")
+        get_http_client().log_summary(self.logger, interval=3600)
+
+    async def remove_trigger(self, superevent_id, triggered, trigger_plan_id):
+        """
+        If a previous alert for this event prompted a trigger, mark it invalid and try to remove it from the ZTF queue
+        """
+        if triggered:
+            update_trigger_log(superevent_id, "valid", False, path_data=self.path_data)
+            get_trigger_ledger(self.path_data).export_csv()
+            await asyncio.to_thread(
+                delete_trigger_ztf, trigger_plan_id, self.fritz_token, self.mode
+            )
+            self.logger.log(f"attempting to remove trigger for {superevent_id}")
+
+    def query_mchirp(self, superevent_id):
+        try:
+            return query_chirp_mass(superevent_id, path_data=self.path_data)
+        except HTTPError:
+            logmessage = f"GraceDB HTTPError for {superevent_id}, retrying"
+            self.logger.log(logmessage)
+            return None
+
+    async def get_mchirp(self, superevent_id, results):
+        """
+        Poll GraceDB for the chirp mass distribution. The lookup is shared by all alerts for the
+        superevent, so a newer alert picks up where a superseded one left off rather than starting over.
+        """
+        lookup = self.start_lookup(
+            results,
+            "mchirp",
+            lambda: poll_with_backoff(
+                self.query_mchirp,
+                superevent_id,
+                timeout=600,
+                initial_delay=15,
+                max_delay=60,
+            ),
+        )
+        return await asyncio.shield(lookup)
+
+    async def get_skymap(self, skymap_url, results):
+        """
+        Distance and 90% area of the skymap, shared by alerts with the same skymap
+        """
+        lookup = self.start_lookup(
+            results,
+            ("skymap", skymap_url),
+            lambda: asyncio.to_thread(get_skymap_params, skymap_url, self.path_data),
+        )
+        return await asyncio.shield(lookup)
+
+    async def find_fritz_event(self, dateobs, skymap_name, results):
+        """
+        Poll Fritz for the gcnevent_id and the localization id of the skymap, saving them in results
+        """
+
+        async def find():
+            if not self.testing and "gcnevent_id" not in results:
+                # give Fritz time to ingest a new event
+                await asyncio.sleep(30)
+            with get_tracer().span("fritz event lookup"):
+                fritz_event = await poll_with_backoff(
+                    query_fritz_gcn_events,
+                    dateobs,
+                    skymap_name,
+                    self.fritz_token,
+                    self.mode,
+                    timeout=1 if self.testing else 300,
+                    initial_delay=10,
+                    max_delay=60,
+                )
+            if fritz_event is not None:
+                results["gcnevent_id"], results["localizations"][skymap_name] = (
+                    fritz_event
+                )
+            return fritz_event
+
+        lookup = self.start_lookup(results, ("fritz event", skymap_name), find)
+        return await asyncio.shield(lookup)
+
+    async def get_coverage(
+        self, dateobs, superevent_id, skymap_name, skymap_url, results
+    ):
+        """
+        Fraction of the skymap ZTF covered in the previous ~3 nights in each filter
+        """
+
+        async def check():
+            coverage = SkymapCoverage(
+                dateobs,
+                skymap_name,
+                localprob=0.9,
+                fritz_token=self.fritz_token,
+                fritz_mode=self.mode,
+                kowalski_username=self.kowalski_username,
+                kowalski_password=self.kowalski_password,
+                superevent_id=superevent_id,
+                skymap_url=skymap_url,
+                path_data=self.path_data,
+            )
+            with get_tracer().span("coverage check") as span:
+                fractions = await asyncio.to_thread(coverage.get_coverage_fractions)
+                span.set(**fractions)
+            return fractions
+
+        lookup = self.start_lookup(results, ("coverage", skymap_url), check)
+        return await asyncio.shield(lookup)
+
+    async def prewarm_alert(self, params):
+        """
+        Fetch and cache what a later alert for this superevent will need, without submitting
+        anything: the skymap, chirp mass, Fritz event and ZTF coverage
+        """
+        dateobs, mjd, superevent_id = params[0], params[1], params[2]
+        skymap_url, skymap_name = params[9], params[10]
+        results = self.get_results(superevent_id, mjd)
+        tracer = get_tracer()
+        with tracer.context(superevent_id=superevent_id, alert_type="Preliminary"):
+            with tracer.span("prewarm"):
+                self.logger.log(f"Prewarming lookups for {superevent_id}", slack=False)
+                lookups = [
+                    asyncio.ensure_future(self.get_mchirp(superevent_id, results)),
+                    asyncio.ensure_future(
+                        self.find_fritz_event(dateobs, skymap_name, results)
+                    ),
+                ]
+                if skymap_url is not None:
+                    # the coverage check reads the skymap, so let it download once first
+                    try:
+                        await self.get_skymap(skymap_url, results)
+                        lookups.append(
+                            self.get_coverage(
+                                dateobs, superevent_id, skymap_name, skymap_url, results
+                            )
+                        )
+                    except Exception as e:
+                        logmessage = (
+                            f"Could not prewarm skymap for {superevent_id}: {e}"
+                        )
+                        self.logger.log(logmessage, slack=False)
+                outcomes = await asyncio.gather(*lookups, return_exceptions=True)
+        failed = [o for o in outcomes if o is None or isinstance(o, BaseException)]
+        logmessage = f"Prewarmed {len(outcomes) - len(failed)} of {len(outcomes)} lookups for {superevent_id}"
+        self.logger.log(logmessage, slack=False)
+
+    def screen_plan(self, superevent_id, skymap_url):
+        """
+        Estimate the Fritz plan locally and say whether it clearly fails or passes our plan
+        criteria, or "unsure" if we need the real plan (or couldn't make the estimate)
+        """
+        try:
+            skymap = get_skymap_cache(self.path_data).get_table(skymap_url)
+            with get_tracer().span("plan estimate") as span:
+                estimate = estimate_plan(skymap, self.path_data)
+                span.set(
+                    total_time=estimate["total_time"],
+                    probability=estimate["probability"],
+                )
+        except Exception as e:
+            logmessage = f"Could not estimate a plan for {superevent_id}: {e}"
+            self.logger.log(logmessage, slack=False)
+            return "unsure"
+        screen = screen_plan(estimate, max_time=5400, min_probability=0.5)
+        logmessage = f"Estimated plan for {superevent_id} with {estimate['total_time']} seconds and {estimate['probability']:.2f} probability: {screen}"
+        self.logger.log(logmessage, slack=False)
+        return screen
+
+    async def check_ztf_queue(self, dateobs, superevent_id, gcnevent_id):
+        with get_tracer().span("queue check"):
+            kowalski_event_status = await asyncio.to_thread(
+                query_kowalski_ztf_queue,
+                [dateobs, superevent_id, gcnevent_id],
+                self.fritz_token,
+                self.allocation,
+            )
+        self.logger.log(
+            f"checked ZTF observing queue for key words related to {superevent_id}"
+        )
+        return kowalski_event_status
+
+    async def process_alert(self, params):
+        dateobs = params[0]
+        mjd = params[1]
+        superevent_id = params[2]
+        significant = params[3]
+        alert_type = params[4]
+        group = params[5]
+        prob_bbh = params[6]
+        prob_ter = params[7]
+        far = params[8]
+        skymap_url = params[9]
+        skymap_name = params[10]
+
+        # results saved by earlier alerts for this superevent
+        results = self.get_results(superevent_id, mjd)
+
+        # check the trigger ledger for superevent_id
+        triggered, trigger_plan_id = check_triggered_csv(superevent_id, self.path_data)
+
+        # stage 1: cuts on the VOEvent alone, no network I/O
+        if not passes_xml_criteria(
+            superevent_id,
+            significant,
+            alert_type,
+            group,
+            prob_bbh,
+            prob_ter,
+            far,
+            skymap_name,
+        ):
+            await self.remove_trigger(superevent_id, triggered, trigger_plan_id)
+            logmessage = f"{superevent_id} did not pass initial criteria"
+            self.logger.log(logmessage)
+            raise MyException(logmessage)
+
+        # stage 2: only download the skymap for alerts that survive
+        distmean, a90 = await self.get_skymap(skymap_url, results)
+        if distmean == "error" or a90 > 1000:
+            await self.remove_trigger(superevent_id, triggered, trigger_plan_id)
+            logmessage = f"{superevent_id} did not pass initial criteria"
+            self.logger.log(logmessage)
+            raise MyException(logmessage)
+
+        self.logger.log(f"Processing {superevent_id} from {alert_type} alert")
+
+        # grab the left bin edge for the most probable mchirp bin
+        with get_tracer().span("chirp mass lookup") as span:
+            distribution = await self.get_mchirp(superevent_id, results)
+            mchirp = None if distribution is None else distribution.most_probable_bin()
+            span.set(mchirp=mchirp)
+        if mchirp is not None:
+            bins, probabilities = distribution.slack_bins()
+            logmessage = f"{superevent_id} chirp mass bins: " + ", ".join(
+                f"{b[0]}-{b[1]} ({round(100 * p, 1)}%)"
+                for b, p in zip(bins, probabilities)
+            )
+            self.logger.log(logmessage, slack=False)
+            # trigger on most probable bins >= 22
+            if mchirp < 22:
+                await self.remove_trigger(superevent_id, triggered, trigger_plan_id)
+                logmessage = f"{superevent_id} did not pass mass criteria"
+                self.logger.log(logmessage)
+                raise MyException(logmessage)
+        else:
+            # revert to the mass prediction
+            logmessage = (
+                f"Could not find a chirp mass file on GraceDB for {superevent_id}"
+            )
+            self.logger.log(logmessage)
+            mass = get_mass_estimator(self.path_data).predict([distmean], [far])[0]
+            if mass < 60:
+                await self.remove_trigger(superevent_id, triggered, trigger_plan_id)
+                logmessage = (
+                    f"{superevent_id} with mass={mass} did not pass mass criteria"
+                )
+                self.logger.log(logmessage)
+                raise MyException(logmessage)
+
+        self.logger.log(f"{superevent_id} passed mass criteria")
+
+        # a plan that clearly can't meet the criteria doesn't need to go to Fritz. The estimate
+        # is rough, so an existing trigger is only removed on the real plan statistics below.
+        screen = await asyncio.to_thread(self.screen_plan, superevent_id, skymap_url)
+        if screen == "fail" and not triggered:
+            logmessage = (
+                f"Estimated followup plan for {superevent_id} does not meet criteria"
+            )
+            self.logger.log(logmessage)
+            raise MyException(logmessage)
+
+        # find gcn event on fritz
+        localization_id = results["localizations"].get(skymap_name)
+        if localization_id is None:
+            fritz_event = await self.find_fritz_event(dateobs, skymap_name, results)
+            if fritz_event is None:
+                logmessage = f"Could not find a GCN event on Fritz for {superevent_id}"
+                self.logger.log(logmessage)
+                raise MyException(logmessage)
+            localization_id = fritz_event[1]
+        gcnevent_id = results["gcnevent_id"]
+
+        # a plan we expect to pass is likely to be sent to ZTF, so check the ZTF queue while Fritz makes it
+        queue_check = None
+        if screen == "pass" and not self.testing:
+            queue_check = asyncio.ensure_future(
+                self.check_ztf_queue(dateobs, superevent_id, gcnevent_id)
+            )
+
+        try:
+            # submit plan request to Fritz, unless a superseded alert already did for this localization
+            queuename = results["plans"].get(localization_id)
+            with get_tracer().span("plan generation", reused=queuename is not None):
+                if queuename is None:
+                    self.logger.log(f"Submitting plan request for {superevent_id}")
+                    queuename = await asyncio.to_thread(
+                        submit_plan,
+                        self.fritz_token,
+                        self.allocation,
+                        superevent_id,
+                        gcnevent_id,
+                        localization_id,
+                        self.mode,
+                        self.path_data,
+                    )
+                    results["plans"][localization_id] = queuename
+                    await asyncio.sleep(15)
+                else:
+                    self.logger.log(
+                        f"Reusing plan request {queuename} for {superevent_id}"
+                    )
+
+                # retrieve observation plan for event from Fritz
+                fritz_event_status = await poll_with_backoff(
+                    get_plan_stats,
+                    gcnevent_id,
+                    queuename,
+                    self.fritz_token,
+                    self.mode,
+                    timeout=300,
+                    initial_delay=10,
+                    max_delay=60,
+                )
+                if fritz_event_status is None:
+                    logmessage = f"Could not find an observing plan for {superevent_id}"
+                    self.logger.log(logmessage)
+                    raise MyException(logmessage)
+        except BaseException:
+            if queue_check is not None:
+                queue_check.cancel()
+            raise
+
+        # API call to Kowalski - check for event keywords in ZTF observing queue
+        if not self.testing:
+            if queue_check is None:
+                queue_check = self.check_ztf_queue(dateobs, superevent_id, gcnevent_id)
+            kowalski_event_status = await queue_check
+        else:
+            kowalski_event_status = False
+
+        # have we triggered on the event
+        if fritz_event_status[0] or kowalski_event_status:
+            previous_trigger = True
+        else:
+            previous_trigger = False
+
+        # if another group has triggered on the event, we will not trigger
+        if previous_trigger and not triggered:
+            logmessage = f"Previous trigger for {superevent_id}"
+            self.logger.log(logmessage)
+            raise MyException(logmessage)
+
+        # do the plan stats pass our criteria
+        total_time = fritz_event_status[1]
+        probability = fritz_event_status[2]
+        start_observation = fritz_event_status[3]
+        observation_plan_request_id = fritz_event_status[4]
+
+        if triggered and trigger_plan_id == observation_plan_request_id:
+            logmessage = f"Already triggered on this plan for {superevent_id}"
+            self.logger.log(logmessage)
+            raise MyException(logmessage)
+
+        if total_time > 5400 or probability < 0.5:
+            await self.remove_trigger(superevent_id, triggered, trigger_plan_id)
+            logmessage = f"Followup plan for {superevent_id} with {total_time} seconds and {probability} probability does not meet criteria"
+            self.logger.log(logmessage)
+            raise MyException(logmessage)
+        # don't trigger on events older than 1 day
+        if TimeDelta(Time.now().mjd - mjd, format="jd").value > 1:
+            logmessage = f"{superevent_id} is more than 1 day old"
+            self.logger.log(logmessage)
+            raise MyException(logmessage)
+
+        # if we have triggered on earlier GCN, can we update trigger with more recent inference
+        if triggered:
+            if not check_before_sunset(self.path_data):
+                logmessage = f"Too late to update submitted trigger for {superevent_id}"
+                self.logger.log(logmessage)
+                raise MyException(logmessage)
+            else:
+                # remove current submitted plan so we can submit new one
+                # TODO: verify that trigger is successfully removed, else raise exception
+                await asyncio.to_thread(
+                    delete_trigger_ztf, trigger_plan_id, self.fritz_token, self.mode
+                )
+                logmessage = f"Removing previous trigger for {superevent_id} so we can resubmit updated plan"
+                self.logger.log(logmessage)
+
+        # check if ZTF survey naturally covered the skymap previous ~3 nights, in both g and r
+        fractions = await self.get_coverage(
+            dateobs, superevent_id, skymap_name, skymap_url, results
+        )
+        frac_observed = SkymapCoverage.covered_fraction(fractions)
+        if (
+            frac_observed >= 0.9 * probability
+        ):  # TODO: what percentage do we want here? Either way, make sure it is documented
+            serendipitious_observation = (
+                observation_plan_request_id,
+                start_observation,
+            )
+            email_message = f"{superevent_id} is good. Serendipitious coverage {round(frac_observed * 100)} % of {superevent_id} - not triggering"
+            self.logger.log(email_message)
+            send_to_ztf = False
+        else:
+            if self.testing:
+                logmessage = f"Plan for {superevent_id} is good - but dont trigger in testing mode"
+                self.logger.log(logmessage)
+                send_to_ztf = False
+            else:
+                await asyncio.sleep(30)
+                send_to_ztf = True
+            email_message = f"ZTF Triggered for {superevent_id}"
+            serendipitious_observation = None
+
+        # once we start sending the plan to ZTF, finish the bookkeeping even if this alert is cancelled
+        commit = asyncio.ensure_future(
+            self.commit_trigger(
+                send_to_ztf,
+                superevent_id,
+                dateobs,
+                alert_type,
+                skymap_name,
+                gcnevent_id,
+                localization_id,
+                observation_plan_request_id,
+                start_observation,
+                serendipitious_observation,
+                email_message,
+            )
+        )
+        self.commits[superevent_id] = commit
+        await asyncio.shield(commit)
+
+    async def commit_trigger(
+        self,
+        send_to_ztf,
+        superevent_id,
+        dateobs,
+        alert_type,
+        skymap_name,
+        gcnevent_id,
+        localization_id,
+        observation_plan_request_id,
+        start_observation,
+        serendipitious_observation,
+        email_message,
+    ):
+        """
+        Send the plan to the ZTF queue, record it in the trigger ledger, and send the email
+        """
+        if send_to_ztf:
+            with get_tracer().span("trigger submission"):
+                await asyncio.to_thread(
+                    trigger_ztf,
+                    observation_plan_request_id,
+                    self.fritz_token,
+                    self.mode,
+                )
+            self.logger.log(f"Triggered ZTF for {superevent_id} at {Time.now()}")
+
+        # write to the trigger ledger, and export triggered_events.csv
+        trigger_cadence = generate_cadence_dates(dateobs)
+        gcn_type = (alert_type, skymap_name)
+        queued_plan = (observation_plan_request_id, start_observation)
+        valid = True
+        if serendipitious_observation:
+            queued_plan = None
+        add_triggercsv(
+            superevent_id,
+            dateobs,
+            gcn_type,
+            gcnevent_id,
+            localization_id,
+            trigger_cadence,
+            queued_plan,
+            serendipitious_observation,
+            valid,
+            self.path_data,
+        )
+        get_trigger_ledger(self.path_data).export_csv()
+        # only queued here, the outbox worker sends it
+        with get_tracer().span("email"):
+            send_trigger_email(
+                self.credentials, email_message, dateobs, path_data=self.path_data
+            )
@@ -1,29 +1,38 @@
 import numpy as np
-import pandas as pd
-from astropy.cosmology import Planck15 as cosmo
-import astropy.cosmology as cos
-from astropy.table import Table
-import astropy.units as u
-import astropy_healpix as ah
 from astropy.time import Time, TimeDelta
-from astropy.coordinates import EarthLocation
-from astroplan import Observer
 import datetime
 from datetime import timedelta
-import requests
 import os
-from io import BytesIO
+import re
 import json
 import pickle
 import xmltodict
-import smtplib
-from penquins import Kowalski
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from ligo.gracedb.rest import GraceDb
 # TODO use either datetime or astropytime
 
 from utils.log import Logger
+from utils.skymap_cache import get_skymap_cache
+from utils.credible_region import CredibleRegions
+from utils.cosmology import z_at_luminosity_distance
+from utils.ephemeris import get_night_ephemeris
+from utils.http_client import get_http_client
+from utils.tracing import get_tracer
+from utils.outbox import get_outbox
+from trigger_utils.chirp_mass import query_chirp_mass
+from trigger_utils.plan_requests import (
+    get_plan_requests,
+    MyException as PlanRequestsException,
+)
+from trigger_utils.ztf_coverage import (
+    get_ztf_exposures,
+    get_ztf_field_grid,
+    observed_fields,
+    FieldCoverage,
+)
+from trigger_utils.trigger_ledger import (
+    get_trigger_ledger,
+    parse_observations,
+    OBSERVATION_COLUMNS,
+)
 
 
 class MyException(Exception):
@@ -43,18 +52,72 @@ def parse_gcn_dict(response):
     return dict
 
 
+def parse_alert_header(response):
+    """
+    Read just the ivorn, GraceID, AlertType and ISOTime of a VOEvent with regular expressions,
+    which is much cheaper than parsing the whole document. Returns None if any are missing.
+    """
+    if isinstance(response, bytes):
+        response = response.decode("utf-8", errors="replace")
+    ivorn = re.search(r'<voe:VOEvent\b[^>]*\bivorn="([^"]+)"', response)
+    event_id = re.search(
+        r'<Param\b[^>]*\bname="GraceID"[^>]*\bvalue="([^"]+)"', response
+    )
+    alert_type = re.search(
+        r'<Param\b[^>]*\bname="AlertType"[^>]*\bvalue="([^"]+)"', response
+    )
+    isotime = re.search(r"<ISOTime>\s*([^<\s]+)\s*</ISOTime>", response)
+    if not (ivorn and event_id and alert_type and isotime):
+        return None
+    try:
+        dateobs = datetime.datetime.fromisoformat(isotime.group(1))
+    except ValueError:
+        return None
+    if dateobs.tzinfo is None:
+        dateobs = dateobs.replace(tzinfo=datetime.timezone.utc)
+    return event_id.group(1), dateobs, alert_type.group(1), ivorn.group(1)
+
+
+class ProcessedAlerts:
+    """
+    (superevent_id, ivorn) of every alert we have finished processing, saved in
+    processed_alerts.csv so that restarts and repeats across the LVC topics are dropped
+    with a set lookup. The ivorn carries the alert sequence number, e.g. ivo://gwnet/LVC#S230518h-2-Preliminary
+    """
+
+    def __init__(self, path_data="data"):
+        self.path = f"{path_data}/trigger_data/processed_alerts.csv"
+        self.processed = set()
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                for line in f:
+                    superevent_id, _, ivorn = line.strip().partition(",")
+                    if ivorn:
+                        self.processed.add((superevent_id, ivorn))
+
+    def __contains__(self, key):
+        return key in self.processed
+
+    def add(self, superevent_id, ivorn):
+        if (superevent_id, ivorn) in self.processed:
+            return
+        self.processed.add((superevent_id, ivorn))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(f"{superevent_id},{ivorn}\n")
+
+
 def get_a(skymap, probarea):
-    skymap.sort("PROBDENSITY", reverse=True)
-    level, ipix = ah.uniq_to_level_ipix(skymap["UNIQ"])
-    pixel_area = ah.nside_to_pixel_area(ah.level_to_nside(level))
-    prob = pixel_area * skymap["PROBDENSITY"]
-    cumprob = np.cumsum(prob)
-    i = cumprob.searchsorted(probarea)
-    area = (pixel_area[:i].sum()).to_value(u.deg**2)
-    return area
+    """
+    Area in deg2 of the probarea credible region - does not modify skymap
+    """
+    return CredibleRegions(skymap).get_area(probarea)
 
 
-def get_params(dict):
+def get_xml_params(dict):
+    """
+    Parse the fields we cut on directly from the VOEvent XML, without any network I/O
+    """
     try:
         # Ensure the input dictionary has the expected structure
         if (
@@ -91,6 +154,21 @@ def get_params(dict):
             for item in dict["voe:VOEvent"]["What"]["Param"]
             if item.get("@name") == "AlertType"
         ][0]
+        # retractions (AlertType "Retraction") carry no classification or skymap - nothing else to parse
+        if alert_type.upper() == "RETRACTION":
+            return (
+                dateobs_str,
+                mjd,
+                event_id,
+                None,
+                alert_type,
+                None,
+                0,
+                1,
+                None,
+                None,
+                None,
+            )
         group = [
             item["@value"]
             for item in dict["voe:VOEvent"]["What"]["Param"]
@@ -127,20 +205,7 @@ def get_params(dict):
         except (KeyError, IndexError, TypeError, ValueError):
             prob_ter = 1
         far = float(dict["voe:VOEvent"]["What"]["Param"][9]["@value"])
-        skymap_url = [
-            item["Param"]["@value"]
-            for item in dict["voe:VOEvent"]["What"]["Group"]
-            if item.get("@name") == "GW_SKYMAP"
-        ][0]
-        skymap_response = requests.get(skymap_url)
-        skymap_bytes = skymap_response.content
-        skymap = Table.read(BytesIO(skymap_bytes))
-        try:
-            distmean = skymap.meta["DISTMEAN"]
-        except (KeyError, IndexError, TypeError, ValueError):
-            distmean = "error"
         far_format = 1.0 / (far * 3.15576e7)
-        a90 = round(get_a(skymap, 0.9))
         skymap_url = [
             item["Param"]["@value"]
             for item in dict["voe:VOEvent"]["What"]["Group"]
@@ -157,62 +222,129 @@ def get_params(dict):
             prob_bbh,
             prob_ter,
             far_format,
-            distmean,
-            a90,
+            skymap_url,
             skymap_type,
         )
     except MyException as e:
         raise MyException(f"error getting params for {event_id}: error: {e}") from e
 
 
-def m_total_mlp(path_data, dl_bbh, far, dl_bns=168.0):
-    path_mlp = f"{path_data}/mlp_model.sav"
-    MLP = pickle.load(open(path_mlp, "rb"))
-    z = cos.z_at_value(cosmo.luminosity_distance, dl_bbh * u.Mpc, method="bounded")
-    X = np.array([np.log10(dl_bbh / dl_bns), np.log10(1 + z), np.log10(far)])
-    X = X.reshape(1, -1)
-    mass = MLP.predict(X)[0]
-    return 10.0**mass
+def passes_xml_criteria(
+    superevent_id,
+    significant,
+    alert_type,
+    group,
+    prob_bbh,
+    prob_ter,
+    far,
+    skymap_name,
+):
+    """
+    The cuts we can make from the VOEvent alone, before downloading the skymap
+    """
+    return not (
+        superevent_id[0] != "S"
+        or alert_type.upper() == "RETRACTION"
+        or significant != "1"
+        or group != "CBC"
+        or prob_bbh < 0.5
+        or prob_ter > 0.4
+        or far < 10
+        or (alert_type == "Preliminary" and skymap_name[-1] == "0")
+    )
 
 
-def query_mchirp_gracedb(event, path_data):
+def plausible_bbh(
+    superevent_id, significant, alert_type, group, prob_bbh, prob_ter, far
+):
     """
-    Fetches chirp mass .json from GraceDB
+    Looser cuts than passes_xml_criteria, for alerts that might be a BBH once the
+    classification firms up - worth fetching inputs for ahead of a later alert
     """
-    client = GraceDb(service_url="https://gracedb.ligo.org/api/")
+    return (
+        superevent_id[0] == "S"
+        and alert_type.upper() != "RETRACTION"
+        and group == "CBC"
+        and prob_bbh >= 0.3
+    )
 
-    files = client.files(event).json()
-    file_data = None
 
-    # Ensure output directory exists
-    output_dir = os.path.join(path_data, "mchirp")
-    os.makedirs(output_dir, exist_ok=True)
+def get_skymap_params(skymap_url, path_data="data"):
+    """
+    Get the skymap (through the shared cache) and the parameters we cut on: distance and 90% area
+    """
+    tracer = get_tracer()
+    with tracer.span("skymap fetch"):
+        skymap = get_skymap_cache(path_data).get_table(skymap_url)
+    try:
+        distmean = skymap.meta["DISTMEAN"]
+    except (KeyError, IndexError, TypeError, ValueError):
+        distmean = "error"
+    with tracer.span("credible area") as span:
+        a90 = round(get_a(skymap, 0.9))
+        span.set(a90=a90)
+    return distmean, a90
+
+
+def get_params(dict, path_data="data"):
+    """
+    Get all parameters for an alert: the VOEvent fields and those that need the skymap
+    """
+    xml_params = get_xml_params(dict)
+    skymap_url = xml_params[9]
+    if skymap_url is None:
+        raise MyException(f"No skymap for {xml_params[2]} {xml_params[4]} alert")
+    distmean, a90 = get_skymap_params(skymap_url, path_data)
+    return (*xml_params[:9], distmean, a90, xml_params[10])
+
+
+class MassEstimator:
+    """
+    Outdated MLP total mass estimator, used when we can't get the chirp mass from GraceDB.
+    Use get_mass_estimator so the model is loaded once per process.
+    """
+
+    def __init__(self, path_data):
+        self.path_data = path_data
+        self.path_mlp = f"{path_data}/mlp_model.sav"
+        with open(self.path_mlp, "rb") as f:
+            self.MLP = pickle.load(f)
+
+    def predict(self, distances, fars, dl_bns=168.0):
+        """
+        Total restframe mass for each event from its mean distance (Mpc) and FAR (years/FA)
+        """
+        dl_bbh = np.asarray(distances, dtype=float)
+        far = np.asarray(fars, dtype=float)
+        if dl_bbh.size == 0:
+            return np.array([])
+        z = z_at_luminosity_distance(dl_bbh, self.path_data)
+        X = np.column_stack([np.log10(dl_bbh / dl_bns), np.log10(1 + z), np.log10(far)])
+        mass = self.MLP.predict(X)
+        return 10.0**mass
+
+
+mass_estimators = {}
+
+
+def get_mass_estimator(path_data):
+    if path_data not in mass_estimators:
+        mass_estimators[path_data] = MassEstimator(path_data)
+    return mass_estimators[path_data]
 
-    for fname in files:
-        if "mchirp_source" in fname and fname.endswith(".json"):
-            logmessage = f"Found: {fname}"
-            logger.log(logmessage, slack=False)
-            file_data = client.files(event, fname)
-            output_path = os.path.join(output_dir, f"mchirp_source_{event}.json")
-            with open(output_path, "wb") as f:
-                f.write(file_data.read())
-            break
-
-    if not file_data:
-        logmessage = f"Did not find chirp mass file on Gracedb event page for {event}"
-        logger.log(logmessage, slack=False)
-        return None
 
-    # Read back JSON file
-    output_path = os.path.join(output_dir, f"mchirp_source_{event}.json")
-    with open(output_path, "r") as f:
-        data = json.load(f)
+def m_total_mlp(path_data, dl_bbh, far, dl_bns=168.0):
+    return get_mass_estimator(path_data).predict([dl_bbh], [far], dl_bns=dl_bns)[0]
 
-    max_index = data["probabilities"].index(max(data["probabilities"]))
-    bin_edges = data["bin_edges"]
 
-    # Return the left edge of the most probable bin
-    return bin_edges[max_index]
+def query_mchirp_gracedb(event, path_data):
+    """
+    Left edge of the most probable bin in the GraceDB chirp mass file, or None if there isn't one yet
+    """
+    distribution = query_chirp_mass(event, path_data)
+    if distribution is None:
+        return None
+    return distribution.most_probable_bin()
 
 
 """
@@ -224,7 +356,7 @@ def query_fritz_gcn_events(dateobs_id, local_name, token, mode):
     try:
         headers = {"Authorization": f"token {token}"}
         endpoint = f"https://{mode}fritz.science/api/gcn_event/{dateobs_id}"
-        response = requests.request("GET", endpoint, headers=headers)
+        response = get_http_client().request("GET", endpoint, headers=headers)
         if response.status_code == 200:
             json_string = response.content.decode("utf-8")
             json_data = json.loads(json_string)
@@ -245,38 +377,33 @@ def query_fritz_gcn_events(dateobs_id, local_name, token, mode):
         return None
 
 
-def compute_plan_start_end():
-    location = EarthLocation(lat=33.3564, lon=-116.865, height=1712)  # Palomar
-    observer = Observer(location=location, timezone="US/Pacific")
-
+def compute_plan_start_end(path_data="data"):
+    ephemeris = get_night_ephemeris(path_data)
     now = Time.now()
-    sunset_time = observer.sun_set_time(now, which="next")
-    sunrise_time = observer.sun_rise_time(now, which="next")
-    if sunrise_time < sunset_time:
+    if ephemeris.is_night(now):
         startdate = now
     else:
-        startdate = sunset_time
+        startdate = ephemeris.next_sunset(now)
     # TODO necessary? to be safe go an hour before sunset
     startdate_return = (startdate - TimeDelta(1 * 3600, format="sec")).utc.iso
     enddate_return = (startdate + TimeDelta(1 * 3600 * 15, format="sec")).utc.iso
     return startdate_return, enddate_return
 
 
-def check_before_sunset():
-    location = EarthLocation(lat=33, lon=-116, height=1712)  # Palomar
-    observer = Observer(location=location, timezone="US/Pacific")
-    now = Time.now()
-    sunset_time = observer.sun_set_time(now, which="next")
-    sunrise_time = observer.sun_rise_time(now, which="next")
-    if sunrise_time < sunset_time:
-        before_sunset = False
-    else:
-        before_sunset = True
-    return before_sunset
+def check_before_sunset(path_data="data"):
+    return not get_night_ephemeris(path_data).is_night()
 
 
-def submit_plan(token, allocation_id, gracedbid, gcnevent_id, localization_id, mode):
-    startdate, enddate = compute_plan_start_end()
+def submit_plan(
+    token,
+    allocation_id,
+    gracedbid,
+    gcnevent_id,
+    localization_id,
+    mode,
+    path_data="data",
+):
+    startdate, enddate = compute_plan_start_end(path_data)
     queuename = f"{gracedbid}_BBHBot_{startdate.replace(' ', '_')}"
 
     # field reference data is not loaded to preview instance of Fritz
@@ -314,37 +441,31 @@ def submit_plan(token, allocation_id, gracedbid, gcnevent_id, localization_id, m
     }
 
     headers = {"Content-Type": "application/json", "Authorization": f"token {token}"}
-    requests.post(url, json=data, headers=headers)
+    get_http_client().post(url, json=data, headers=headers)
+    # the next look at the event's plan requests should include this one
+    get_plan_requests(token, mode).invalidate(gcnevent_id)
     return queuename
 
 
 def get_plan_stats(gcnevent_id, queuename, token, mode):
     try:
-        headers = {"Authorization": f"token {token}"}
-        endpoint = f"https://{mode}fritz.science/api/gcn_event/{gcnevent_id}/observation_plan_requests"
-        response = requests.request("GET", endpoint, headers=headers)
-        if response.status_code == 200:
-            json_string = response.content.decode("utf-8")
-            json_data = json.loads(json_string)
+        listing = get_plan_requests(token, mode).get(gcnevent_id)
 
-        if len(json_data["data"]) == 0:
+        if len(listing) == 0:
             raise MyException(f"No requests found for {gcnevent_id}")
 
         # check if already submitted to queue
-        status = [x["status"] for x in json_data["data"]]
-        if "submitted to telescope queue" in status:
+        if listing.submitted:
             past_submission = True
             logmessage = "Already submitted to queue"
             logger.log(logmessage, slack=False)
         else:
             past_submission = False
 
-        generated_plan = [
-            x for x in json_data["data"] if x["payload"]["queue_name"] == queuename
-        ]
-        if len(generated_plan) == 0:
+        generated_plan = listing.by_queue_name.get(queuename)
+        if generated_plan is None:
             raise MyException(f"No generated plan for {gcnevent_id}")
-        observation_plans = generated_plan[0]["observation_plans"]
+        observation_plans = generated_plan["observation_plans"]
         if len(observation_plans) == 0:
             raise MyException(f"No observation plans for {gcnevent_id}")
         elif len(observation_plans) > 1:
@@ -361,7 +482,7 @@ def get_plan_stats(gcnevent_id, queuename, token, mode):
         total_time = stats[0]["statistics"]["total_time"]
         probability = stats[0]["statistics"]["probability"]
         start_observation = stats[0]["statistics"]["start_observation"]
-        observation_plan_request_id = generated_plan[0]["id"]
+        observation_plan_request_id = generated_plan["id"]
         logmessage = f"Total time: {total_time}, probability: {probability}"
         logger.log(logmessage, slack=False)
         return (
@@ -372,7 +493,7 @@ def get_plan_stats(gcnevent_id, queuename, token, mode):
             observation_plan_request_id,
         )
 
-    except MyException as e:
+    except (MyException, PlanRequestsException) as e:
         logmessage = f"error: {e}"
         logger.log(logmessage, slack=False)
         return None
@@ -384,7 +505,7 @@ def query_kowalski_ztf_queue(keywords, token, allocation):
     """
     headers = {"Authorization": f"token {token}"}
     endpoint = f"https://fritz.science/api/observation/external_api/{allocation}?queuesOnly=true"
-    response = requests.request("GET", endpoint, headers=headers)
+    response = get_http_client().request("GET", endpoint, headers=headers)
     if response.status_code != 200:
         raise Exception("API call to ZTF queue failed")
     json_string = response.content.decode("utf-8")
@@ -408,11 +529,13 @@ def trigger_ztf(plan_request_id, token, mode):
     endpoint = (
         f"https://{mode}fritz.science/api/observation_plan/{plan_request_id}/queue"
     )
-    response = requests.request("POST", endpoint, headers=headers)
+    response = get_http_client().request("POST", endpoint, headers=headers)
     if response.status_code != 200:
         raise MyException(
             f"Could not trigger - {response.status_code} - {response.text}"
         )
+    # the plan is now submitted to the queue, which later checks need to see
+    get_plan_requests(token, mode).invalidate()
 
 
 def delete_trigger_ztf(plan_request_id, token, mode):
@@ -423,7 +546,7 @@ def delete_trigger_ztf(plan_request_id, token, mode):
     endpoint = (
         f"https://{mode}fritz.science/api/observation_plan/{plan_request_id}/queue"
     )
-    response = requests.request("DELETE", endpoint, headers=headers)
+    response = get_http_client().request("DELETE", endpoint, headers=headers)
     if response.status_code != 200:
         raise MyException(
             f"Could not trigger - {response.status_code} - {response.text}"
@@ -434,6 +557,16 @@ def delete_trigger_ztf(plan_request_id, token, mode):
 
 
 class SkymapCoverage:
+    """
+    How much of a skymap's credible region ZTF observed between startdate and enddate (default
+    the 3 days before the event), weighted by probability and reported per filter.
+
+    The exposures come from the shared nightly ZTFExposures cache, so checks for several
+    events in one night share a single ZTF_ops query. The skymap is read from the skymap
+    cache and mapped to fields with the local ZTF field grid, so Fritz is only asked for
+    the fields if the grid isn't available.
+    """
+
     def __init__(
         self,
         localdateobs,
@@ -443,6 +576,11 @@ class SkymapCoverage:
         fritz_mode,
         kowalski_username,
         kowalski_password,
+        startdate=None,
+        enddate=None,
+        superevent_id=None,
+        skymap_url=None,
+        path_data="data",
     ):
         self.localdateobs = localdateobs
         self.localname = localname
@@ -451,67 +589,34 @@ class SkymapCoverage:
         self.fritz_mode = fritz_mode
         self.kowalski_username = kowalski_username
         self.kowalski_password = kowalski_password
-        self.enddate = Time(self.localdateobs).jd
-        self.startdate = self.enddate - TimeDelta(3, format="jd").value
+        self.enddate = Time(enddate or self.localdateobs).jd
+        if startdate is None:
+            self.startdate = self.enddate - TimeDelta(3, format="jd").value
+        else:
+            self.startdate = Time(startdate).jd
+        if skymap_url is None and superevent_id is not None:
+            skymap_url = f"https://gracedb.ligo.org/api/superevents/{superevent_id}/files/{localname}"
+        self.skymap_url = skymap_url
+        self.path_data = path_data
 
-    def connect_Kowalski(self):
+    def get_ztf_fields_observation(self):
         """
-        Connect to Kowalski using credentials from the config file.
+        ZTF field ids observed in each filter in the time period, e.g. {"g": {..}, "r": {..}}
         """
-
-        protocol = "https"
-        host = "kowalski.caltech.edu"
-        port = 443
-        timeout = 10
-
-        k = Kowalski(
-            protocol=protocol,
-            host=host,
-            port=port,
-            username=self.kowalski_username,
-            password=self.kowalski_password,
-            timeout=timeout,
-            verbose=False,
-        )
-        return k
-
-    def get_ztf_fields_observation(self):
-        k = self.connect_Kowalski()
-        query = {
-            "query_type": "find",
-            "query": {
-                "catalog": "ZTF_ops",
-                "filter": {
-                    "jd_start": {"$gte": self.startdate},
-                    "jd_end": {"$lte": self.enddate},
-                    "exp": {"$gte": 30},
-                    "filter": {"$in": [1, 2]},
-                    "qcomment": {
-                        "$nin": [
-                            "missing_FCD",
-                            "reference_building_g",
-                            "reference_building_r",
-                            "reference_building_i",
-                        ]
-                    },
-                },
-                "projection": {},
-            },
-        }
-
-        response = k.query(query=query, max_n_threads=12).get("default").get("data")
-        fields = [x["field"] for x in response]
-        logmessage = f"found {len(fields)} exposures of {len(list(set(fields)))} unique fields between JD {round(self.startdate)} and {round(self.enddate)}"
+        observed = get_ztf_exposures(
+            self.kowalski_username, self.kowalski_password, self.path_data
+        ).get_observed_fields(self.startdate, self.enddate)
+        logmessage = f"found {len(observed['g'])} g and {len(observed['r'])} r unique fields observed between JD {round(self.startdate)} and {round(self.enddate)}"
         logger.log(logmessage, slack=False)
-        return fields
+        return observed
 
     def get_ztf_fields_skymap(self):
         """
-        get all the ZTF primary field IDs needed to cover a skymap
+        get all the ZTF primary fields needed to cover a skymap, as a list of dicts with field_id, ra and dec
         """
         headers = {"Authorization": f"token {self.fritz_token}"}
         endpoint = f"https://{self.fritz_mode}fritz.science/api/instrument/1?localizationDateobs={self.localdateobs}&localizationName={self.localname}&localizationCumprob={self.localprob}"
-        response = requests.request("GET", endpoint, headers=headers)
+        response = get_http_client().request("GET", endpoint, headers=headers)
         if response.status_code != 200:
             raise Exception(
                 f"API call to ZTF queue failed with status code {response.status_code}. "
@@ -520,22 +625,174 @@ class SkymapCoverage:
         json_string = response.content.decode("utf-8")
         json_data = json.loads(json_string)
         fields = [
-            x["field_id"]
+            x
             for x in json_data["data"]["fields"]
             if x["instrument_id"] == 1 and 220 < x["field_id"] < 880 and x["dec"] > -30
         ]
         return fields
 
-    def get_coverage_fraction(self):
-        observation_fields = self.get_ztf_fields_observation()
-        skymap_fields = self.get_ztf_fields_skymap()
-        skymap_observations = [
-            field for field in skymap_fields if field in observation_fields
-        ]
-        logmessage = f"found {len(skymap_observations)} / {len(skymap_fields)} fields observed in time period"
+    def get_field_coverage(self):
+        """
+        Which skymap pixels each ZTF field covers, from the local field grid if we can load the
+        skymap, else from the fields Fritz lists for the localization
+        """
+        skymap = None
+        if self.skymap_url is not None:
+            try:
+                skymap = get_skymap_cache(self.path_data).get_table(self.skymap_url)
+            except Exception as e:
+                logmessage = f"could not load {self.skymap_url}: {e}"
+                logger.log(logmessage, slack=False)
+        if skymap is not None:
+            try:
+                return get_ztf_field_grid(self.path_data).get_field_coverage(
+                    skymap, self.localprob
+                )
+            except Exception as e:
+                logmessage = f"no local ZTF field grid, asking Fritz for fields: {e}"
+                logger.log(logmessage, slack=False)
+        fields = self.get_ztf_fields_skymap()
+        field_ids = [x["field_id"] for x in fields]
+        if skymap is not None:
+            return FieldCoverage.from_field_centers(
+                skymap,
+                field_ids,
+                [x["ra"] for x in fields],
+                [x["dec"] for x in fields],
+                level=self.localprob,
+            )
+        logmessage = f"weighting the fields of {self.localname} equally"
+        logger.log(logmessage, slack=False)
+        return FieldCoverage.equal_weights(field_ids)
+
+    def get_coverage_fractions(self):
+        """
+        Fraction of the credible region probability observed in g, in r, in both and in either
+        """
+        observed = self.get_ztf_fields_observation()
+        fractions = self.get_field_coverage().get_fractions(observed)
+        logmessage = ", ".join(
+            f"{name}: {fraction:.2f}" for name, fraction in fractions.items()
+        )
+        logmessage = f"coverage of {self.localname} in time period - {logmessage}"
         logger.log(logmessage, slack=False)
-        frac_observed = len(skymap_observations) / len(skymap_fields)
-        return frac_observed
+        return fractions
+
+    @staticmethod
+    def covered_fraction(fractions):
+        """
+        The fraction we count as covered, from the fractions of get_coverage_fractions: the
+        lesser of the g and r coverage, as our plans observe in both filters
+        """
+        return min(fractions["g"], fractions["r"])
+
+    def get_coverage_fraction(self):
+        """
+        Fraction of the credible region probability we count as covered (see covered_fraction)
+        """
+        return self.covered_fraction(self.get_coverage_fractions())
+
+
+class CoverageVerifier:
+    """
+    Coverage of many skymaps, each over its own time period, checked in one pass.
+
+    The exposures for the union of the time periods come from the ZTFExposures cache in one
+    call (so at most one ZTF_ops query), and the fields covering each skymap are kept between
+    calls, so checking the pending observations costs one query and some set lookups however
+    many events are pending. Skymaps not in the latest call are dropped from the cache.
+    """
+
+    def __init__(
+        self,
+        fritz_token,
+        fritz_mode,
+        kowalski_username,
+        kowalski_password,
+        localprob=0.9,
+        path_data="data",
+    ):
+        self.fritz_token = fritz_token
+        self.fritz_mode = fritz_mode
+        self.kowalski_username = kowalski_username
+        self.kowalski_password = kowalski_password
+        self.localprob = localprob
+        self.path_data = path_data
+        self.field_coverages = {}  # (superevent_id, dateobs, skymap name) -> FieldCoverage
+
+    def get_field_coverage(self, superevent_id, dateobs, skymap_name):
+        key = (superevent_id, dateobs, skymap_name)
+        if key not in self.field_coverages:
+            self.field_coverages[key] = SkymapCoverage(
+                dateobs,
+                skymap_name,
+                localprob=self.localprob,
+                fritz_token=self.fritz_token,
+                fritz_mode=self.fritz_mode,
+                kowalski_username=self.kowalski_username,
+                kowalski_password=self.kowalski_password,
+                superevent_id=superevent_id,
+                path_data=self.path_data,
+            ).get_field_coverage()
+        return self.field_coverages[key]
+
+    def verify(self, checks):
+        """
+        Coverage fractions (see SkymapCoverage.get_coverage_fractions) for each check, a
+        (superevent_id, dateobs, skymap name, startdate, enddate) tuple, in order. A check
+        whose skymap fields we couldn't get is None.
+        """
+        if not checks:
+            return []
+        windows = [(Time(x[3]).jd, Time(x[4]).jd) for x in checks]
+        exposures = get_ztf_exposures(
+            self.kowalski_username, self.kowalski_password, self.path_data
+        ).get_exposures(min(w[0] for w in windows), max(w[1] for w in windows))
+        keys = set()
+        results = []
+        for (superevent_id, dateobs, skymap_name, _, _), window in zip(checks, windows):
+            keys.add((superevent_id, dateobs, skymap_name))
+            try:
+                field_coverage = self.get_field_coverage(
+                    superevent_id, dateobs, skymap_name
+                )
+            except Exception as e:
+                logmessage = f"could not get the fields of {skymap_name} for {superevent_id}: {e}"
+                logger.log(logmessage, slack=False)
+                results.append(None)
+                continue
+            fractions = field_coverage.get_fractions(
+                observed_fields(exposures, *window)
+            )
+            logmessage = ", ".join(
+                f"{name}: {fraction:.2f}" for name, fraction in fractions.items()
+            )
+            logmessage = f"coverage of {superevent_id} {skymap_name} between JD {window[0]:.2f} and {window[1]:.2f} - {logmessage}"
+            logger.log(logmessage, slack=False)
+            results.append(fractions)
+        for key in set(self.field_coverages) - keys:
+            del self.field_coverages[key]
+        return results
+
+
+coverage_verifiers = {}
+
+
+def get_coverage_verifier(
+    fritz_token, fritz_mode, kowalski_username, kowalski_password, path_data="data"
+):
+    """
+    One verifier (and its cache of skymap fields) per data directory per process
+    """
+    if path_data not in coverage_verifiers:
+        coverage_verifiers[path_data] = CoverageVerifier(
+            fritz_token,
+            fritz_mode,
+            kowalski_username,
+            kowalski_password,
+            path_data=path_data,
+        )
+    return coverage_verifiers[path_data]
 
 
 """
@@ -554,20 +811,16 @@ def generate_cadence_dates(date):
 
 
 def check_triggered_csv(superevent_id, path_data):
-    df = pd.read_csv(f"{path_data}/trigger_data/triggered_events.csv")
+    """
+    Whether we have a pending trigger for superevent_id, and the plan request id of that trigger
+    """
     # todo: add serendipitious case
-    triggered = (
-        superevent_id in df["superevent_id"].values
-        and df.loc[df["superevent_id"] == superevent_id, "pending_observation"].any()
+    pending = get_trigger_ledger(path_data).observations(
+        superevent_id, status="pending"
     )
-    if triggered:
-        pending = df[df["superevent_id"] == superevent_id][
-            "pending_observation"
-        ].values[0]
-        trigger_plan_id = int(pending.strip("()").split(",")[0])
-    else:
-        trigger_plan_id = None
-    return triggered, trigger_plan_id
+    if pending:
+        return True, pending[0]["plan_request_id"]
+    return False, None
 
 
 def add_triggercsv(
@@ -583,34 +836,17 @@ def add_triggercsv(
     path_data,
 ):
     # FIXME: need better logic for handling update alerts (ie, we dont want cadence to start ~ 2 days late given update alert)
-    # if the event already exists in the log, change "valid" to "false" so we use the new event
-    update_trigger_log(superevent_id, "valid", False, path_data)
-
-    # Create a DataFrame with the new event data
-    new_event = pd.DataFrame(
-        [
-            {
-                "superevent_id": superevent_id,
-                "dateobs": dateobs,
-                "gcn_type": gcn_type,
-                "gcn_id": gcnid,
-                "localization_id": localizationid,
-                "trigger_cadence": str(trigger_cadence),
-                "pending_observation": queued_plan,
-                "unsuccessful_observation": None,
-                "successful_observation": None,
-                "serendipitous_observation": serendipitous_observation,
-                "valid": valid,
-            }
-        ]
-    )
-
-    # Append the new event to the existing CSV file
-    new_event.to_csv(
-        f"{path_data}/trigger_data/triggered_events.csv",
-        mode="a",
-        header=False,
-        index=False,
+    # if the event already exists in the ledger, the new trigger replaces it
+    get_trigger_ledger(path_data).add(
+        superevent_id,
+        dateobs,
+        gcn_type,
+        gcnid,
+        localizationid,
+        trigger_cadence,
+        queued_plan,
+        serendipitous_observation=serendipitous_observation,
+        valid=valid,
     )
 
 
@@ -622,75 +858,50 @@ def update_trigger_log(
     append_string=False,
     remove_string=False,
 ):
-    df = pd.read_csv(f"{path_data}/trigger_data/triggered_events.csv")
-    if append_string:
-        current_value = df.loc[
-            df["superevent_id"] == superevent_id_to_check, column
-        ].values[0]
-        separator = ","
-        if not isinstance(current_value, str):
-            current_value = ""
-            separator = ""
-        df["superevent_id"] = df["superevent_id"].astype("object")
-        df[column] = df[column].astype("object")
-        df.loc[df["superevent_id"] == superevent_id_to_check, column] = (
-            current_value + separator + value
-        )
-    elif remove_string:
-        current_value = df.loc[
-            df["superevent_id"] == superevent_id_to_check, column
-        ].values[0]
-        if not isinstance(current_value, str):
-            raise MyException(
-                f"error removing {value} from {superevent_id_to_check} - not a string"
+    """
+    Set a column of the trigger ledger. For the observation columns, appending "(plan_id,start)"
+    gives that observation the column's status, and removing it marks it removed if it still has that status.
+    """
+    ledger = get_trigger_ledger(path_data)
+    if column not in OBSERVATION_COLUMNS:
+        ledger.update(superevent_id_to_check, column, value)
+        return
+    status = OBSERVATION_COLUMNS[column]
+    for plan_request_id, start_time in parse_observations(value):
+        if remove_string:
+            current = [
+                x
+                for x in ledger.observations(superevent_id_to_check, status=status)
+                if x["plan_request_id"] == plan_request_id
+            ]
+            if current:
+                ledger.set_observation(
+                    superevent_id_to_check, plan_request_id, start_time, "removed"
+                )
+        else:
+            ledger.set_observation(
+                superevent_id_to_check, plan_request_id, start_time, status
             )
-        new_value = (
-            current_value.replace(value + ",", "")
-            .replace("," + value, "")
-            .replace(value, "")
-        )
-        df.loc[df["superevent_id"] == superevent_id_to_check, column] = new_value
-    else:
-        df.loc[df["superevent_id"] == superevent_id_to_check, column] = value
-    df.to_csv(f"{path_data}/trigger_data/triggered_events.csv", index=False)
-
 
-def send_email(sender_email, sender_password, recipient_emails, subject, body):
-    smtp_server = "smtp.gmail.com"
-    smtp_port = 587
 
-    try:
-        # Connect to the SMTP server
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(sender_email, sender_password)
-
-        # Send the email to each recipient
-        for recipient in recipient_emails:
-            # Create the email
-            msg = MIMEMultipart()
-            msg["From"] = sender_email
-            msg["To"] = recipient
-            msg["Subject"] = subject
-            msg.attach(MIMEText(body, "html"))  # Send as HTML
-
-            server.sendmail(sender_email, recipient, msg.as_string())
-
-        logmessage = "Emails sent successfully!"
-        logger.log(logmessage, slack=False)
-    except Exception as e:
-        logmessage = f"Failed to send email: {e}"
-        logger.log(logmessage, slack=False)
-    finally:
-        # Close the SMTP server connection
-        server.quit()
+def send_email(
+    sender_email, sender_password, recipient_emails, subject, body, path_data="data"
+):
+    """
+    Queue an email to all recipients, sent in the background by the outbox worker
+    """
+    get_outbox(path_data).email(
+        sender_email, sender_password, recipient_emails, subject, body
+    )
 
 
-def send_trigger_email(credentials, subject_message, dateobs):
+def send_trigger_email(credentials, subject_message, dateobs, path_data="data"):
     sender_email = credentials["sender_email"]
     sender_password = credentials["sender_app_password"]
     recipient_emails = credentials["recipient_emails"]
     subject = subject_message
     fritz_url = f"https://fritz.science/gcn_events/{dateobs}"
     body = f"<html><body><p>{fritz_url}</p></body></html>"
-    send_email(sender_email, sender_password, recipient_emails, subject, body)
+    send_email(
+        sender_email, sender_password, recipient_emails, subject, body, path_data
+    )
@@ -0,0 +1,463 @@
+import os
+import time
+import threading
+import numpy as np
+import astropy.units as u
+import astropy_healpix as ah
+from penquins import Kowalski
+
+from utils.log import Logger
+from utils.credible_region import CredibleRegions
+
+# set up logger (this one wont send to slack)
+logger = Logger(filename="ztf_coverage")
+
+# ZTF_ops filter ids
+FILTERS = {1: "g", 2: "r"}
+
+# half widths in degrees of the ZTF field of view, in RA and dec at the field center
+FIELD_HALF_WIDTH = (3.75, 3.65)
+
+# the ZTF primary field grid (id, ra, dec, ebv), shipped with the package
+ZTF_FIELDS_PATH = os.path.join(os.path.dirname(__file__), "ZTF_Fields.txt")
+
+# HEALPix level of the pixel -> field index, nside 256 or ~0.05 deg2 pixels
+FIELD_INDEX_LEVEL = 8
+
+
+def field_offsets(ra, dec, field_ra, field_dec):
+    """
+    Offsets in deg of points from field centers, projected onto the plane of the sky at the field center
+    """
+    ra, dec, field_ra, field_dec = (
+        np.radians(x) for x in (ra, dec, field_ra, field_dec)
+    )
+    dra = ra - field_ra
+    cos_c = np.sin(field_dec) * np.sin(dec) + np.cos(field_dec) * np.cos(dec) * np.cos(
+        dra
+    )
+    x = np.cos(dec) * np.sin(dra) / cos_c
+    y = (
+        np.cos(field_dec) * np.sin(dec) - np.sin(field_dec) * np.cos(dec) * np.cos(dra)
+    ) / cos_c
+    # points more than 90 deg away would project back onto the plane
+    behind = cos_c <= 0
+    return np.degrees(np.where(behind, np.inf, x)), np.degrees(
+        np.where(behind, np.inf, y)
+    )
+
+
+def in_field(x, y):
+    """
+    Whether offsets from field_offsets fall inside the field of view
+    """
+    return (np.abs(x) < FIELD_HALF_WIDTH[0]) & (np.abs(y) < FIELD_HALF_WIDTH[1])
+
+
+def night_of(jd):
+    """
+    Nights are numbered so that one Palomar night never spans two numbers (boundary 18:00 UTC)
+    """
+    return np.floor(np.asarray(jd) - 0.25).astype(int)
+
+
+class ZTFExposures:
+    """
+    ZTF science exposures from Kowalski's ZTF_ops catalog, cached by night.
+
+    Each night is fetched at most once - nights that are over are saved to disk, and the
+    current night is kept in memory for ttl seconds - so every coverage check in a process
+    (the trigger, cadence and the flares trigger status check) shares one ZTF_ops query
+    per night. Missing nights are fetched together in a single query.
+    """
+
+    def __init__(
+        self,
+        kowalski_username,
+        kowalski_password,
+        cache_dir="data/ztf_exposures",
+        ttl=600,
+    ):
+        self.kowalski_username = kowalski_username
+        self.kowalski_password = kowalski_password
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.kowalski = None
+        self.nights = {}  # night -> (time fetched, exposures)
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def connect_Kowalski(self):
+        """
+        Connect to Kowalski once and reuse the connection
+        """
+        if self.kowalski is None:
+            self.kowalski = Kowalski(
+                protocol="https",
+                host="kowalski.caltech.edu",
+                port=443,
+                username=self.kowalski_username,
+                password=self.kowalski_password,
+                timeout=10,
+                verbose=False,
+            )
+        return self.kowalski
+
+    def query(self, startdate, enddate):
+        """
+        One ZTF_ops query for every good 30 s+ g/r exposure between two JDs
+        """
+        query = {
+            "query_type": "find",
+            "query": {
+                "catalog": "ZTF_ops",
+                "filter": {
+                    "jd_start": {"$gte": startdate},
+                    "jd_end": {"$lte": enddate},
+                    "exp": {"$gte": 30},
+                    "filter": {"$in": list(FILTERS)},
+                    "qcomment": {
+                        "$nin": [
+                            "missing_FCD",
+                            "reference_building_g",
+                            "reference_building_r",
+                            "reference_building_i",
+                        ]
+                    },
+                },
+                "projection": {"field": 1, "filter": 1, "jd_start": 1, "jd_end": 1},
+            },
+        }
+        response = (
+            self.connect_Kowalski()
+            .query(query=query, max_n_threads=12)
+            .get("default")
+            .get("data")
+        )
+        exposures = np.array(
+            [(x["field"], x["filter"], x["jd_start"], x["jd_end"]) for x in response],
+            dtype=[
+                ("field", int),
+                ("filter", int),
+                ("jd_start", float),
+                ("jd_end", float),
+            ],
+        )
+        logmessage = f"ZTF_ops returned {len(exposures)} exposures between JD {startdate:.2f} and {enddate:.2f}"
+        logger.log(logmessage, slack=False)
+        return exposures
+
+    def night_path(self, night):
+        return os.path.join(self.cache_dir, f"{night}.npy")
+
+    def load_nights(self, nights):
+        now = time.time()
+        current_night = night_of(2440587.5 + now / 86400)
+        missing = []
+        for night in nights:
+            if night in self.nights:
+                fetched, _ = self.nights[night]
+                if night < current_night or now - fetched < self.ttl:
+                    continue
+            elif night < current_night and os.path.exists(self.night_path(night)):
+                self.nights[night] = (now, np.load(self.night_path(night)))
+                continue
+            missing.append(night)
+        if not missing:
+            return
+        exposures = self.query(min(missing) + 0.25, max(missing) + 1.25)
+        exposure_nights = night_of(exposures["jd_start"])
+        for night in missing:
+            night_exposures = exposures[exposure_nights == night]
+            self.nights[night] = (now, night_exposures)
+            if night < current_night:
+                # the night is over so its exposures won't change
+                np.save(self.night_path(night), night_exposures)
+
+    def get_exposures(self, startdate, enddate):
+        """
+        Exposures starting after startdate and ending before enddate (JD), like the ZTF_ops query
+        """
+        nights = range(int(night_of(startdate)), int(night_of(enddate)) + 1)
+        with self.lock:
+            self.load_nights(nights)
+            exposures = np.concatenate([self.nights[night][1] for night in nights])
+        keep = (exposures["jd_start"] >= startdate) & (exposures["jd_end"] <= enddate)
+        return exposures[keep]
+
+    def get_observed_fields(self, startdate, enddate):
+        """
+        Set of field ids observed in each filter between two JDs, e.g. {"g": {..}, "r": {..}}
+        """
+        return observed_fields(self.get_exposures(startdate, enddate))
+
+
+def observed_fields(exposures, startdate=None, enddate=None):
+    """
+    Set of field ids observed in each filter, e.g. {"g": {..}, "r": {..}}, optionally only
+    from the exposures starting after startdate and ending before enddate (JD)
+    """
+    keep = np.ones(len(exposures), dtype=bool)
+    if startdate is not None:
+        keep &= exposures["jd_start"] >= startdate
+    if enddate is not None:
+        keep &= exposures["jd_end"] <= enddate
+    exposures = exposures[keep]
+    return {
+        name: set(exposures["field"][exposures["filter"] == filter_id].tolist())
+        for filter_id, name in FILTERS.items()
+    }
+
+
+ztf_exposures = {}
+
+
+def get_ztf_exposures(kowalski_username, kowalski_password, path_data="data"):
+    """
+    One exposure cache and Kowalski connection per data directory per process
+    """
+    if path_data not in ztf_exposures:
+        ztf_exposures[path_data] = ZTFExposures(
+            kowalski_username,
+            kowalski_password,
+            cache_dir=f"{path_data}/ztf_exposures",
+        )
+    return ztf_exposures[path_data]
+
+
+class FieldCoverage:
+    """
+    Which ZTF fields cover which pixels of a skymap credible region.
+
+    Stored as (pixel, field) pairs, so the probability covered by any set of observed
+    fields is a set lookup over the pairs and a sum - a pixel covered by several fields
+    is only counted once. Each pixel's probability is also assigned to the closest field
+    covering it to give a probability per field. pixel_prob holds every pixel of the
+    credible region, including those no field covers, so fractions are of the whole region.
+    """
+
+    def __init__(self, pixel_prob, pixel_index, pixel_field, pixel_distance=None):
+        self.pixel_prob = np.asarray(pixel_prob)
+        self.pixel_index = np.asarray(pixel_index)
+        self.pixel_field = np.asarray(pixel_field)
+        self.fields = np.unique(self.pixel_field)
+        # the credible region probability, not just the part the grid covers
+        self.total_prob = self.pixel_prob.sum()
+        if pixel_distance is None:
+            pixel_distance = np.zeros(len(self.pixel_index))
+        # closest field for each pixel: sort pairs by distance, keep the first per pixel
+        order = np.lexsort((pixel_distance, self.pixel_index))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = self.pixel_index[order][1:] != self.pixel_index[order][:-1]
+        closest = order[first]
+        probs = np.zeros(len(self.fields))
+        np.add.at(
+            probs,
+            np.searchsorted(self.fields, self.pixel_field[closest]),
+            self.pixel_prob[self.pixel_index[closest]],
+        )
+        self.field_prob = dict(zip(self.fields.tolist(), probs.tolist()))
+
+    @classmethod
+    def from_field_centers(cls, skymap, field_ids, ra, dec, level=0.9):
+        """
+        Coverage of the level credible region by fields with the given centers (deg)
+        """
+        regions = CredibleRegions(skymap)
+        rows = regions.get_pixels(level)
+        order, ipix = ah.uniq_to_level_ipix(regions.uniq[rows])
+        lon, lat = ah.healpix_to_lonlat(ipix, ah.level_to_nside(order), order="nested")
+        x, y = field_offsets(
+            lon.to_value(u.deg)[:, None],
+            lat.to_value(u.deg)[:, None],
+            np.asarray(ra)[None, :],
+            np.asarray(dec)[None, :],
+        )
+        pixel_index, field_index = np.nonzero(in_field(x, y))
+        return cls(
+            regions.prob[rows],
+            pixel_index,
+            np.asarray(field_ids)[field_index],
+            np.hypot(x, y)[pixel_index, field_index],
+        )
+
+    @classmethod
+    def equal_weights(cls, field_ids):
+        """
+        Every field weighted equally, for when we don't have the skymap
+        """
+        field_ids = np.asarray(field_ids)
+        return cls(np.ones(len(field_ids)), np.arange(len(field_ids)), field_ids)
+
+    def get_fraction(self, observed_fields):
+        """
+        Fraction of the credible region probability in pixels covered by any of observed_fields
+        """
+        if self.total_prob == 0:
+            return 0.0
+        observed = np.isin(self.pixel_field, list(observed_fields))
+        covered = np.unique(self.pixel_index[observed])
+        return float(self.pixel_prob[covered].sum() / self.total_prob)
+
+    def get_fractions(self, observed):
+        """
+        Coverage fraction for each filter, for g and r together ("both") and for either ("any")
+        given the observed field sets of ZTFExposures.get_observed_fields
+        """
+        fractions = {
+            name: self.get_fraction(fields) for name, fields in observed.items()
+        }
+        fractions["both"] = self.get_fraction(set.intersection(*observed.values()))
+        fractions["any"] = self.get_fraction(set.union(*observed.values()))
+        return fractions
+
+
+class ZTFFieldGrid:
+    """
+    The ZTF primary field grid and which fields cover each HEALPix pixel.
+
+    The grid is read from the copy shipped next to this module, and the pixel -> field
+    index is built from it at a fixed HEALPix level and saved to data/ztf_fields, so mapping
+    a skymap's credible region to fields is a lookup with no call to Fritz or download. Only
+    primary grid fields the queue uses are kept (220 < field id < 880 and dec > -30), as in
+    SkymapCoverage.
+    """
+
+    def __init__(
+        self,
+        path="data/ztf_fields",
+        fields_path=ZTF_FIELDS_PATH,
+        level=FIELD_INDEX_LEVEL,
+        min_field=220,
+        max_field=880,
+        min_dec=-30,
+    ):
+        self.fields_path = fields_path
+        self.index_path = f"{path}/field_index_{level}.npz"
+        self.level = level
+        os.makedirs(path, exist_ok=True)
+        field_id, ra, dec = self.load_fields()
+        keep = (field_id > min_field) & (field_id < max_field) & (dec > min_dec)
+        self.field_id = field_id[keep]
+        self.ra = ra[keep]
+        self.dec = dec[keep]
+        self.offsets, self.fields, self.distances = self.load_index()
+
+    def load_fields(self):
+        """
+        Field ids and centers (deg) of the whole ZTF primary grid
+        """
+        grid = np.loadtxt(self.fields_path, usecols=(0, 1, 2), ndmin=2)
+        return grid[:, 0].astype(int), grid[:, 1], grid[:, 2]
+
+    def build_index(self):
+        """
+        Fields covering each pixel, as offsets into flat arrays of field ids and distances
+        from the field center (deg) - the fields of pixel i are fields[offsets[i]:offsets[i + 1]]
+        """
+        nside = ah.level_to_nside(self.level)
+        healpix = ah.HEALPix(nside=nside, order="nested")
+        radius = np.hypot(*FIELD_HALF_WIDTH) + 2 * healpix.pixel_resolution.to_value(
+            u.deg
+        )
+        pixels, fields, distances = [], [], []
+        for field_id, ra, dec in zip(self.field_id, self.ra, self.dec):
+            ipix = healpix.cone_search_lonlat(ra * u.deg, dec * u.deg, radius * u.deg)
+            lon, lat = healpix.healpix_to_lonlat(ipix)
+            x, y = field_offsets(lon.to_value(u.deg), lat.to_value(u.deg), ra, dec)
+            inside = in_field(x, y)
+            pixels.append(ipix[inside])
+            fields.append(np.full(inside.sum(), field_id))
+            distances.append(np.hypot(x, y)[inside])
+        pixels = np.concatenate(pixels)
+        order = np.argsort(pixels, kind="stable")
+        counts = np.bincount(pixels, minlength=healpix.npix)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        return (
+            offsets.astype(np.int64),
+            np.concatenate(fields)[order].astype(np.int32),
+            np.concatenate(distances)[order].astype(np.float32),
+        )
+
+    def load_index(self):
+        if os.path.exists(self.index_path):
+            saved = np.load(self.index_path)
+            if np.array_equal(saved["field_id"], self.field_id):
+                return saved["offsets"], saved["fields"], saved["distances"]
+        offsets, fields, distances = self.build_index()
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_path,
+            field_id=self.field_id,
+            offsets=offsets,
+            fields=fields,
+            distances=distances,
+        )
+        os.replace(tmp_path, self.index_path)
+        logmessage = f"saved ZTF field index of {len(self.field_id)} fields at HEALPix level {self.level} to {self.index_path}"
+        logger.log(logmessage, slack=False)
+        return offsets, fields, distances
+
+    def get_index_pixels(self, skymap, level=0.9):
+        """
+        Pixels at the index level in the credible region of a multiorder skymap, and the
+        probability in each. Coarser skymap pixels are split evenly between their children,
+        finer ones added to their parent.
+        """
+        regions = CredibleRegions(skymap)
+        rows = regions.get_pixels(level)
+        order, ipix = ah.uniq_to_level_ipix(regions.uniq[rows])
+        prob = regions.prob[rows]
+        shift = 2 * (self.level - order)
+        coarse = shift >= 0
+        # each coarse pixel becomes the 4**shift pixels starting at ipix << shift
+        num_children = np.where(coarse, 1 << np.where(coarse, shift, 0), 1)
+        first = np.where(
+            coarse,
+            ipix << np.where(coarse, shift, 0),
+            ipix >> np.where(coarse, 0, -shift),
+        )
+        parent = np.repeat(np.arange(len(ipix)), num_children)
+        start = np.concatenate([[0], np.cumsum(num_children)[:-1]])
+        pixels = first[parent] + np.arange(len(parent)) - start[parent]
+        pixels, inverse = np.unique(pixels, return_inverse=True)
+        probs = np.bincount(
+            inverse, weights=(prob / num_children)[parent], minlength=len(pixels)
+        )
+        return pixels, probs
+
+    def get_field_coverage(self, skymap, level=0.9):
+        """
+        FieldCoverage of the level credible region of a multiorder skymap by the primary grid
+        """
+        pixels, probs = self.get_index_pixels(skymap, level)
+        counts = self.offsets[pixels + 1] - self.offsets[pixels]
+        pixel_index = np.repeat(np.arange(len(pixels)), counts)
+        # position of each (pixel, field) pair in the flat index arrays
+        start = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        pairs = (
+            self.offsets[pixels][pixel_index]
+            + np.arange(len(pixel_index))
+            - start[pixel_index]
+        )
+        return FieldCoverage(
+            probs, pixel_index, self.fields[pairs], self.distances[pairs]
+        )
+
+    def get_field_probabilities(self, skymap, level=0.9):
+        """
+        Field ids covering the credible region, each with the probability closest to that field
+        """
+        return self.get_field_coverage(skymap, level).field_prob
+
+
+ztf_field_grids = {}
+
+
+def get_ztf_field_grid(path_data="data"):
+    """
+    One field grid and index per data directory per process
+    """
+    if path_data not in ztf_field_grids:
+        ztf_field_grids[path_data] = ZTFFieldGrid(path=f"{path_data}/ztf_fields")
+    return ztf_field_grids[path_data]
@@ -0,0 +1,116 @@
+import os
+import numpy as np
+import astropy.units as u
+import astropy.cosmology as cos
+from astropy.cosmology import Planck15 as cosmo
+
+from utils.log import Logger
+
+# set up logger (this one wont send to slack)
+logger = Logger(filename="cosmology")
+
+
+class DistanceRedshiftTable:
+    """
+    Planck15 luminosity distance -> redshift by interpolating a dense, monotone table.
+
+    The table is built once and saved to disk. On build it is checked against the exact
+    distance at the midpoint of every grid interval (where linear interpolation is worst)
+    and against z_at_value, and we refuse to use it if the error is above max_error.
+    """
+
+    def __init__(
+        self,
+        path="data/cosmology/planck15_dl_z.npz",
+        zmax=10.0,
+        num_points=20000,
+        max_error=1e-6,
+    ):
+        self.path = path
+        self.zmax = zmax
+        self.num_points = num_points
+        self.max_error = max_error
+        self.z, self.dl = self.load()
+
+    def build(self):
+        # uniform in log(1+z), so the grid is densest at low z where most events are
+        z = np.expm1(np.linspace(0, np.log1p(self.zmax), self.num_points))
+        dl = cosmo.luminosity_distance(z).to_value(u.Mpc)
+        if not np.all(np.diff(dl) > 0):
+            raise ValueError("luminosity distance table is not monotone")
+        return z, dl
+
+    def validate(self, z, dl):
+        z_mid = 0.5 * (z[1:] + z[:-1])
+        dl_mid = cosmo.luminosity_distance(z_mid).to_value(u.Mpc)
+        error = np.max(np.abs(np.interp(dl_mid, dl, z) - z_mid))
+        # spot check against the root finder we are replacing
+        dl_check = np.geomspace(1, dl[-1] / 2, 20)
+        z_check = cos.z_at_value(
+            cosmo.luminosity_distance, dl_check * u.Mpc, method="bounded"
+        ).value
+        error = max(error, np.max(np.abs(np.interp(dl_check, dl, z) - z_check)))
+        if error > self.max_error:
+            raise ValueError(
+                f"distance-redshift table error {error} is larger than {self.max_error}"
+            )
+        return error
+
+    def load(self):
+        if os.path.exists(self.path):
+            saved = np.load(self.path)
+            if (
+                saved["zmax"] == self.zmax
+                and saved["num_points"] == self.num_points
+                and saved["max_error"] <= self.max_error
+            ):
+                return saved["z"], saved["dl"]
+        z, dl = self.build()
+        error = self.validate(z, dl)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        np.savez(
+            self.path,
+            z=z,
+            dl=dl,
+            zmax=self.zmax,
+            num_points=self.num_points,
+            max_error=error,
+        )
+        logmessage = (
+            f"saved distance-redshift table to {self.path} with max error {error:.1e}"
+        )
+        logger.log(logmessage, slack=False)
+        return z, dl
+
+    def z_at_distance(self, distance):
+        """
+        Redshift for luminosity distance(s) in Mpc - accepts scalars or arrays
+        """
+        distance = np.asarray(distance, dtype=float)
+        if np.any(distance < 0) or np.any(distance > self.dl[-1]):
+            raise ValueError(
+                f"luminosity distance must be between 0 and {self.dl[-1]:.0f} Mpc"
+            )
+        z = np.interp(distance, self.dl, self.z)
+        return z if z.ndim else float(z)
+
+
+distance_redshift_tables = {}
+
+
+def get_distance_redshift_table(path_data="data"):
+    """
+    One table per data directory per process
+    """
+    if path_data not in distance_redshift_tables:
+        distance_redshift_tables[path_data] = DistanceRedshiftTable(
+            path=f"{path_data}/cosmology/planck15_dl_z.npz"
+        )
+    return distance_redshift_tables[path_data]
+
+
+def z_at_luminosity_distance(distance, path_data="data"):
+    """
+    Drop in for z_at_value(cosmo.luminosity_distance, distance * u.Mpc) with distance in Mpc
+    """
+    return get_distance_redshift_table(path_data).z_at_distance(distance)
@@ -0,0 +1,72 @@
+import numpy as np
+import astropy.units as u
+import astropy_healpix as ah
+
+
+class CredibleRegions:
+    """
+    Credible regions of a multiorder skymap.
+
+    Pixel areas and the probability ordering are computed once, then any number of
+    credible levels are answered with a single searchsorted. The input table is not
+    modified - all indices refer to rows of the table as passed in.
+    """
+
+    def __init__(self, skymap):
+        self.uniq = np.asarray(skymap["UNIQ"])
+        self.probdensity = np.asarray(skymap["PROBDENSITY"])
+        level, ipix = ah.uniq_to_level_ipix(self.uniq)
+        pixel_area = ah.nside_to_pixel_area(ah.level_to_nside(level))
+        self.pixel_area = pixel_area.to_value(u.deg**2)
+        self.prob = pixel_area.to_value(u.sr) * self.probdensity
+        # same ordering as Table.sort("PROBDENSITY", reverse=True)
+        self.order = np.argsort(self.probdensity, kind="stable")[::-1]
+        self.cumprob = np.cumsum(self.prob[self.order])
+        self.cumarea = np.cumsum(self.pixel_area[self.order])
+
+    @property
+    def credible_levels(self):
+        """
+        Cumulative probability of each pixel (in table row order), as in find_greedy_credible_levels
+        """
+        levels = np.empty_like(self.cumprob)
+        levels[self.order] = self.cumprob
+        return levels
+
+    def get_index(self, levels):
+        """
+        Number of most probable pixels in each credible region
+        """
+        return self.cumprob.searchsorted(np.atleast_1d(levels))
+
+    def get_areas(self, levels):
+        """
+        Area in deg2 of each credible region in levels, e.g. [0.5, 0.9, 0.95]
+        """
+        i = self.get_index(levels)
+        cumarea = np.concatenate([[0.0], self.cumarea])
+        return cumarea[i]
+
+    def get_area(self, level):
+        return self.get_areas([level])[0]
+
+    def get_pixels(self, level):
+        """
+        Row indices of the pixels in the credible region, most probable first
+        """
+        return self.order[: self.get_index(level)[0]]
+
+    def get_regions(self, levels):
+        """
+        Area, pixel rows and UNIQ ids for each credible level
+        """
+        index = self.get_index(levels)
+        areas = np.concatenate([[0.0], self.cumarea])[index]
+        return {
+            level: {
+                "area": area,
+                "rows": self.order[:i],
+                "uniq": self.uniq[self.order[:i]],
+            }
+            for level, area, i in zip(np.atleast_1d(levels), areas, index)
+        }
@@ -0,0 +1,182 @@
+import os
+import time as systime
+import numpy as np
+import astropy.units as u
+from astropy.time import Time
+from astropy.coordinates import EarthLocation
+from astropy.utils.masked import Masked
+from astroplan import Observer
+
+from utils.log import Logger
+
+# set up logger (this one wont send to slack)
+logger = Logger(filename="ephemeris")
+
+UNIX_EPOCH_JD = 2440587.5
+
+# Palomar, used for every sunset and sunrise calculation
+PALOMAR = {"lat": 33.3564, "lon": -116.865, "height": 1712}
+
+# name -> the astroplan Observer method giving the next time of that event
+EVENTS = {
+    "sunset": lambda observer, t: observer.sun_set_time(t, which="next"),
+    "sunrise": lambda observer, t: observer.sun_rise_time(t, which="next"),
+    "evening_twilight": lambda observer, t: observer.twilight_evening_astronomical(
+        t, which="next"
+    ),
+    "morning_twilight": lambda observer, t: observer.twilight_morning_astronomical(
+        t, which="next"
+    ),
+}
+
+
+def event_jd(name, observer, t):
+    """
+    UTC julian dates of the next event after each time in t, NaN where astroplan finds none
+    (it misses an event falling within seconds of t, which the next day's solve picks up)
+    """
+    jd = EVENTS[name](observer, t).utc.jd
+    if isinstance(jd, Masked):
+        jd = jd.filled(np.nan)
+    return np.asarray(jd, dtype=float)
+
+
+class NightEphemeris:
+    """
+    Sunset, sunrise and astronomical twilight at Palomar for each night of the coming year.
+
+    The times are solved for with astroplan once, saved to disk as sorted arrays of UTC
+    julian dates, and looked up with a binary search. The table is rebuilt when fewer than
+    min_remaining days of it are left. If a new table fails its spot checks it isn't used,
+    and every lookup is solved with astroplan directly instead.
+    """
+
+    def __init__(
+        self,
+        path="data/ephemeris/palomar_nights.npz",
+        days=366,
+        min_remaining=30,
+        max_error=60,
+    ):
+        self.path = path
+        self.days = days
+        self.min_remaining = min_remaining
+        self.max_error = max_error  # seconds
+        self.observer = Observer(
+            location=EarthLocation(
+                lat=PALOMAR["lat"], lon=PALOMAR["lon"], height=PALOMAR["height"]
+            ),
+            timezone="US/Pacific",
+        )
+        self.times = self.load()
+
+    def build(self, start):
+        # one solve a day finds every event, the day before start covers an event in progress
+        t = start - 1 * u.day + np.arange(self.days + 1) * u.day
+        times = {}
+        for name in EVENTS:
+            jd = event_jd(name, self.observer, t)
+            times[name] = np.unique(jd[np.isfinite(jd)])
+        return times
+
+    def validate(self, times, start, num_checks=5):
+        """
+        Spot check lookups against solving with astroplan directly, on nights spread evenly
+        through the table so the checks are the same every time
+        """
+        error = 0
+        for jd in start.jd + np.linspace(0.5, self.days - 1.5, num_checks):
+            t = Time(jd, format="jd")
+            for name in EVENTS:
+                exact = event_jd(name, self.observer, t)
+                if not np.isfinite(exact):
+                    continue
+                lookup = times[name][np.searchsorted(times[name], jd, side="right")]
+                error = max(error, abs(lookup - exact) * 86400)
+        if error > self.max_error:
+            raise ValueError(
+                f"night ephemeris error {error:.0f} s is larger than {self.max_error} s"
+            )
+        return error
+
+    def load(self):
+        now = Time.now()
+        if os.path.exists(self.path):
+            saved = np.load(self.path)
+            if (
+                np.allclose(saved["location"], list(PALOMAR.values()))
+                and saved["sunset"][-1] - now.jd > self.min_remaining
+                and saved["sunset"][0] < now.jd
+            ):
+                return {name: saved[name] for name in EVENTS}
+        times = self.build(now)
+        try:
+            error = self.validate(times, now)
+        except ValueError as e:
+            logmessage = f"not using the night ephemeris table, solving with astroplan instead: {e}"
+            logger.log(logmessage, slack=False)
+            return None
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        np.savez(self.path, location=list(PALOMAR.values()), **times)
+        logmessage = f"saved {self.days} day night ephemeris to {self.path} with max error {error:.1f} s"
+        logger.log(logmessage, slack=False)
+        return times
+
+    @staticmethod
+    def to_jd(time=None):
+        """
+        UTC julian date of time, or of now - without making an astropy Time for now
+        """
+        if time is None:
+            return UNIX_EPOCH_JD + systime.time() / 86400
+        return Time(time).utc.jd
+
+    def next_event_jd(self, name, jd):
+        if (
+            self.times is not None
+            and self.times["sunset"][-1] - self.to_jd() < self.min_remaining
+        ):
+            # a long running process has used up the table
+            self.times = self.load()
+        if self.times is None:
+            return float(event_jd(name, self.observer, Time(jd, format="jd")))
+        events = self.times[name]
+        i = np.searchsorted(events, jd, side="right")
+        if i == 0 or i == len(events):
+            # outside the table, e.g. an old event - solve directly
+            return float(event_jd(name, self.observer, Time(jd, format="jd")))
+        return events[i]
+
+    def next_event(self, name, time=None):
+        """
+        Time of the next sunset, sunrise, evening_twilight or morning_twilight after time (default now)
+        """
+        jd = self.next_event_jd(name, self.to_jd(time))
+        return Time(jd, format="jd", scale="utc")
+
+    def next_sunset(self, time=None):
+        return self.next_event("sunset", time)
+
+    def next_sunrise(self, time=None):
+        return self.next_event("sunrise", time)
+
+    def is_night(self, time=None):
+        """
+        Whether the sun is down at Palomar - the next sunrise comes before the next sunset
+        """
+        jd = self.to_jd(time)
+        return self.next_event_jd("sunrise", jd) < self.next_event_jd("sunset", jd)
+
+
+night_ephemerides = {}
+
+
+def get_night_ephemeris(path_data="data"):
+    """
+    One table per data directory per process
+    """
+    if path_data not in night_ephemerides:
+        night_ephemerides[path_data] = NightEphemeris(
+            path=f"{path_data}/ephemeris/palomar_nights.npz"
+        )
+    return night_ephemerides[path_data]
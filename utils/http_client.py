@@ -0,0 +1,173 @@
+import re
+import time
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HttpClient:
+    """
+    Shared HTTP client for Fritz, GraceDB, ZFPS, Slack and anything else we call.
+
+    There is one requests.Session per host, so connections are kept alive and reused
+    rather than paying for a new TLS handshake on every request. Every request gets a
+    default timeout, and idempotent requests are retried with exponential backoff on
+    connection errors and on 429/5xx responses (a POST is only retried if it could not
+    connect). The latency and bytes received are recorded for each endpoint, both since
+    the process started and since the last log_summary.
+    """
+
+    def __init__(
+        self,
+        timeout=(10, 120),
+        retries=3,
+        backoff_factor=1,
+        status_forcelist=(429, 500, 502, 503, 504),
+        pool_maxsize=20,
+    ):
+        self.timeout = timeout  # (connect, read) seconds
+        self.retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=status_forcelist,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        self.pool_maxsize = pool_maxsize
+        self.sessions = {}
+        self.stats = {}
+        self.recent = {}
+        self.last_summary = time.time()
+        self.lock = threading.Lock()
+
+    def session(self, url):
+        """
+        The session for the host of url, created on first use
+        """
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    max_retries=self.retry,
+                    pool_connections=1,
+                    pool_maxsize=self.pool_maxsize,
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    @staticmethod
+    def endpoint(method, url):
+        """
+        Name to group requests by, with ids in the path replaced by * e.g. GET fritz.science/api/gcn_event/*
+        """
+        parts = urlsplit(url)
+        path = "/".join(
+            "*" if re.search(r"\d", segment) else segment
+            for segment in parts.path.split("/")
+        )
+        return f"{method.upper()} {parts.netloc}{path}"
+
+    def request(self, method, url, **kwargs):
+        """
+        Same arguments and return value as requests.request
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.perf_counter()
+        try:
+            response = self.session(url).request(method, url, **kwargs)
+        except requests.RequestException:
+            self.record(method, url, time.perf_counter() - start, 0, error=True)
+            raise
+        if kwargs.get("stream"):
+            num_bytes = int(response.headers.get("Content-Length", 0))
+        else:
+            num_bytes = len(response.content)
+        self.record(
+            method,
+            url,
+            time.perf_counter() - start,
+            num_bytes,
+            error=response.status_code >= 400,
+        )
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def record(self, method, url, seconds, num_bytes, error=False):
+        endpoint = self.endpoint(method, url)
+        with self.lock:
+            for totals in (self.stats, self.recent):
+                stats = totals.setdefault(
+                    endpoint,
+                    {
+                        "requests": 0,
+                        "errors": 0,
+                        "seconds": 0.0,
+                        "max_seconds": 0.0,
+                        "bytes": 0,
+                    },
+                )
+                stats["requests"] += 1
+                stats["errors"] += int(error)
+                stats["seconds"] += seconds
+                stats["max_seconds"] = max(stats["max_seconds"], seconds)
+                stats["bytes"] += num_bytes
+
+    @staticmethod
+    def format_stats(stats):
+        return [
+            f"{endpoint}: {s['requests']} requests, {s['errors']} errors, "
+            f"mean {s['seconds'] / s['requests']:.2f} s, max {s['max_seconds']:.2f} s, "
+            f"{s['bytes'] / 1e6:.2f} MB"
+            for endpoint, s in sorted(stats.items())
+        ]
+
+    def summary(self):
+        """
+        One line per endpoint with the number of requests, errors, mean and max latency, and
+        bytes received since the process started
+        """
+        with self.lock:
+            stats = {k: dict(v) for k, v in self.stats.items()}
+        return self.format_stats(stats)
+
+    def log_summary(self, logger, interval=None):
+        """
+        Log the requests made since the last summary, and start a new one. With interval,
+        only if the last summary was at least interval s ago, so a long running process
+        can call this often.
+        """
+        now = time.time()
+        with self.lock:
+            if interval is not None and now - self.last_summary < interval:
+                return
+            stats, self.recent = self.recent, {}
+            minutes = (now - self.last_summary) / 60
+            self.last_summary = now
+        if not stats:
+            return
+        logger.log(f"HTTP requests in the last {minutes:.0f} min:", slack=False)
+        for line in self.format_stats(stats):
+            logger.log(line, slack=False)
+
+
+http_client = HttpClient()
+
+
+def get_http_client():
+    """
+    One client, and so one connection pool per host, per process
+    """
+    return http_client
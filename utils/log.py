@@ -1,37 +1,210 @@
 import datetime
 import time
 import os
-import requests
+import queue
+import atexit
+import threading
 import subprocess
 
+
 # TODO: move email function here
-# TODO: more sophisticated log level: debug, info, warning, error, critical to set once when running codebase
+
+DEBUG, INFO, WARNING, ERROR, CRITICAL = 10, 20, 30, 40, 50
+LEVEL_NAMES = {
+    DEBUG: "DEBUG",
+    INFO: "INFO",
+    WARNING: "WARNING",
+    ERROR: "ERROR",
+    CRITICAL: "CRITICAL",
+}
+
+# messages below this level are dropped, set once for the run with set_log_level
+log_level = {name: level for level, name in LEVEL_NAMES.items()}.get(
+    os.environ.get("BBHBOT_LOG_LEVEL", "INFO").upper(), INFO
+)
+
+# slack allows about one message per second per webhook, and up to 40k characters
+SLACK_INTERVAL = 1.0
+SLACK_MAX_CHARS = 3000
+
+
+def set_log_level(level):
+    """
+    Minimum level logged by every Logger, e.g. set_log_level(WARNING) for a quiet run
+    """
+    global log_level
+    log_level = level
+
+
+class LogWriter:
+    """
+    Background thread that writes the log lines of every Logger in the process.
+
+    Logger.log only puts the line on a queue. The thread takes everything queued each
+    time it wakes, so a burst of messages is one write and one flush to the daily log
+    file, which stays open until the date changes. Slack log messages are coalesced per
+    webhook into at most one post every SLACK_INTERVAL s and passed to the outbox.
+    """
+
+    def __init__(self, log_dir="data/logs"):
+        self.log_dir = log_dir
+        self.queue = queue.SimpleQueue()
+        self.file = None
+        self.date = None
+        self.slack = {}  # webhook url -> messages waiting to be posted
+        self.slack_posted = {}  # webhook url -> time of the last post
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self.run, name="log_writer", daemon=True
+                )
+                self.thread.start()
+
+    def write(self, date, line, console=True):
+        self.queue.put(("log", date, line, console))
+        self.start()
+
+    def post_slack(self, webhook_url, message):
+        self.queue.put(("slack", webhook_url, message))
+        self.start()
+
+    def flush(self, timeout=10):
+        """
+        Wait for everything queued so far to be written
+        """
+        if self.thread is None or not self.thread.is_alive():
+            return
+        done = threading.Event()
+        self.queue.put(("flush", done))
+        done.wait(timeout)
+
+    def run(self):
+        while True:
+            try:
+                items = [self.queue.get(timeout=self.slack_wait())]
+            except queue.Empty:
+                items = []
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            flushed = []
+            lines = {}
+            for item in items:
+                if item[0] == "log":
+                    _, date, line, console = item
+                    lines.setdefault(date, []).append(line)
+                    if console:
+                        print(line)
+                elif item[0] == "slack":
+                    self.slack.setdefault(item[1], []).append(item[2])
+                else:
+                    flushed.append(item[1])
+            try:
+                for date, date_lines in lines.items():
+                    self.write_lines(date, date_lines)
+            except OSError as e:
+                print(f"Error writing to the log file: {e}")
+            self.send_slack(force=bool(flushed))
+            for done in flushed:
+                done.set()
+
+    def write_lines(self, date, lines):
+        if date != self.date or self.file is None:
+            if self.file is not None:
+                self.file.close()
+            os.makedirs(self.log_dir, exist_ok=True)
+            self.file = open(os.path.join(self.log_dir, f"bbhbot_{date}.log"), "a")
+            self.date = date
+        self.file.write("".join(f"{line}\n" for line in lines))
+        self.file.flush()
+
+    def slack_wait(self):
+        """
+        Seconds until the next coalesced slack post is due, or None if there are none
+        """
+        if not self.slack:
+            return None
+        now = time.time()
+        return max(
+            0,
+            min(self.slack_posted.get(url, 0) + SLACK_INTERVAL for url in self.slack)
+            - now,
+        )
+
+    def send_slack(self, force=False):
+        # imported here as the outbox logs with Logger
+        from utils.outbox import get_outbox
+
+        now = time.time()
+        for url in list(self.slack):
+            if not force and now < self.slack_posted.get(url, 0) + SLACK_INTERVAL:
+                continue
+            messages = self.slack.pop(url)
+            # join what has built up into as few posts as slack allows
+            post = ""
+            for message in messages:
+                if post and len(post) + len(message) > SLACK_MAX_CHARS:
+                    self.outbox_slack(get_outbox, url, post)
+                    post = ""
+                post += message
+            self.outbox_slack(get_outbox, url, post)
+            self.slack_posted[url] = now
+
+    @staticmethod
+    def outbox_slack(get_outbox, url, message):
+        try:
+            get_outbox().slack(url, message)
+        except Exception as e:
+            print(f"Error sending log message to Slack: {e}")
+            print("Message was:", message)
+
+
+log_writers = {}
+
+
+def get_log_writer(log_dir="data/logs"):
+    """
+    One writer thread per log directory per process, flushed when the process exits
+    """
+    if log_dir not in log_writers:
+        log_writers[log_dir] = LogWriter(log_dir)
+        atexit.register(log_writers[log_dir].flush)
+    return log_writers[log_dir]
 
 
 class Logger:
-    def __init__(self, webhook_url=None, filename=None):
+    """
+    Writes timestamped messages to stdout and data/logs/bbhbot_{date}.log, and optionally
+    to slack. Messages are handed to the shared LogWriter thread, so log() doesn't wait on
+    the file or slack. level is the minimum level logged, by default the global log_level.
+    """
+
+    def __init__(self, webhook_url=None, filename=None, level=None):
         self.LOG_DIR = "data/logs"
         self.verbose = True
         self.webhook_url = webhook_url
         self.filename = filename
+        self.level = level
 
     def send_slack(self, message: str):
         """
-        Send a slack message
+        Queue a slack message, which the outbox worker posts in the background
         :param message: message to send
         :return: None
         """
-        message_payload = {"text": message}
-        try:
-            response = requests.post(self.webhook_url, json=message_payload)
-            if response.status_code == 200:
-                print("Message was sent successfully to slack")
-            else:
-                print(
-                    "Message was not sent to slack, status_code:", response.status_code
-                )
-        except Exception as e:
-            print("An exception occurred while sending a slack message", e)
+        # imported here as the outbox logs with this Logger
+        from utils.outbox import get_outbox
+
+        if not self.webhook_url:
+            print("No slack webhook, message not sent:", message)
+            return
+        get_outbox().slack(self.webhook_url, message)
 
     def chirp_slack_message(
         self, masstoshare, url, id, mass, prob, plot=None, alert=None
@@ -74,27 +247,33 @@ class Logger:
         """
         return datetime.datetime.utcnow().strftime("%Y%m%d_%H:%M:%S")
 
-    def log(self, message, slack=True):
-        # TODO: issue with multiple scripts logging to same file? - unlikely with our frequency
-        if self.verbose:
-            timestamp = self.time_stamp()
-            print(f"{timestamp}: {message}")
+    def log(self, message, slack=True, level=INFO):
+        if level < (log_level if self.level is None else self.level):
+            return
+        timestamp = self.time_stamp()
+        if level != INFO:
+            message = f"{LEVEL_NAMES.get(level, level)}: {message}"
+        line = f"{timestamp}: {message}"
+        writer = get_log_writer(self.LOG_DIR)
+        writer.write(timestamp.split("_")[0], line, console=self.verbose)
 
-        if not os.path.isdir(self.LOG_DIR):
-            os.makedirs(self.LOG_DIR, exist_ok=True)
+        # send log message to slack, coalesced with any others logged around the same time
+        if slack:
+            if self.webhook_url:
+                if self.filename:
+                    line = f"{self.filename:} {line}"
+                writer.post_slack(self.webhook_url, f"{line}\n")
+            else:
+                print("No slack webhook, message not sent:", line)
 
-        date = timestamp.split("_")[0]
-        with open(os.path.join(self.LOG_DIR, f"bbhbot_{date}.log"), "a") as logfile:
-            logfile.write(f"{timestamp}: {message}\n")
-            logfile.flush()
+    def debug(self, message):
+        self.log(message, slack=False, level=DEBUG)
 
-        # send log message to slack
-        if slack:
-            try:
-                self.log_slack_message(f"{timestamp}: {message}\n")
-            except Exception as e:
-                print(f"Error sending log message to Slack: {e}")
-                print("Message was:", f"{timestamp}: {message}\n")
+    def warning(self, message, slack=False):
+        self.log(message, slack=slack, level=WARNING)
+
+    def error(self, message, slack=True):
+        self.log(message, slack=slack, level=ERROR)
 
     def heartbeat(self):
         """
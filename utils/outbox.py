@@ -0,0 +1,408 @@
+import os
+import json
+import time
+import uuid
+import atexit
+import sqlite3
+import smtplib
+import threading
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from utils.log import Logger, log_writers
+from utils.http_client import get_http_client
+
+# set up logger (this one wont send to slack)
+logger = Logger(filename="outbox")
+
+# slack answers these for a bad webhook or payload, which retrying won't fix
+SLACK_PERMANENT_ERRORS = (400, 403, 404, 410)
+
+
+class MyException(Exception):
+    pass
+
+
+class Outbox:
+    """
+    Durable queue of emails and Slack messages, delivered by a background worker thread.
+
+    Sending a notification is an insert into a SQLite table, so a slow SMTP server or Slack
+    webhook never holds up the caller. The worker keeps one SMTP connection open between
+    emails (closed after idle_timeout s without any), sends each email to all recipients
+    in one envelope, and retries failures with exponential backoff up to max_attempts.
+    Notifications left over from a process that exited are sent by the next one to start
+    the worker. SMTP passwords are only kept in memory, so an email queued by an earlier
+    process waits until the sender's password is given again.
+
+    The trigger and cadence processes share the table, so a worker claims a notification
+    (status 'sending') in one write transaction before delivering it, and only takes emails
+    from senders whose password it has. A claim older than claim_timeout s, e.g. from a
+    process that died mid-delivery, is released back to pending.
+    """
+
+    def __init__(
+        self,
+        path_data="data",
+        smtp_host="smtp.gmail.com",
+        smtp_port=587,
+        starttls=True,
+        max_attempts=8,
+        initial_delay=5,
+        max_delay=600,
+        idle_timeout=240,
+        claim_timeout=300,
+    ):
+        self.path = f"{path_data}/outbox/notifications.db"
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.starttls = starttls
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.idle_timeout = idle_timeout
+        self.claim_timeout = claim_timeout
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.connection = sqlite3.connect(
+            self.path, timeout=30, check_same_thread=False
+        )
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS notifications (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL,
+                    created REAL NOT NULL,
+                    error TEXT,
+                    sender TEXT,
+                    claimed_by TEXT,
+                    claimed_at REAL
+                )
+                """
+            )
+            # tables made before notifications were claimed
+            columns = [
+                x[1]
+                for x in self.connection.execute("PRAGMA table_info(notifications)")
+            ]
+            for column, column_type in [
+                ("sender", "TEXT"),
+                ("claimed_by", "TEXT"),
+                ("claimed_at", "REAL"),
+            ]:
+                if column not in columns:
+                    self.connection.execute(
+                        f"ALTER TABLE notifications ADD COLUMN {column} {column_type}"
+                    )
+            if "sender" not in columns:
+                for record in self.connection.execute(
+                    "SELECT id, payload FROM notifications WHERE kind = 'email'"
+                ).fetchall():
+                    self.connection.execute(
+                        "UPDATE notifications SET sender = ? WHERE id = ?",
+                        (json.loads(record["payload"])["sender"], record["id"]),
+                    )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS notifications_status_next ON notifications (status, next_attempt)"
+            )
+        self.passwords = {}
+        self.smtp = None
+        self.smtp_sender = None
+        self.smtp_last_used = 0
+        self.wakeup = threading.Event()
+        self.worker = None
+        self.stopping = False
+
+    def put(self, kind, payload):
+        """
+        Queue a notification and wake the worker, returning its id
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO notifications (kind, payload, next_attempt, created, sender) VALUES (?, ?, ?, ?, ?)",
+                (kind, json.dumps(payload), now, now, payload.get("sender")),
+            )
+        self.start()
+        self.wakeup.set()
+        return cursor.lastrowid
+
+    def email(self, sender_email, sender_password, recipient_emails, subject, body):
+        """
+        Queue an html email to all recipient_emails
+        """
+        self.passwords[sender_email] = sender_password
+        payload = {
+            "sender": sender_email,
+            "recipients": list(recipient_emails),
+            "subject": subject,
+            "body": body,
+        }
+        return self.put("email", payload)
+
+    def slack(self, webhook_url, message):
+        """
+        Queue a message for a Slack webhook
+        """
+        return self.put("slack", {"webhook_url": webhook_url, "text": message})
+
+    def start(self):
+        """
+        Start the worker thread, if it isn't running
+        """
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.stopping = False
+                self.worker = threading.Thread(
+                    target=self.run, name="outbox", daemon=True
+                )
+                self.worker.start()
+
+    def counts(self):
+        """
+        Number of notifications with each status
+        """
+        with self.lock:
+            records = self.connection.execute(
+                "SELECT status, COUNT(*) FROM notifications GROUP BY status"
+            ).fetchall()
+        return {status: count for status, count in records}
+
+    def deliverable(self):
+        """
+        WHERE clause and parameters for the pending notifications this process can send -
+        emails only from senders whose password it has
+        """
+        senders = list(self.passwords)
+        placeholders = ", ".join("?" * len(senders))
+        return (
+            f"status = 'pending' AND (kind != 'email' OR sender IN ({placeholders}))",
+            senders,
+        )
+
+    def next_due(self):
+        """
+        The pending notification this process can send that is due soonest, or None if there
+        are none
+        """
+        where, parameters = self.deliverable()
+        with self.lock:
+            return self.connection.execute(
+                f"SELECT * FROM notifications WHERE {where} ORDER BY next_attempt, id LIMIT 1",
+                parameters,
+            ).fetchone()
+
+    def claim(self):
+        """
+        Claim the due notification this process can send soonest, so no other process sends
+        it too, or None if none are due
+        """
+        now = time.time()
+        where, parameters = self.deliverable()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                record = self.connection.execute(
+                    f"SELECT id FROM notifications WHERE {where} AND next_attempt <= ? ORDER BY next_attempt, id LIMIT 1",
+                    (*parameters, now),
+                ).fetchone()
+                if record is not None:
+                    self.connection.execute(
+                        "UPDATE notifications SET status = 'sending', claimed_by = ?, claimed_at = ? WHERE id = ? AND status = 'pending'",
+                        (self.worker_id, now, record["id"]),
+                    )
+                    record = self.connection.execute(
+                        "SELECT * FROM notifications WHERE id = ?", (record["id"],)
+                    ).fetchone()
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+        return record
+
+    def release_stale_claims(self):
+        """
+        Put notifications claimed longer than claim_timeout s ago back to pending
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE notifications SET status = 'pending', claimed_by = NULL WHERE status = 'sending' AND claimed_at < ?",
+                (time.time() - self.claim_timeout,),
+            )
+
+    def mark_sent(self, notification_id):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE notifications SET status = 'sent', error = NULL, claimed_by = NULL WHERE id = ?",
+                (notification_id,),
+            )
+
+    def mark_failed(self, record, error, retry=True):
+        """
+        Schedule another attempt with backoff, or give up after max_attempts
+        """
+        attempts = record["attempts"] + 1
+        delay = min(self.initial_delay * 2 ** (attempts - 1), self.max_delay)
+        status = "pending" if retry and attempts < self.max_attempts else "failed"
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE notifications SET status = ?, attempts = ?, next_attempt = ?, error = ?, claimed_by = NULL WHERE id = ?",
+                (status, attempts, time.time() + delay, str(error), record["id"]),
+            )
+        if status == "failed":
+            logmessage = f"Giving up on {record['kind']} notification {record['id']} after {attempts} attempts: {error}"
+        else:
+            logmessage = f"Failed to send {record['kind']} notification {record['id']}, retrying in {delay} s: {error}"
+        logger.log(logmessage, slack=False)
+
+    def run(self):
+        while not self.stopping:
+            self.wakeup.clear()
+            self.release_stale_claims()
+            record = self.next_due()
+            if record is None:
+                # look again for claims left by a process that died
+                wait = self.claim_timeout
+            else:
+                wait = record["next_attempt"] - time.time()
+            if self.smtp is not None:
+                # close the SMTP connection once it has been idle for a while
+                idle_left = self.smtp_last_used + self.idle_timeout - time.time()
+                if idle_left <= 0:
+                    self.close_smtp()
+                else:
+                    wait = idle_left if wait is None else min(wait, idle_left)
+            if wait is None or wait > 0:
+                self.wakeup.wait(wait)
+                continue
+            record = self.claim()
+            if record is not None:
+                self.deliver(record)
+        self.close_smtp()
+
+    def deliver(self, record):
+        payload = json.loads(record["payload"])
+        try:
+            if record["kind"] == "email":
+                self.send_email(payload)
+            elif record["kind"] == "slack":
+                self.send_slack(payload)
+            else:
+                raise MyException(f"Unknown notification kind {record['kind']}")
+        except MyException as e:
+            self.mark_failed(record, e, retry=False)
+        except Exception as e:
+            self.mark_failed(record, e)
+        else:
+            self.mark_sent(record["id"])
+
+    def connect_smtp(self, sender):
+        password = self.passwords.get(sender)
+        if password is None:
+            raise Exception(f"No password for {sender} in this process yet")
+        self.close_smtp()
+        smtp = smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=30)
+        try:
+            if self.starttls:
+                smtp.starttls()
+            smtp.login(sender, password)
+        except Exception:
+            smtp.close()
+            raise
+        self.smtp = smtp
+        self.smtp_sender = sender
+
+    def close_smtp(self):
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except OSError:
+            self.smtp.close()
+        self.smtp = None
+        self.smtp_sender = None
+
+    def send_email(self, payload):
+        msg = MIMEMultipart()
+        msg["From"] = payload["sender"]
+        msg["To"] = ", ".join(payload["recipients"])
+        msg["Subject"] = payload["subject"]
+        msg.attach(MIMEText(payload["body"], "html"))  # Send as HTML
+        if self.smtp is None or self.smtp_sender != payload["sender"]:
+            self.connect_smtp(payload["sender"])
+        try:
+            self.smtp.sendmail(
+                payload["sender"], payload["recipients"], msg.as_string()
+            )
+        except smtplib.SMTPServerDisconnected:
+            # the server dropped the connection we kept open - reconnect once
+            self.connect_smtp(payload["sender"])
+            self.smtp.sendmail(
+                payload["sender"], payload["recipients"], msg.as_string()
+            )
+        except OSError:
+            # SMTP errors included, start the next attempt on a fresh connection
+            self.close_smtp()
+            raise
+        self.smtp_last_used = time.time()
+        logmessage = f"Sent email '{payload['subject']}' to {len(payload['recipients'])} recipients"
+        logger.log(logmessage, slack=False)
+
+    def send_slack(self, payload):
+        response = get_http_client().post(
+            payload["webhook_url"], json={"text": payload["text"]}, timeout=10
+        )
+        if response.status_code in SLACK_PERMANENT_ERRORS:
+            raise MyException(f"Slack webhook status code {response.status_code}")
+        if response.status_code != 200:
+            raise Exception(f"Slack webhook status code {response.status_code}")
+
+    def flush(self, timeout=30):
+        """
+        Wait up to timeout s for the notifications due now to be sent or scheduled for a
+        retry, True if none are left due
+        """
+        end_time = time.time() + timeout
+        while True:
+            record = self.next_due()
+            if record is None or record["next_attempt"] > time.time():
+                return True
+            if time.time() >= end_time:
+                return False
+            self.start()
+            self.wakeup.set()
+            time.sleep(0.05)
+
+    def stop(self, timeout=30):
+        # slack log messages the log writers are still coalescing belong in the outbox first
+        for writer in list(log_writers.values()):
+            writer.flush()
+        self.flush(timeout)
+        self.stopping = True
+        self.wakeup.set()
+        if self.worker is not None:
+            self.worker.join(timeout)
+
+
+outboxes = {}
+
+
+def get_outbox(path_data="data"):
+    """
+    One outbox (and worker) per data directory per process. Before the process exits we
+    give the worker a little time to send what is queued, and anything left is sent by
+    the next process to use the outbox.
+    """
+    if path_data not in outboxes:
+        outbox = Outbox(path_data)
+        outboxes[path_data] = outbox
+        atexit.register(outbox.stop)
+    return outboxes[path_data]
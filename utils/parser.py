@@ -18,6 +18,11 @@ def trigger_parser():
         default="data",
         help="Path to data directory",
     )
+    parser.add_argument(
+        "--no_trace",
+        action="store_true",
+        help="Include --no_trace to stop writing stage timings to data/logs/trace.jsonl",
+    )
     return parser
 
 
@@ -53,6 +58,11 @@ def followup_parser():
         choices=["O4a", "O4b", "O4c"],
         help="Current LIGO observing run",
     )
+    parser.add_argument(
+        "--no_trace",
+        action="store_true",
+        help="Include --no_trace to stop writing stage timings to data/logs/trace.jsonl",
+    )
     return parser
 
 
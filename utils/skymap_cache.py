@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import fcntl
+import threading
+import contextlib
+from astropy.table import Table
+
+from utils.log import Logger
+from utils.http_client import get_http_client
+
+# set up logger (this one wont send to slack)
+logger = Logger(filename="skymap_cache")
+
+
+class SkymapCache:
+    """
+    On-disk cache of multiorder skymaps shared by trigger, flares, and the notebooks.
+
+    Files are stored by the sha256 of their content, and an index maps each GraceDB url
+    to its content hash and the ETag/Last-Modified headers used to revalidate it. Parsed
+    tables are kept in memory by content hash, so a skymap is parsed once per process.
+    The trigger and flares processes share the cache, so the index is only updated while
+    holding a lock on index.lock, and the directory is only scanned for eviction once the
+    skymaps we know of add up to more than max_bytes.
+    """
+
+    def __init__(self, cache_dir="data/skymaps", max_bytes=2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.lock_path = os.path.join(cache_dir, "index.lock")
+        self.tables = {}
+        self.total_bytes = None  # size of the cached skymaps, from the last scan on
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Hold the cache lock, shared between processes and threads, in the with block
+        """
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_index(self, index):
+        # write then rename so another process never reads a partial index
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"  # only written under the lock
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def content_path(self, content_hash):
+        return os.path.join(self.cache_dir, f"{content_hash}.fits")
+
+    @staticmethod
+    def is_versioned(url):
+        """
+        GraceDB file urls ending in ",N" point to one immutable version of the file
+        """
+        return url.rsplit(",", 1)[-1].isdigit()
+
+    def store(self, content):
+        content_hash = hashlib.sha256(content).hexdigest()
+        path = self.content_path(content_hash)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+            if self.total_bytes is not None:
+                self.total_bytes += len(content)
+            if self.total_bytes is None or self.total_bytes > self.max_bytes:
+                with self.locked():
+                    self.evict()
+        return content_hash
+
+    def evict(self):
+        """
+        Remove least recently used skymaps until the cache is under max_bytes
+        """
+        files = [
+            os.path.join(self.cache_dir, f)
+            for f in os.listdir(self.cache_dir)
+            if f.endswith(".fits")
+        ]
+        stats = {}
+        for f in files:
+            try:
+                stats[f] = os.stat(f)
+            except FileNotFoundError:
+                pass  # evicted by another process
+        files = sorted(stats, key=lambda f: stats[f].st_mtime)
+        total = sum(x.st_size for x in stats.values())
+        for f in files[:-1]:  # never evict the newest file
+            if total <= self.max_bytes:
+                break
+            total -= stats[f].st_size
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                continue
+            self.tables.pop(os.path.basename(f)[: -len(".fits")], None)
+            logmessage = f"evicted {f} from skymap cache"
+            logger.log(logmessage, slack=False)
+        self.total_bytes = total
+
+    def fetch(self, url):
+        """
+        Get the content hash for a skymap url, downloading only if we don't have the current version
+        """
+        index = self.load_index()
+        entry = index.get(url)
+        if entry and os.path.exists(self.content_path(entry["hash"])):
+            if self.is_versioned(url):
+                return self.touch(entry["hash"])
+            headers = {}
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+            response = get_http_client().get(url, headers=headers)
+            if response.status_code == 304:
+                return self.touch(entry["hash"])
+        else:
+            response = get_http_client().get(url)
+        if response.status_code != 200:
+            raise Exception(
+                f"Could not download skymap {url}: status code {response.status_code}"
+            )
+        content_hash = self.store(response.content)
+        # read, modify and write the index under the lock so no other store is lost
+        with self.locked():
+            index = self.load_index()
+            index[url] = {
+                "hash": content_hash,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            self.save_index(index)
+        logmessage = f"downloaded skymap {url} ({len(response.content)} bytes)"
+        logger.log(logmessage, slack=False)
+        return content_hash
+
+    def touch(self, content_hash):
+        # mtime records the last access for LRU eviction
+        os.utime(self.content_path(content_hash))
+        return content_hash
+
+    def read_table(self, content_hash):
+        if content_hash not in self.tables:
+            self.tables[content_hash] = Table.read(
+                self.content_path(content_hash), memmap=True
+            )
+        return self.tables[content_hash]
+
+    def get_path(self, url):
+        """
+        Local path of the FITS file for a skymap url, e.g. for ligo.skymap.io.read_sky_map
+        """
+        return self.content_path(self.fetch(url))
+
+    def get_table(self, url):
+        """
+        Skymap for a url as an astropy Table
+        """
+        return self.read_table(self.fetch(url))
+
+    def read_bytes(self, content_hash):
+        with open(self.content_path(content_hash), "rb") as f:
+            return f.read()
+
+    def get_bytes(self, url):
+        return self.read_bytes(self.fetch(url))
+
+    def table_from_bytes(self, content):
+        """
+        Skymap for raw FITS content (e.g. a decoded base64 string), parsed only if not seen before
+        """
+        return self.read_table(self.store(content))
+
+
+skymap_caches = {}
+
+
+def get_skymap_cache(path_data="data"):
+    """
+    One shared cache per data directory per process
+    """
+    if path_data not in skymap_caches:
+        skymap_caches[path_data] = SkymapCache(cache_dir=f"{path_data}/skymaps")
+    return skymap_caches[path_data]
@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import argparse
+import threading
+import contextvars
+import numpy as np
+
+# attributes added to every span in the current context, e.g. the superevent being processed.
+# asyncio tasks and asyncio.to_thread copy the context, so these follow an alert everywhere.
+trace_attributes = contextvars.ContextVar("trace_attributes", default={})
+
+
+class Span:
+    """
+    One timed stage, written to the trace file when the with block exits
+    """
+
+    __slots__ = ("tracer", "name", "attributes", "start", "perf_start")
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        """
+        Add attributes once they are known, e.g. the outcome of the stage
+        """
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start = time.time()
+        self.perf_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        record = {
+            "name": self.name,
+            "start": round(self.start, 3),
+            "duration": round(time.perf_counter() - self.perf_start, 6),
+            "process": self.tracer.process,
+            "attributes": {**trace_attributes.get(), **self.attributes},
+        }
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        self.tracer.write(record)
+        return False
+
+
+class TraceContext:
+    """
+    Add attributes to every span started inside the with block
+    """
+
+    __slots__ = ("attributes", "token")
+
+    def __init__(self, attributes):
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.token = trace_attributes.set({**trace_attributes.get(), **self.attributes})
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        trace_attributes.reset(self.token)
+        return False
+
+
+class NullSpan:
+    """
+    What span and context return when tracing is off - does nothing
+    """
+
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    """
+    Timing of each stage of the trigger and cadence, as spans in a JSON lines file.
+
+    Each span is a line with the stage name, start time, duration in seconds, the process
+    that wrote it, any attributes, and the exception type if the stage raised. When the
+    tracer is disabled span() returns a shared no-op object, so leaving spans in the code
+    costs next to nothing.
+    """
+
+    def __init__(self, path="data/logs/trace.jsonl", enabled=True, process=None):
+        self.path = path
+        self.enabled = enabled
+        self.process = process
+        self.file = None
+        self.lock = threading.Lock()
+
+    def configure(self, path=None, enabled=None, process=None):
+        with self.lock:
+            if path is not None and path != self.path:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                self.path = path
+            if enabled is not None:
+                self.enabled = enabled
+            if process is not None:
+                self.process = process
+
+    def span(self, name, **attributes):
+        """
+        with tracer.span("skymap fetch", url=url): ...
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, attributes)
+
+    def context(self, **attributes):
+        """
+        with tracer.context(superevent_id=superevent_id): ...
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return TraceContext(attributes)
+
+    def write(self, record):
+        line = json.dumps(record, default=str)
+        with self.lock:
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self.file = open(self.path, "a")
+            self.file.write(line + "\n")
+            self.file.flush()
+
+
+tracer = Tracer()
+
+
+def get_tracer():
+    """
+    One tracer per process
+    """
+    return tracer
+
+
+def load_spans(path="data/logs/trace.jsonl", since=None):
+    """
+    Spans from a trace file, optionally only those starting after since (unix time)
+    """
+    spans = []
+    with open(path) as f:
+        for line in f:
+            try:
+                span = json.loads(line)
+            except json.JSONDecodeError:
+                # a line cut short by a crash
+                continue
+            if since is None or span["start"] >= since:
+                spans.append(span)
+    return spans
+
+
+def summarize(spans, last=None):
+    """
+    Count, p50, p95, max and total duration of each stage, most total time first. With
+    last, only spans from the last superevents (by when their first span started).
+    """
+    if last is not None:
+        first_seen = {}
+        for span in spans:
+            superevent_id = span["attributes"].get("superevent_id")
+            if superevent_id is not None:
+                first_seen.setdefault(superevent_id, span["start"])
+        recent = set(sorted(first_seen, key=first_seen.get)[-last:])
+        spans = [s for s in spans if s["attributes"].get("superevent_id") in recent]
+    durations = {}
+    for span in spans:
+        durations.setdefault(span["name"], []).append(span["duration"])
+    rows = []
+    for name, values in durations.items():
+        p50, p95 = np.percentile(values, [50, 95])
+        rows.append(
+            {
+                "name": name,
+                "count": len(values),
+                "p50": p50,
+                "p95": p95,
+                "max": max(values),
+                "total": sum(values),
+            }
+        )
+    return sorted(rows, key=lambda row: row["total"], reverse=True)
+
+
+def format_summary(rows):
+    lines = [f"{'stage':<24} {'count':>6} {'p50 s':>9} {'p95 s':>9} {'max s':>9}"]
+    for row in rows:
+        lines.append(
+            f"{row['name']:<24} {row['count']:>6} {row['p50']:>9.2f} {row['p95']:>9.2f} {row['max']:>9.2f}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Summarize stage timings in a trace file"
+    )
+    parser.add_argument("--path", default="data/logs/trace.jsonl")
+    parser.add_argument("--last", type=int, help="only the last N superevents")
+    parser.add_argument("--hours", type=float, help="only spans from the last N hours")
+    args = parser.parse_args()
+    since = time.time() - 3600 * args.hours if args.hours else None
+    print(format_summary(summarize(load_spans(args.path, since), args.last)))